@@ -0,0 +1 @@
+# Офлайн-скрипты подготовки данных; запуск из корня репозитория: python -m clean_data.<скрипт>
@@ -0,0 +1,413 @@
+# catalog_parser.py - Разбор выгрузки СТЕ в колоночный каталог: чанки, пул процессов, докачка после сбоя
+import json
+import os
+import re
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from py_back.shared_arrays import SharedArrayStore
+
+# Менять при любом изменении правил ниже - иначе останется старый каталог
+PARSER_VERSION = 1
+
+# Порядок важен: побеждает первая категория, чье ключевое слово нашлось
+CATEGORY_KEYWORDS = {
+    'Канцелярия': ['ручка', 'карандаш', 'бумага', 'блокнот', 'клей', 'ластик', 'степлер',
+                  'скрепк', 'папка', 'файл', 'маркер', 'тетрадь', 'скотч', 'линейка'],
+    'Хозтовары': ['моющее', 'чистящ', 'мыло', 'дезинфицирующ', 'бельниц', 'гель',
+                 'средство', 'порошок', 'жидкость', 'отбелива', 'пятновыводитель'],
+    'Офисная техника': ['принтер', 'сканер', 'мфу', 'картридж', 'тонер', 'копир', 'факс'],
+    'IT оборудование': ['компьютер', 'ноутбук', 'сервер', 'роутер', 'монитор', 'клавиатура', 'мышь'],
+    'Мебель': ['стол', 'кресло', 'стул', 'шкаф', 'мебель', 'диван', 'полка', 'стеллаж'],
+    'Строительные материалы': ['краска', 'лак', 'инструмент', 'строительн', 'кисть', 'валик', 'шпатель'],
+    'Бытовая химия': ['химия', 'освежитель', 'средство для', 'очиститель'],
+    'Уборочный инвентарь': ['швабра', 'ведро', 'совок', 'щетка', 'перчатк', 'инвентар', 'тряпк']
+}
+DEFAULT_CATEGORY = 'Разное'
+CATEGORIES = list(CATEGORY_KEYWORDS) + [DEFAULT_CATEGORY]
+
+BASE_PRICES = {
+    'Канцелярия': 120,
+    'Хозтовары': 380,
+    'Офисная техника': 7500,
+    'IT оборудование': 12500,
+    'Мебель': 4500,
+    'Строительные материалы': 950,
+    'Бытовая химия': 280,
+    'Уборочный инвентарь': 650,
+    'Разное': 400
+}
+PREMIUM_WORDS = ['премиум', 'профессиональ', 'professional']
+ECONOMY_WORDS = ['эконом', 'бюджет', 'стандарт']
+VOLUME_PATTERNS = [
+    r'(\d+)\s*мл', r'(\d+)\s*л', r'(\d+)\s*г', r'(\d+)\s*кг',
+    r'(\d+)\s*ml', r'(\d+)\s*l', r'(\d+)\s*g', r'(\d+)\s*kg'
+]
+# Число из названия переводится в мл/г, если где-то в названии есть кг или л
+VOLUME_SCALE_WORDS = ['кг', 'kg', 'л', 'l']
+
+# Пары ключ-значение в атрибутах, которые не разобрались как JSON
+ATTRIBUTE_PATTERNS = [re.compile(pattern) for pattern in (
+    r'"([^"]+)"\s*:\s*"([^"]*)"',
+    r'"([^"]+)"\s*:\s*([^,}]+)',
+    r'(\w+)\s*:\s*"([^"]*)"',
+    r'(\w+)\s*:\s*([^,\n]+)'
+)]
+IMPORTANT_ATTRIBUTES = ['Назначение', 'Объем', 'Тип', 'Форма', 'Консистенция', 'Вид']
+AVAILABLE_VALUES = ['t', 'true', '1', 'y', 'yes']
+
+# Колонки каталога, которые хранятся как строки (utf-8 байты + смещения)
+STRING_COLUMNS = ['id', 'name', 'attributes', 'description']
+
+
+def _keywords_pattern(words):
+    return '|'.join(re.escape(word) for word in words)
+
+
+def parse_attributes(attr_str):
+    """Атрибуты товара: JSON, а если не разбирается - пары ключ: значение из текста"""
+    try:
+        return json.loads(attr_str)
+    except Exception:
+        attrs = {}
+        for pattern in ATTRIBUTE_PATTERNS:
+            for key, value in pattern.findall(attr_str):
+                attrs[key.strip()] = value.strip()
+        return attrs
+
+
+def generate_description(name, category, attributes):
+    """Описание для эмбеддингов"""
+    description_parts = [name, category]
+
+    if attributes:
+        for attr in IMPORTANT_ATTRIBUTES:
+            if attr in attributes:
+                description_parts.append(f"{attr}: {attributes[attr]}")
+
+    return ". ".join(description_parts)
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _text_column(df, i):
+    """i-я колонка строками, пропуски - пустая строка"""
+    if i >= df.shape[1]:
+        return pd.Series('', index=df.index, dtype=object)
+    column = df.iloc[:, i]
+    return column.astype(str).where(column.notna(), '')
+
+
+def _present(values):
+    return (values.str.strip() != '') & (values != 'nan')
+
+
+def _classify(texts, assigned):
+    """Коды категорий по ключевым словам для строк, где категория еще не определена (-1)"""
+    for code, keywords in enumerate(CATEGORY_KEYWORDS.values()):
+        pending = assigned < 0
+        if not pending.any():
+            break
+        found = texts[pending].str.contains(_keywords_pattern(keywords), regex=True).to_numpy()
+        assigned[np.flatnonzero(pending)[found]] = code
+    return assigned
+
+
+def _extract_volumes(names_lower):
+    """Объем из названия (как первое совпадение первого сработавшего шаблона), 0 - не найден"""
+    volumes = np.zeros(len(names_lower))
+    found = np.zeros(len(names_lower), dtype=bool)
+    for pattern in VOLUME_PATTERNS:
+        if found.all():
+            break
+        matches = names_lower[~found].str.extract(pattern, expand=False)
+        hit = matches.notna().to_numpy()
+        rows = np.flatnonzero(~found)[hit]
+        volumes[rows] = [float(value) for value in matches[hit]]
+        found[rows] = True
+
+    scaled = found & names_lower.str.contains(_keywords_pattern(VOLUME_SCALE_WORDS), regex=True).to_numpy()
+    volumes[scaled] *= 1000
+    return volumes
+
+
+def estimate_prices(names, category_codes):
+    """Оценка цены по категории, словам-маркерам и объему в названии"""
+    names_lower = names.str.lower()
+    base = np.array([BASE_PRICES.get(category, 400) for category in CATEGORIES], dtype=np.float64)
+    prices = base[category_codes]
+
+    premium = names_lower.str.contains(_keywords_pattern(PREMIUM_WORDS), regex=True).to_numpy()
+    economy = ~premium & names_lower.str.contains(_keywords_pattern(ECONOMY_WORDS), regex=True).to_numpy()
+    prices[premium] *= 1.5
+    prices[economy] *= 0.7
+
+    volumes = _extract_volumes(names_lower)
+    large = volumes > 1000
+    medium = ~large & (volumes > 500)
+    small = ~large & ~medium & (volumes > 0)
+    prices[large] *= 2.5
+    prices[medium] *= 1.8
+    prices[small] *= volumes[small] / 200
+
+    return np.array([round(price, 2) for price in prices.tolist()], dtype=np.float64)
+
+
+def parse_chunk(df):
+    """Разбор пачки строк выгрузки в колонки каталога.
+
+    Колонки выгрузки: 0 - id, 1 - название, 5 - атрибуты, 6 - цена, 7 - доступность.
+    Строковые правила применяются ко всей колонке сразу; построчно разбираются
+    только атрибуты (JSON) и описание.
+    """
+    df = df.dropna(how='all')
+    values = [_text_column(df, i) for i in range(8)]
+
+    product_ids = values[0].str.strip()
+    missing_ids = ((product_ids == '') | (product_ids == 'nan')).to_numpy()
+    if missing_ids.any():
+        rows = np.flatnonzero(missing_ids)
+        product_ids.iloc[rows] = [
+            f"auto_{hash(str([column.iloc[row] for column in values])) % 100000}" for row in rows
+        ]
+
+    names = values[1].str.strip()
+    missing_names = (names == '') | (names == 'nan')
+    names = names.where(~missing_names, 'Товар ' + product_ids)
+
+    has_attributes = _present(values[5]).to_numpy()
+    attributes = [parse_attributes(text) if present else {}
+                  for text, present in zip(values[5].tolist(), has_attributes)]
+
+    # Сначала по названию, затем по тексту атрибутов
+    category_codes = np.full(len(df), -1, dtype=np.int64)
+    category_codes = _classify(names.str.lower(), category_codes)
+    if (category_codes < 0).any():
+        attribute_texts = pd.Series([str(attrs).lower() for attrs in attributes], index=df.index)
+        category_codes = _classify(attribute_texts, category_codes)
+    category_codes[category_codes < 0] = CATEGORIES.index(DEFAULT_CATEGORY)
+
+    prices = np.full(len(df), np.nan)
+    has_price = _present(values[6]).to_numpy()
+    parsed = [_to_float(text) for text in values[6][has_price].tolist()]
+    prices[np.flatnonzero(has_price)] = [np.nan if price is None else price for price in parsed]
+    estimated = ~has_price
+    estimated[np.flatnonzero(has_price)] = [price is None for price in parsed]
+    if estimated.any():
+        prices[estimated] = estimate_prices(names[estimated], category_codes[estimated])
+
+    availability = values[7].str.strip().str.lower()
+    available = (_present(values[7]) & availability.isin(AVAILABLE_VALUES)).to_numpy()
+
+    # Описание зависит от произвольного JSON; строка, на которой оно падает, пропускается
+    descriptions, keep = [], np.ones(len(df), dtype=bool)
+    for i, (name, code, attrs) in enumerate(zip(names.tolist(), category_codes.tolist(), attributes)):
+        try:
+            descriptions.append(generate_description(name, CATEGORIES[code], attrs))
+        except Exception:
+            descriptions.append('')
+            keep[i] = False
+
+    columns = {
+        'id': product_ids.tolist(),
+        'name': names.tolist(),
+        'category': category_codes.astype(np.int8),
+        'price': prices,
+        'available': available,
+        'attributes': [json.dumps(attrs, ensure_ascii=False) for attrs in attributes],
+        'description': descriptions
+    }
+    if not keep.all():
+        columns = {key: [value for value, k in zip(column, keep) if k] if isinstance(column, list) else column[keep]
+                   for key, column in columns.items()}
+    return columns
+
+
+def encode_strings(values):
+    """Список строк -> (utf-8 байты подряд, смещения длиной n + 1)"""
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(data, offsets):
+    raw = np.asarray(data).tobytes()
+    offsets = np.asarray(offsets).tolist()
+    return [raw[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _to_arrays(columns):
+    arrays = {}
+    for name, column in columns.items():
+        if name in STRING_COLUMNS:
+            arrays[f'{name}_data'], arrays[f'{name}_offsets'] = encode_strings(column)
+        else:
+            arrays[name] = np.asarray(column)
+    return arrays
+
+
+def _save_chunk(path, columns):
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **_to_arrays(columns))
+    os.replace(tmp_path, path)
+
+
+def _load_chunk(path):
+    with np.load(path) as chunk:
+        return {name: chunk[name] for name in chunk.files}
+
+
+def parse_chunk_to_file(df, path):
+    """Задача воркера: разбор пачки и атомарная запись чанка (файл чанка = чекпоинт)"""
+    columns = parse_chunk(df)
+    _save_chunk(path, columns)
+    return len(df), len(columns['id'])
+
+
+def _merge_chunks(paths):
+    """Склейка чанков в порядке выгрузки; смещения строк сдвигаются на длину предыдущих данных"""
+    chunks = [_load_chunk(path) for path in paths]
+    merged = {}
+    for name in chunks[0] if chunks else []:
+        if name.endswith('_offsets'):
+            parts, shift = [np.zeros(1, dtype=np.int64)], 0
+            for chunk in chunks:
+                parts.append(chunk[name][1:] + shift)
+                shift += int(chunk[name][-1])
+            merged[name] = np.concatenate(parts)
+        else:
+            merged[name] = np.concatenate([chunk[name] for chunk in chunks])
+    return merged
+
+
+def source_fingerprint(source_path, sep):
+    stat = os.stat(source_path)
+    return f"catalog-parser-v{PARSER_VERSION}:{os.path.abspath(source_path)}:{stat.st_size}:{stat.st_mtime_ns}:{sep}"
+
+
+def build_catalog(source_path, output_dir='catalog_store', workers=None, chunk_size=50000, sep='|'):
+    """Разбор выгрузки товаров в колоночный каталог output_dir/catalog.
+
+    Пачки по chunk_size строк разбираются в пуле процессов, каждая пишется
+    отдельным файлом в output_dir/catalog/chunks. При перезапуске уже записанные
+    чанки пропускаются, поэтому после сбоя работа продолжается с места падения.
+    Готовый каталог публикуется через SharedArrayStore (memory-mapped .npy).
+    """
+    fingerprint = source_fingerprint(source_path, sep)
+    store = SharedArrayStore(output_dir, 'catalog', fingerprint=fingerprint)
+    if store.is_ready():
+        print(f"✅ Каталог уже построен: {store.path}")
+        return store
+    if not store.try_become_leader():
+        raise RuntimeError(f"Каталог в {store.path} уже строит другой процесс")
+    try:
+        return _build_catalog(store, source_path, fingerprint, sep, chunk_size, workers)
+    finally:
+        store.release()
+
+
+def _build_catalog(store, source_path, fingerprint, sep, chunk_size, workers):
+    chunks_dir = os.path.join(store.path, 'chunks')
+    job_file = os.path.join(chunks_dir, 'job.json')
+    job = {'fingerprint': fingerprint, 'chunk_size': chunk_size}
+    try:
+        with open(job_file, 'r', encoding='utf-8') as f:
+            resumable = json.load(f) == job
+    except (FileNotFoundError, json.JSONDecodeError):
+        resumable = False
+    if not resumable:
+        # Чанки от другой выгрузки или другого размера пачки не годятся
+        shutil.rmtree(chunks_dir, ignore_errors=True)
+        os.makedirs(chunks_dir)
+        with open(job_file, 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+
+    workers = workers or os.cpu_count() or 1
+    reader = pd.read_csv(source_path, encoding='utf-8-sig', sep=sep, header=None, dtype=str,
+                         on_bad_lines='skip', chunksize=chunk_size)
+
+    start_time = time.time()
+    paths, failed = [], []
+    stats = {'skipped': 0, 'done': 0, 'rows': 0, 'products': 0}
+
+    def collect(done_futures):
+        for future in done_futures:
+            index = pending.pop(future)
+            try:
+                rows, products = future.result()
+            except Exception as e:
+                failed.append(index)
+                print(f"❌ Чанк {index}: {e}")
+                continue
+            stats['done'] += 1
+            stats['rows'] += rows
+            stats['products'] += products
+            elapsed = time.time() - start_time
+            print(f"📦 Чанк {index} готов: {stats['rows']:,} строк за {elapsed:.0f} с "
+                  f"({stats['rows'] / max(elapsed, 1e-9):,.0f} строк/с), пропущено готовых: {stats['skipped']}")
+
+    pending = {}
+    print(f"🚀 Разбор {source_path}: пачки по {chunk_size:,} строк, {workers} процессов")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for index, chunk in enumerate(reader):
+            path = os.path.join(chunks_dir, f'chunk_{index:05d}.npz')
+            paths.append(path)
+            if os.path.exists(path):
+                stats['skipped'] += 1
+                continue
+            pending[pool.submit(parse_chunk_to_file, chunk, path)] = index
+            # Не читаем выгрузку сильно впереди воркеров
+            while len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    if failed:
+        raise RuntimeError(f"Не разобраны чанки {sorted(failed)}; повторный запуск продолжит с них")
+
+    arrays = _merge_chunks(paths)
+    store.publish(arrays, metadata={'categories': CATEGORIES, 'source': source_path,
+                                    'chunks': len(paths), 'products': len(arrays.get('price', []))})
+    shutil.rmtree(chunks_dir, ignore_errors=True)
+    print(f"✅ Каталог построен за {time.time() - start_time:.0f} с: {len(arrays.get('price', [])):,} товаров")
+    return store
+
+
+def load_catalog(output_dir='catalog_store', source_path=None, sep='|'):
+    """Колонки готового каталога: строки списками, числа - memory-mapped массивами"""
+    fingerprint = source_fingerprint(source_path, sep) if source_path else ''
+    store = SharedArrayStore(output_dir, 'catalog', fingerprint=fingerprint)
+    if source_path and not store.is_ready():
+        raise RuntimeError(f"Каталог в {store.path} не построен для {source_path}")
+
+    arrays, metadata = store.attach()
+    columns = {name: decode_strings(arrays[f'{name}_data'], arrays[f'{name}_offsets']) for name in STRING_COLUMNS}
+    columns.update({name: arrays[name] for name in ('category', 'price', 'available')})
+    columns['categories'] = metadata['categories']
+    return columns
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Разбор выгрузки товаров в колоночный каталог")
+    parser.add_argument('source', help="CSV выгрузка товаров (без заголовка)")
+    parser.add_argument('--output', default='catalog_store')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--sep', default='|')
+    args = parser.parse_args()
+
+    build_catalog(args.source, args.output, workers=args.workers, chunk_size=args.chunk_size, sep=args.sep)
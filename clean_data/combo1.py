@@ -5,16 +5,22 @@ import torch
 from transformers import AutoTokenizer, AutoModel
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
-import re
+import os
 from collections import defaultdict, Counter
 import warnings
+
+from clean_data.catalog_parser import CATEGORIES, build_catalog, load_catalog, parse_chunk
 warnings.filterwarnings('ignore')
 
 class FixedProcurementRecommender:
+    # Колоночный каталог, который строит catalog_parser (переиспользуется между запусками)
+    CATALOG_DIR = os.environ.get('CATALOG_DIR', 'catalog_store')
+    CATALOG_WORKERS = int(os.environ['CATALOG_WORKERS']) if os.environ.get('CATALOG_WORKERS') else None
+    
     def __init__(self, templates_path, analysis_path, products_path, procurement_examples=None):
         self.templates = self._load_json(templates_path)
         self.analysis = self._load_json(analysis_path)
-        self.products_df = self._load_products_fixed(products_path)
+        self.products_path = products_path
         self.procurement_examples = procurement_examples or []
         
         # Инициализация моделей
@@ -38,42 +44,6 @@ class FixedProcurementRecommender:
         with open(path, 'r', encoding='utf-8') as f:
             return json.load(f)
 
-    def _load_products_fixed(self, products_path):
-        """Исправленная загрузка CSV с обработкой ошибок"""
-        try:
-            # Пробуем разные разделители и кодировки
-            try:
-                # Сначала пробуем с разделителем |
-                df = pd.read_csv(products_path, encoding='utf-8-sig', sep='|', header=None, 
-                               on_bad_lines='skip', low_memory=False)
-                print(f"✅ Загружено с разделителем |: {len(df)} строк")
-            except:
-                try:
-                    # Пробуем с разделителем ;
-                    df = pd.read_csv(products_path, encoding='utf-8-sig', sep=';', header=None,
-                                   on_bad_lines='skip', low_memory=False)
-                    print(f"✅ Загружено с разделителем ;: {len(df)} строк")
-                except:
-                    # Пробуем с автоматическим определением
-                    df = pd.read_csv(products_path, encoding='utf-8-sig', header=None,
-                                   on_bad_lines='skip', low_memory=False, engine='python')
-                    print(f"✅ Загружено с автоопределением: {len(df)} строк")
-            
-            # Очистка данных
-            df = df.dropna(how='all')  # Удаляем полностью пустые строки
-            df = df.reset_index(drop=True)
-            
-            print(f"📊 Структура данных: {df.shape[0]} строк, {df.shape[1]} колонок")
-            if len(df) > 0:
-                print(f"📋 Пример первой строки: {df.iloc[0].tolist()}")
-            
-            return df
-            
-        except Exception as e:
-            print(f"❌ Критическая ошибка загрузки: {e}")
-            # Создаем тестовые данные для продолжения работы
-            return self._create_test_data()
-
     def _create_test_data(self):
         """Создает тестовые данные если файл не загружается"""
         print("🔄 Создание тестовых данных...")
@@ -99,217 +69,48 @@ class FixedProcurementRecommender:
         return pd.DataFrame(test_data)
 
     def _build_enhanced_catalog(self):
-        """Строит каталог товаров с обработкой разных структур данных"""
+        """Строит каталог товаров из колоночного каталога catalog_parser"""
         print("📦 Построение каталога товаров...")
         
         self.product_catalog = {}
         self.available_products = set()
         self.category_products = defaultdict(list)
         
-        if self.products_df is None or len(self.products_df) == 0:
-            print("❌ Нет данных для построения каталога")
-            return
-        
-        successful_parses = 0
+        try:
+            # Выгрузка разбирается один раз пачками в пуле процессов; повторно - только после ее изменения
+            build_catalog(self.products_path, self.CATALOG_DIR, workers=self.CATALOG_WORKERS)
+            columns = load_catalog(self.CATALOG_DIR, self.products_path)
+        except Exception as e:
+            print(f"❌ Критическая ошибка загрузки: {e}")
+            # Создаем тестовые данные для продолжения работы
+            columns = parse_chunk(self._create_test_data())
+            columns['categories'] = CATEGORIES
         
-        for idx, row in self.products_df.iterrows():
-            try:
-                product_data = self._parse_product_row(row)
-                if product_data:
-                    product_id = product_data['id']
-                    self.product_catalog[product_id] = product_data
-                    
-                    if product_data.get('available', False):
-                        self.available_products.add(product_id)
-                    
-                    category = product_data['category']
-                    self.category_products[category].append(product_id)
-                    successful_parses += 1
-                    
-            except Exception as e:
-                continue  # Пропускаем проблемные строки
+        categories = columns['categories']
+        rows = zip(columns['id'], columns['name'], columns['category'].tolist(), columns['price'].tolist(),
+                   columns['available'].tolist(), columns['attributes'], columns['description'])
         
-        print(f"✅ Успешно обработано: {successful_parses} товаров")
-        print(f"📊 Категории: {list(self.category_products.keys())}")
-
-    def _parse_product_row(self, row):
-        """Парсит строку с товаром из DataFrame"""
-        try:
-            # Берем первые 8 колонок (максимум что может быть)
-            values = [str(row[i]) if i < len(row) and pd.notna(row[i]) else '' for i in range(8)]
-            
-            product_id = values[0].strip()
-            if not product_id or product_id == 'nan':
-                product_id = f"auto_{hash(str(values)) % 100000}"
-            
-            # Извлекаем название
-            name = values[1].strip() if len(values) > 1 else f"Товар {product_id}"
-            if not name or name == 'nan':
-                name = f"Товар {product_id}"
-            
-            # Парсим атрибуты
-            attributes = {}
-            if len(values) > 5 and values[5].strip() and values[5] != 'nan':
-                attributes = self._parse_attributes(values[5])
-            
-            # Определяем категорию
-            category = self._determine_category(name, attributes)
-            
-            # Извлекаем цену
-            price = 0.0
-            if len(values) > 6 and values[6].strip() and values[6] != 'nan':
-                try:
-                    price = float(values[6])
-                except:
-                    price = self._estimate_price(category, name)
-            else:
-                price = self._estimate_price(category, name)
-            
-            # Определяем доступность
-            available = False
-            if len(values) > 7 and values[7].strip() and values[7] != 'nan':
-                available = values[7].strip().lower() in ['t', 'true', '1', 'y', 'yes']
-            
-            return {
+        successful_parses = 0
+        for product_id, name, category_code, price, available, attributes, description in rows:
+            category = categories[category_code]
+            self.product_catalog[product_id] = {
                 'id': product_id,
                 'name': name,
                 'category': category,
                 'price': price,
-                'attributes': attributes,
+                'attributes': json.loads(attributes),
                 'available': available,
-                'description': self._generate_description(name, category, attributes)
+                'description': description
             }
             
-        except Exception as e:
-            return None
-
-    def _parse_attributes(self, attr_str):
-        """Парсит атрибуты товара"""
-        try:
-            if isinstance(attr_str, str) and attr_str.strip():
-                # Пробуем как JSON
-                try:
-                    return json.loads(attr_str)
-                except:
-                    # Пробуем извлечь ключ-значения из текста
-                    attrs = {}
-                    # Ищем паттерны типа "ключ": "значение"
-                    patterns = [
-                        r'"([^"]+)"\s*:\s*"([^"]*)"',
-                        r'"([^"]+)"\s*:\s*([^,}]+)',
-                        r'(\w+)\s*:\s*"([^"]*)"',
-                        r'(\w+)\s*:\s*([^,\n]+)'
-                    ]
-                    
-                    for pattern in patterns:
-                        matches = re.findall(pattern, attr_str)
-                        for key, value in matches:
-                            attrs[key.strip()] = value.strip()
-                    
-                    return attrs
-        except:
-            pass
-        return {}
-
-    def _determine_category(self, name, attributes):
-        """Определяет категорию товара"""
-        name_lower = name.lower()
-        attrs_str = str(attributes).lower()
-        
-        category_keywords = {
-            'Канцелярия': ['ручка', 'карандаш', 'бумага', 'блокнот', 'клей', 'ластик', 'степлер', 
-                          'скрепк', 'папка', 'файл', 'маркер', 'тетрадь', 'скотч', 'линейка'],
-            'Хозтовары': ['моющее', 'чистящ', 'мыло', 'дезинфицирующ', 'бельниц', 'гель', 
-                         'средство', 'порошок', 'жидкость', 'отбелива', 'пятновыводитель'],
-            'Офисная техника': ['принтер', 'сканер', 'мфу', 'картридж', 'тонер', 'копир', 'факс'],
-            'IT оборудование': ['компьютер', 'ноутбук', 'сервер', 'роутер', 'монитор', 'клавиатура', 'мышь'],
-            'Мебель': ['стол', 'кресло', 'стул', 'шкаф', 'мебель', 'диван', 'полка', 'стеллаж'],
-            'Строительные материалы': ['краска', 'лак', 'инструмент', 'строительн', 'кисть', 'валик', 'шпатель'],
-            'Бытовая химия': ['химия', 'освежитель', 'средство для', 'очиститель'],
-            'Уборочный инвентарь': ['швабра', 'ведро', 'совок', 'щетка', 'перчатк', 'инвентар', 'тряпк']
-        }
-        
-        # Проверяем название
-        for category, keywords in category_keywords.items():
-            if any(keyword in name_lower for keyword in keywords):
-                return category
-        
-        # Проверяем атрибуты
-        for category, keywords in category_keywords.items():
-            if any(keyword in attrs_str for keyword in keywords):
-                return category
-        
-        return 'Разное'
-
-    def _estimate_price(self, category, name):
-        """Оценивает цену товара"""
-        base_prices = {
-            'Канцелярия': 120,
-            'Хозтовары': 380,
-            'Офисная техника': 7500,
-            'IT оборудование': 12500,
-            'Мебель': 4500,
-            'Строительные материалы': 950,
-            'Бытовая химия': 280,
-            'Уборочный инвентарь': 650,
-            'Разное': 400
-        }
-        
-        price = base_prices.get(category, 400)
-        
-        # Корректировка на основе названия
-        name_lower = name.lower()
-        if any(word in name_lower for word in ['премиум', 'профессиональ', 'professional']):
-            price *= 1.5
-        elif any(word in name_lower for word in ['эконом', 'бюджет', 'стандарт']):
-            price *= 0.7
-        
-        # Корректировка на объем
-        volume = self._extract_volume_from_name(name)
-        if volume > 1000:
-            price *= 2.5
-        elif volume > 500:
-            price *= 1.8
-        elif volume > 0:
-            price *= (volume / 200)  # Нормализация
-        
-        return round(price, 2)
-
-    def _extract_volume_from_name(self, name):
-        """Извлекает объем из названия товара"""
-        name_lower = name.lower()
-        
-        volume_patterns = [
-            r'(\d+)\s*мл', r'(\d+)\s*л', r'(\d+)\s*г', r'(\d+)\s*кг',
-            r'(\d+)\s*ml', r'(\d+)\s*l', r'(\d+)\s*g', r'(\d+)\s*kg'
-        ]
-        
-        for pattern in volume_patterns:
-            matches = re.findall(pattern, name_lower)
-            if matches:
-                try:
-                    volume = float(matches[0])
-                    if 'кг' in name_lower or 'kg' in name_lower:
-                        volume *= 1000
-                    elif 'л' in name_lower or 'l' in name_lower:
-                        volume *= 1000
-                    return volume
-                except:
-                    continue
-        
-        return 0
-
-    def _generate_description(self, name, category, attributes):
-        """Генерирует описание для эмбеддингов"""
-        description_parts = [name, category]
-        
-        if attributes:
-            important_attrs = ['Назначение', 'Объем', 'Тип', 'Форма', 'Консистенция', 'Вид']
-            for attr in important_attrs:
-                if attr in attributes:
-                    description_parts.append(f"{attr}: {attributes[attr]}")
+            if available:
+                self.available_products.add(product_id)
+            
+            self.category_products[category].append(product_id)
+            successful_parses += 1
         
-        return ". ".join(description_parts)
+        print(f"✅ Успешно обработано: {successful_parses} товаров")
+        print(f"📊 Категории: {list(self.category_products.keys())}")
 
     def _build_similarity_models(self):
         """Строит модели схожести"""
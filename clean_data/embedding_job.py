@@ -0,0 +1,316 @@
+# embedding_job.py - Офлайн-кодирование каталога в кэш эмбеддингов bert_main и tiny: шарды по процессам, докачка после сбоя
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from py_back.embedding_cache import EmbeddingCache
+from py_back.encoder_backends import create_text_encoder
+from py_back.product_texts import canonical_text, embedding_model_key, embedding_text
+
+# Менять при любом изменении формата шардов
+JOB_VERSION = 3
+
+# Модель и параметры кодировщика - как у потребителя (BERTRecommendationConfig в py_back/bert_main.py):
+# ключ кэша содержит только модель и текст, векторы с другими параметрами смешались бы с его векторами
+DEFAULT_MODEL = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
+DEFAULT_DIM = 384
+DEFAULT_MAX_LENGTH = 128
+
+# Потребители кэша и их кодировщики. У каждого свой каталог кэша: max_length и normalize в ключ не входят
+CONSUMERS = {
+    'bert': {'model': DEFAULT_MODEL, 'dim': DEFAULT_DIM, 'max_length': DEFAULT_MAX_LENGTH, 'normalize': True,
+             'backend': os.environ.get('BERT_ENCODER_BACKEND', 'torch'),
+             'cache_dir': os.environ.get('BERT_EMBEDDING_CACHE_DIR', 'embedding_cache')},
+    # clean_data/tiny.py и tiny2.py: "название категория", rubert-tiny2 без нормализации
+    'tiny': {'model': 'cointegrated/rubert-tiny2', 'dim': 312, 'max_length': 64, 'normalize': False,
+             'backend': os.environ.get('ENCODER_BACKEND', 'torch'),
+             'cache_dir': os.environ.get('TINY_EMBEDDING_CACHE_DIR', 'tiny_embedding_cache')}
+}
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+_encoder = None  # модель воркера: загружается один раз на процесс
+
+
+def _init_worker(model_name, encoder_params, threads, next_slot):
+    """Инициализация воркера: закрепление потоков и ядер, загрузка модели"""
+    global _encoder
+
+    # OpenMP/MKL читают число потоков при загрузке torch, поэтому до create_text_encoder
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+
+    with next_slot.get_lock():
+        slot = next_slot.value
+        next_slot.value += 1
+    if hasattr(os, 'sched_setaffinity'):
+        # Каждому воркеру свои ядра - потоки соседних процессов не вытесняют друг друга
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cores[(slot * threads + i) % len(cores)] for i in range(threads)})
+
+    _encoder = create_text_encoder(model_name, intra_op_threads=threads, inter_op_threads=1, **encoder_params)
+
+
+def _shard_paths(shards_dir, index):
+    base = os.path.join(shards_dir, f'shard_{index:05d}')
+    return base + '.npy', base + '.keys.npy'
+
+
+def _save_array(path, array):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array, allow_pickle=False)
+    os.replace(tmp_path, path)
+
+
+def _shard_done(shards_dir, index, rows):
+    """Шард готов, если записаны оба файла нужной длины (векторы пишутся последними)"""
+    vectors_path, keys_path = _shard_paths(shards_dir, index)
+    if not (os.path.exists(vectors_path) and os.path.exists(keys_path)):
+        return False
+    try:
+        return len(np.load(vectors_path, mmap_mode='r')) == rows == len(np.load(keys_path, mmap_mode='r'))
+    except ValueError:
+        return False
+
+
+def encode_shard(index, keys, texts, shards_dir):
+    """Задача воркера: кодирование шарда и атомарная запись векторов и ключей кэша (файлы шарда = чекпоинт)"""
+    start = time.time()
+    tokens, padded = _encoder.stats['tokens'], _encoder.stats['padded_tokens']
+
+    vectors = _encoder.encode(texts)
+
+    vectors_path, keys_path = _shard_paths(shards_dir, index)
+    _save_array(keys_path, np.asarray(keys, dtype=str))
+    _save_array(vectors_path, np.ascontiguousarray(vectors, dtype=np.float32))
+    return {
+        'rows': len(texts),
+        'seconds': time.time() - start,
+        'tokens': _encoder.stats['tokens'] - tokens,
+        'padded_tokens': _encoder.stats['padded_tokens'] - padded
+    }
+
+
+def _append_shards(cache, shards_dir, shard_rows):
+    """Перенос готовых шардов в кэш по одному - весь массив в памяти не собирается"""
+    for index in range(len(shard_rows)):
+        vectors_path, keys_path = _shard_paths(shards_dir, index)
+        vectors = np.load(vectors_path, mmap_mode='r')
+        if vectors.shape[1] != cache.dim:
+            raise ValueError(f"Encoder dimension {vectors.shape[1]} differs from cache dimension {cache.dim}")
+        cache.append(np.load(keys_path).tolist(), vectors)
+
+
+def job_fingerprint(keys, model_name, backend, max_length, normalize):
+    digest = hashlib.sha1()
+    for key in keys:
+        digest.update(f"{key}\n".encode('utf-8'))
+    return f"embedding-job-v{JOB_VERSION}:{model_name}:{backend}:{max_length}:{int(normalize)}:{digest.hexdigest()}"
+
+
+def run_embedding_job(texts, cache_dir='embedding_cache', model_name=DEFAULT_MODEL, backend='torch',
+                      workers=None, threads_per_worker=None, shard_size=20000, dim=DEFAULT_DIM,
+                      max_length=DEFAULT_MAX_LENGTH, normalize=True, max_tokens_per_batch=8192):
+    """Кодирование текстов товаров в EmbeddingCache, из которого bert_main (или tiny) берет векторы при старте.
+
+    Ключи - те же, что у bert_main: make_key(модель, канонический текст),
+    кодируются только тексты, которых еще нет в кэше. Они режутся на шарды
+    по shard_size, шарды кодируются в пуле из workers процессов, у каждого
+    threads_per_worker потоков torch на своих ядрах. Каждый шард пишется
+    memory-mapped .npy с соседним .keys.npy; при перезапуске готовые шарды
+    пропускаются. После всех шардов векторы дописываются в кэш. Ключи всех
+    текстов закрепляются в кэше (pin): компакция потребителя, у которого
+    каталог меньше, их не удалит.
+    """
+    cache = EmbeddingCache(cache_dir, dim)
+    try:
+        model_key = embedding_model_key(model_name, backend)
+        texts_by_key = {}
+        for text in texts:
+            text = canonical_text(text)
+            texts_by_key.setdefault(EmbeddingCache.make_key(model_key, text), text)
+        # Закрепляем до записи, чтобы компакция потребителя не удалила только что дописанные векторы.
+        # Один набор на модель: повторный запуск заменяет его ключами текущего каталога
+        cache.pin(hashlib.sha1(model_key.encode('utf-8')).hexdigest()[:16], texts_by_key)
+        return _run_embedding_job(cache, texts_by_key, model_name, backend, workers, threads_per_worker,
+                                  shard_size, max_length, normalize, max_tokens_per_batch)
+    finally:
+        cache.close()
+
+
+def _run_embedding_job(cache, texts_by_key, model_name, backend, workers, threads_per_worker, shard_size, max_length,
+                       normalize, max_tokens_per_batch):
+    rows = cache.lookup(texts_by_key)
+    keys = [key for key, row in zip(texts_by_key, rows) if row < 0]
+    texts = [texts_by_key[key] for key in keys]
+    if not keys:
+        print(f"✅ Все {len(texts_by_key):,} текстов уже в кэше {cache.cache_dir}")
+        return 0
+
+    fingerprint = job_fingerprint(keys, model_name, backend, max_length, normalize)
+    shards_dir = os.path.join(cache.cache_dir, 'job_shards')
+    job_file = os.path.join(shards_dir, 'job.json')
+    job = {'fingerprint': fingerprint, 'shard_size': shard_size}
+    try:
+        with open(job_file, 'r', encoding='utf-8') as f:
+            resumable = json.load(f) == job
+    except (FileNotFoundError, json.JSONDecodeError):
+        resumable = False
+    if not resumable:
+        # Шарды от другого набора текстов, модели или размера шарда не годятся
+        shutil.rmtree(shards_dir, ignore_errors=True)
+        os.makedirs(shards_dir)
+        with open(job_file, 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    workers = workers or max(1, cpus // 2)
+    threads_per_worker = threads_per_worker or max(1, cpus // workers)
+
+    starts = list(range(0, len(keys), shard_size))
+    shard_rows = [min(shard_size, len(keys) - start) for start in starts]
+    todo = [index for index, rows in enumerate(shard_rows) if not _shard_done(shards_dir, index, rows)]
+
+    start_time = time.time()
+    failed = []
+    stats = {'done': 0, 'rows': 0, 'tokens': 0, 'padded_tokens': 0}
+    print(f"🚀 Кодирование {len(keys):,} новых текстов из {len(texts_by_key):,} ({model_name}, {backend}): "
+          f"{len(shard_rows)} шардов "
+          f"по {shard_size:,}, готово ранее: {len(shard_rows) - len(todo)}, "
+          f"{workers} процессов × {threads_per_worker} потоков")
+
+    def collect(done_futures):
+        for future in done_futures:
+            index = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                failed.append(index)
+                print(f"❌ Шард {index}: {e}")
+                continue
+            stats['done'] += 1
+            for key in ('rows', 'tokens', 'padded_tokens'):
+                stats[key] += result[key]
+            elapsed = time.time() - start_time
+            print(f"📦 Шард {index} готов за {result['seconds']:.0f} с: {stats['done']}/{len(todo)} шардов, "
+                  f"{stats['rows']:,} текстов ({stats['rows'] / max(elapsed, 1e-9):,.0f} текстов/с), "
+                  f"паддинг +{stats['padded_tokens'] / max(stats['tokens'], 1) - 1:.1%}")
+
+    pending = {}
+    if todo and backend == 'onnx':
+        # Экспорт ONNX один раз в родителе, иначе воркеры пишут один и тот же файл одновременно
+        create_text_encoder(model_name, backend, max_length=max_length, normalize=normalize)
+
+    if todo:
+        # spawn: воркер стартует без унаследованных потоков torch/OpenMP родителя
+        context = multiprocessing.get_context('spawn')
+        encoder_params = {'backend': backend, 'max_length': max_length, 'normalize': normalize,
+                          'max_tokens_per_batch': max_tokens_per_batch, 'device': 'cpu'}
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(model_name, encoder_params, threads_per_worker,
+                                           context.Value('i', 0))) as pool:
+            for index in todo:
+                start, end = starts[index], starts[index] + shard_rows[index]
+                pending[pool.submit(encode_shard, index, keys[start:end], texts[start:end], shards_dir)] = index
+                # Не держим в очереди тексты всего каталога
+                while len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+    if failed:
+        raise RuntimeError(f"Не закодированы шарды {sorted(failed)}; повторный запуск продолжит с них")
+
+    _append_shards(cache, shards_dir, shard_rows)
+    shutil.rmtree(shards_dir, ignore_errors=True)
+    print(f"✅ Эмбеддинги построены за {time.time() - start_time:.0f} с: {len(keys):,} текстов → {cache.cache_dir}")
+    return len(keys)
+
+
+async def catalog_texts(limit=None):
+    """Тексты товаров из БД - тот же отбор и текст, что в bert_main.DatabaseService.get_available_products.
+
+    limit=None - весь каталог: лишние для bert_main векторы закреплены и его компакцией не удаляются.
+    """
+    import asyncpg
+
+    from py_back.product_names import DB_CONFIG, dedup_key
+
+    query = """
+    SELECT p.name, p.description, c.name as category_name, p.manufacturer, p.unit_of_measure,
+           p.specifications, p.normalized_name, COALESCE(p.dedup_group_id, g.group_id) as dedup_group_id
+    FROM products p
+    LEFT JOIN categories c ON p.category_id = c.category_id
+    LEFT JOIN product_name_groups g ON p.dedup_group_id IS NULL AND g.normalized_name = normalize_product_name(p.name)
+    LEFT JOIN product_stats s ON s.product_id = p.product_id
+    WHERE p.is_available = true
+    AND p.average_price > 0
+    AND p.name IS NOT NULL
+    AND LENGTH(TRIM(p.name)) > 3
+    ORDER BY COALESCE(s.purchase_count, 0) DESC, p.average_price DESC
+    LIMIT $1
+    """
+    conn = await asyncpg.connect(**DB_CONFIG)
+    try:
+        texts, seen_groups = [], set()
+        async with conn.transaction():
+            async for row in conn.cursor(query, limit, prefetch=10000):
+                group = dedup_key(row)
+                if group not in seen_groups:
+                    seen_groups.add(group)
+                    texts.append(embedding_text(row))
+        return texts
+    finally:
+        await conn.close()
+
+
+def catalog_store_texts(catalog_dir='catalog_store'):
+    """Тексты товаров из каталога catalog_parser - тот же текст, что в tiny.py: "название категория" """
+    from clean_data.catalog_parser import load_catalog
+
+    catalog = load_catalog(catalog_dir)
+    categories = np.asarray(catalog['categories'], dtype=object)[np.asarray(catalog['category'])]
+    return [f"{name} {category}" for name, category in zip(catalog['name'], categories.tolist())]
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    from py_back.encoder_backends import ENCODER_BACKENDS
+
+    parser = argparse.ArgumentParser(description="Офлайн-кодирование каталога товаров в кэш эмбеддингов bert_main или tiny")
+    parser.add_argument('--consumer', default='bert', choices=sorted(CONSUMERS),
+                        help="bert - каталог из БД, tiny - каталог catalog_parser; задает модель и кодировщик")
+    parser.add_argument('--limit', type=int, default=None, help="товаров из БД (по умолчанию весь каталог)")
+    parser.add_argument('--catalog', default='catalog_store', help="каталог, построенный catalog_parser.py (для tiny)")
+    # Значения по умолчанию - от потребителя (каталог кэша и бэкенд - из тех же переменных окружения, что читает он)
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--model', default=None)
+    parser.add_argument('--backend', default=None, choices=ENCODER_BACKENDS)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=None, help="потоков torch на процесс")
+    parser.add_argument('--shard-size', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=None)
+    parser.add_argument('--max-length', type=int, default=None)
+    parser.add_argument('--max-tokens', type=int, default=8192, help="токенов (с паддингом) в батче")
+    args = parser.parse_args()
+
+    consumer = CONSUMERS[args.consumer]
+    if args.consumer == 'bert':
+        texts = asyncio.run(catalog_texts(args.limit))
+    else:
+        texts = catalog_store_texts(args.catalog)
+    run_embedding_job(texts, args.cache_dir or consumer['cache_dir'], model_name=args.model or consumer['model'],
+                      backend=args.backend or consumer['backend'], workers=args.workers, threads_per_worker=args.threads,
+                      shard_size=args.shard_size, dim=args.dim or consumer['dim'],
+                      max_length=args.max_length or consumer['max_length'], normalize=consumer['normalize'],
+                      max_tokens_per_batch=args.max_tokens)
@@ -5,6 +5,7 @@ from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.preprocessing import normalize
 import re
+import heapq
 from collections import defaultdict, Counter
 import warnings
 warnings.filterwarnings('ignore')
@@ -15,6 +16,8 @@ class ProcurementConfig:
     TFIDF_NGRAM_RANGE = (1, 2)
     TFIDF_MAX_FEATURES = 1000
     
+    SIMILAR_BATCH_SIZE = 256  # строк матрицы схожести на одну пачку в пакетном поиске соседей
+    
     PRICE_ESTIMATES = {
         'канцелярия': 1000,
         'хозтовары': 2000,
@@ -240,6 +243,11 @@ class ProcurementRecommender:
             self.similarity_matrix = cosine_similarity(tfidf_matrix_normalized)
             self.product_to_index = {pid: idx for idx, pid in enumerate(self.product_ids)}
             
+            # Коды названий для отсечения дубликатов среди соседей
+            _, self.product_name_codes = np.unique(
+                [self.product_catalog_info[pid]['name'] for pid in self.product_ids], return_inverse=True
+            )
+            
             print(f"Built similarity matrix for {len(self.product_ids)} products")
 
     def get_product_info(self, product_id):
@@ -295,40 +303,63 @@ class ProcurementRecommender:
 
     def get_similar_products(self, target_product_id, top_n=5):
         """Находит РАЗНЫЕ похожие товары"""
-        if target_product_id not in self.product_to_index:
-            return []
-        
-        target_idx = self.product_to_index[target_product_id]
-        similarities = self.similarity_matrix[target_idx]
-        
-        similar_indices = np.argsort(similarities)[::-1][1:top_n*2]  # Берем больше для фильтрации
-        
-        similar_products = []
-        seen_names = set()
-        
-        for idx in similar_indices:
-            similar_product_id = self.product_ids[idx]
-            if similar_product_id in self.available_products:
+        return self.get_similar_products_batch([target_product_id], top_n).get(target_product_id, [])
+
+    def get_similar_products_batch(self, target_product_ids, top_n=5):
+        """Похожие товары сразу для многих исходных: {product_id: [похожие]}.
+        
+        Для каждого исходного товара берутся 2 * top_n - 1 ближайших соседей (без него самого,
+        при равной схожести - сначала больший индекс), из них доступные товары с разными
+        названиями - не больше top_n. Строки матрицы обрабатываются пачками через argpartition,
+        без полной сортировки строки на каждый товар.
+        """
+        targets = [pid for pid in dict.fromkeys(target_product_ids) if pid in self.product_to_index]
+        results = {pid: [] for pid in targets}
+        window = min(top_n * 2 - 1, len(self.product_ids) - 1)
+        if not targets or window <= 0:
+            return results
+        
+        available = np.fromiter((pid in self.available_products for pid in self.product_ids),
+                                dtype=bool, count=len(self.product_ids))
+        name_count = int(self.product_name_codes.max()) + 1
+        batch_size = self.config.SIMILAR_BATCH_SIZE
+        
+        for start in range(0, len(targets), batch_size):
+            batch = targets[start:start + batch_size]
+            sources = np.array([self.product_to_index[pid] for pid in batch])
+            similarities = self.similarity_matrix[sources].astype(np.float64)
+            similarities[np.arange(len(batch)), sources] = -np.inf
+            
+            # Порог - window-я по величине схожесть строки; берем все не ниже него, чтобы равные на границе не терялись
+            thresholds = -np.partition(-similarities, window - 1, axis=1)[:, window - 1]
+            source_pos, candidates = np.nonzero(similarities >= thresholds[:, None])
+            scores = similarities[source_pos, candidates]
+            
+            order = np.lexsort((-candidates, -scores, source_pos))
+            source_pos, candidates, scores = source_pos[order], candidates[order], scores[order]
+            in_window = np.arange(len(order)) - np.searchsorted(source_pos, source_pos) < window
+            
+            # Доступные, первое вхождение каждого названия внутри исходного товара
+            keep = in_window & available[candidates]
+            source_pos, candidates, scores = source_pos[keep], candidates[keep], scores[keep]
+            _, first = np.unique(source_pos * name_count + self.product_name_codes[candidates], return_index=True)
+            first = np.sort(first)
+            source_pos, candidates, scores = source_pos[first], candidates[first], scores[first]
+            top = np.arange(len(first)) - np.searchsorted(source_pos, source_pos) < top_n
+            
+            reasons = {pid: f'Похож на "{self.get_product_info(pid)["name"]}"' for pid in batch}
+            for position, candidate, score in zip(source_pos[top], candidates[top], scores[top]):
+                similar_product_id = self.product_ids[candidate]
                 product_info = self.get_product_info(similar_product_id)
-                similarity_score = similarities[idx]
-                
-                # Пропускаем товары с одинаковыми названиями
-                if product_info['name'] not in seen_names:
-                    seen_names.add(product_info['name'])
-                    
-                    similar_products.append({
-                        'product_id': similar_product_id,
-                        'product_name': product_info['name'],
-                        'product_category': product_info['category'],
-                        'similarity_score': round(similarity_score, 4),
-                        'reason': f'Похож на "{self.get_product_info(target_product_id)["name"]}"'
-                    })
-                
-                # Останавливаемся когда набрали нужное количество РАЗНЫХ товаров
-                if len(similar_products) >= top_n:
-                    break
-        
-        return similar_products
+                results[batch[position]].append({
+                    'product_id': similar_product_id,
+                    'product_name': product_info['name'],
+                    'product_category': product_info['category'],
+                    'similarity_score': round(score, 4),
+                    'reason': reasons[batch[position]]
+                })
+        
+        return results
 
     def get_recommendations(self, user_id, top_n=15):
         """Улучшенные рекомендации с разнообразием"""
@@ -340,10 +371,11 @@ class ProcurementRecommender:
         
         recommendations = []
         
-        # 1. Рекомендации на основе похожих товаров к купленным
+        # 1. Рекомендации на основе похожих товаров к купленным (соседи всей истории одним пакетом)
+        similar_by_product = self.get_similar_products_batch(user_profile['purchased_products'], top_n=3)
         for purchased_product in user_profile['purchased_products']:
-            if purchased_product in self.product_to_index:
-                similar_products = self.get_similar_products(purchased_product, top_n=3)
+            if purchased_product in similar_by_product:
+                similar_products = similar_by_product[purchased_product]
                 
                 for similar in similar_products:
                     if (similar['product_id'] not in user_products and 
@@ -403,10 +435,8 @@ class ProcurementRecommender:
                 existing = unique_recommendations[name_key]
                 existing['total_score'] = max(existing['total_score'], rec['total_score'])
         
-        final_recommendations = sorted(unique_recommendations.values(), 
-                                     key=lambda x: x['total_score'], reverse=True)
-        
-        return final_recommendations[:top_n]
+        # nlargest равносилен sorted(..., reverse=True)[:top_n], но без сортировки всех кандидатов
+        return heapq.nlargest(top_n, unique_recommendations.values(), key=lambda x: x['total_score'])
 
     def _generate_recommendation_reason(self, product_category, user_categories, frequency):
         if product_category in user_categories:
@@ -6,7 +6,6 @@ import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader
 from transformers import (
     AutoTokenizer, 
-    AutoModel, 
     AdamW, 
     get_linear_schedule_with_warmup
 )
@@ -14,12 +13,22 @@ from sklearn.preprocessing import LabelEncoder
 import re
 from collections import defaultdict, Counter
 import warnings
+import os
+
+from py_back.embedding_cache import EmbeddingCache
+from py_back.encoder_backends import create_text_encoder
+from py_back.product_texts import canonical_text, embedding_model_key
 warnings.filterwarnings('ignore')
 
 class ProcurementConfig:
     BERT_MODEL_NAME = 'cointegrated/rubert-tiny2'
     MAX_SEQUENCE_LENGTH = 128
     BATCH_SIZE = 16
+    ENCODER_BACKEND = os.environ.get('ENCODER_BACKEND', 'torch')  # torch | torch_int8 | onnx
+    ENCODER_THREADS = int(os.environ['ENCODER_THREADS']) if os.environ.get('ENCODER_THREADS') else None
+    # Кэш эмбеддингов, который заполняет clean_data/embedding_job.py --consumer tiny; пусто - кодировать здесь
+    EMBEDDING_CACHE_DIR = os.environ.get('TINY_EMBEDDING_CACHE_DIR', 'tiny_embedding_cache')
+    EMBEDDING_DIM = 312
     EPOCHS = 10
     LEARNING_RATE = 2e-5
     HIDDEN_DROPOUT_PROB = 0.3
@@ -308,41 +317,52 @@ class AdvancedProcurementRecommender:
             product_descriptions[product_id] = description
         
         self.product_embeddings = {}
-        
-        # Используем чистый BERT для эмбеддингов
-        bert_model = AutoModel.from_pretrained(self.config.BERT_MODEL_NAME).to(self.device)
-        bert_model.eval()
-        
-        batch_size = 16
         product_ids = list(product_descriptions.keys())
         
-        print(f"Generating embeddings for {len(product_ids)} products...")
-        
-        for i in range(0, len(product_ids), batch_size):
-            batch_ids = product_ids[i:i+batch_size]
-            batch_descriptions = [product_descriptions[pid] for pid in batch_ids]
-            
-            inputs = self.tokenizer(
-                batch_descriptions,
-                padding=True,
-                truncation=True,
+        cache = None
+        if self.config.EMBEDDING_CACHE_DIR:
+            # Ключ кэша - модель и текст, как у embedding_job.py: берем готовые векторы, кодируем только новые
+            cache = EmbeddingCache(self.config.EMBEDDING_CACHE_DIR, self.config.EMBEDDING_DIM)
+            model_key = embedding_model_key(self.config.BERT_MODEL_NAME, self.config.ENCODER_BACKEND)
+            cache_keys = {pid: EmbeddingCache.make_key(model_key, canonical_text(product_descriptions[pid]))
+                          for pid in product_ids}
+            rows = cache.lookup(cache_keys[pid] for pid in product_ids)
+            vectors = cache.vectors()
+            for product_id, row in zip(product_ids, rows):
+                if row >= 0:
+                    self.product_embeddings[product_id] = np.array(vectors[row])
+            product_ids = [pid for pid, row in zip(product_ids, rows) if row < 0]
+            print(f"Loaded {len(self.product_embeddings)} cached embeddings from {self.config.EMBEDDING_CACHE_DIR}")
+        
+        if product_ids:
+            # Чистый BERT с mean pooling по маске; батчи собираются по длине в токенах
+            encoder = create_text_encoder(
+                self.config.BERT_MODEL_NAME,
+                backend=self.config.ENCODER_BACKEND,
                 max_length=64,
-                return_tensors='pt'
-            ).to(self.device)
+                normalize=False,
+                intra_op_threads=self.config.ENCODER_THREADS
+            )
             
-            with torch.no_grad():
-                outputs = bert_model(**inputs)
-                embeddings = outputs.last_hidden_state.mean(dim=1).cpu().numpy()
+            print(f"Generating embeddings for {len(product_ids)} products...")
             
-            for j, product_id in enumerate(batch_ids):
-                self.product_embeddings[product_id] = embeddings[j]
+            chunk_size = 1024
+            for i in range(0, len(product_ids), chunk_size):
+                batch_ids = product_ids[i:i + chunk_size]
+                embeddings = encoder.encode([product_descriptions[pid] for pid in batch_ids])
+                
+                for j, product_id in enumerate(batch_ids):
+                    self.product_embeddings[product_id] = embeddings[j]
+                if cache is not None:
+                    cache.append([cache_keys[pid] for pid in batch_ids], embeddings)
+                
+                print(f"Processed {min(i + chunk_size, len(product_ids))}/{len(product_ids)} products")
             
-            if (i // batch_size) % 10 == 0:
-                print(f"Processed {min(i + batch_size, len(product_ids))}/{len(product_ids)} products")
+            del encoder
+            torch.cuda.empty_cache() if torch.cuda.is_available() else None
         
-        bert_model.cpu()
-        del bert_model
-        torch.cuda.empty_cache() if torch.cuda.is_available() else None
+        if cache is not None:
+            cache.close()
         
         print(f"Created embeddings for {len(self.product_embeddings)} products")
     
@@ -1,6 +1,6 @@
 /* eslint-disable no-undef */
 /* eslint-disable no-unused-vars */
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import './App.css';
 import './Body.css';
 import './Header.css';
@@ -11,7 +11,7 @@ import UserProfile from './modal/UserProfile';
 import CreateProcurement from './modal/CreateProcurement';
 import RecommendationsPanel from './modal/RecommendationsPanel';
 import FavoritesTab from './modal/FavoritesTab';
-import { authAPI, productsAPI, procurementsAPI } from './services/api';
+import { authAPI, productsAPI, procurementsAPI, searchAPI } from './services/api';
 import { generateProductImage, getCategoryColor } from './utils/productImages';
 
 
@@ -27,6 +27,8 @@ function App() {
   const [searchQuery, setSearchQuery] = useState('');
   const [searchResults, setSearchResults] = useState({ products: [], procurements: [] });
   const [isSearching, setIsSearching] = useState(false);
+  const latestSearchQuery = useRef('');
+  const semanticSearchTimer = useRef(null);
   const [selectedProducts, setSelectedProducts] = useState([]);
   const [procurementCreationStep, setProcurementCreationStep] = useState(1);
   const [activeSection, setActiveSection] = useState('products');
@@ -450,40 +452,74 @@ const handleClearSavedProcurementData = () => {
 
   // Функции поиска
   const handleSearch = async (query) => {
+    latestSearchQuery.current = query;
+    clearTimeout(semanticSearchTimer.current);
+
     if (!query.trim()) {
       setSearchResults({ products: [], procurements: [] });
+      setIsSearching(false);
       return;
     }
 
-    setIsSearching(true);
-    
+    // Мгновенный поиск по ключевым словам; он же остается, если ML сервис недоступен
+    const searchLower = query.toLowerCase().trim();
+
+    const foundProducts = products.filter(product => 
+      product.name.toLowerCase().includes(searchLower) ||
+      product.category_name?.toLowerCase().includes(searchLower) ||
+      product.company?.toLowerCase().includes(searchLower) ||
+      product.description?.toLowerCase().includes(searchLower)
+    );
+
+    const foundProcurements = procurements.filter(procurement =>
+      procurement.title.toLowerCase().includes(searchLower) ||
+      procurement.description?.toLowerCase().includes(searchLower) ||
+      procurement.customer_name?.toLowerCase().includes(searchLower) ||
+      procurement.session_number?.toLowerCase().includes(searchLower)
+    );
+
+    setSearchResults({
+      products: foundProducts,
+      procurements: foundProcurements
+    });
+
+    // Товары по описанию потребности - семантическим поиском, после паузы в наборе
+    if (searchLower.length >= 3) {
+      setIsSearching(true);
+      semanticSearchTimer.current = setTimeout(() => handleSemanticSearch(query), 300);
+    } else {
+      setIsSearching(false);
+    }
+  };
+
+  const handleSemanticSearch = async (query) => {
     try {
-      const searchLower = query.toLowerCase().trim();
-      
-      const foundProducts = products.filter(product => 
-        product.name.toLowerCase().includes(searchLower) ||
-        product.category_name?.toLowerCase().includes(searchLower) ||
-        product.company?.toLowerCase().includes(searchLower) ||
-        product.description?.toLowerCase().includes(searchLower)
-      );
+      const response = await searchAPI.semanticSearch(query, 50);
+      if (latestSearchQuery.current !== query) {
+        return;
+      }
 
-      const foundProcurements = procurements.filter(procurement =>
-        procurement.title.toLowerCase().includes(searchLower) ||
-        procurement.description?.toLowerCase().includes(searchLower) ||
-        procurement.customer_name?.toLowerCase().includes(searchLower) ||
-        procurement.session_number?.toLowerCase().includes(searchLower)
+      const productsById = new Map(products.map(product => [String(product.id), product]));
+      const foundProducts = (response.results || []).map(result =>
+        productsById.get(String(result.product_id)) || {
+          id: result.product_id,
+          name: result.product_name,
+          category_name: result.product_category,
+          price_per_item: result.average_price,
+          company: result.manufacturer
+        }
       );
 
-      setSearchResults({
-        products: foundProducts,
-        procurements: foundProcurements
-      });
-      
+      if (foundProducts.length > 0) {
+        setSearchResults(prev => ({ ...prev, products: foundProducts }));
+      }
     } catch (error) {
-      console.error('Search error:', error);
-      setSearchResults({ products: [], procurements: [] });
+      // Индекс еще строится или сервис недоступен - остаются результаты по ключевым словам
+      console.warn('Semantic search unavailable, using keyword search:', error.message);
     } finally {
-      setIsSearching(false);
+      if (latestSearchQuery.current === query) {
+        setIsSearching(false);
+      }
     }
   };
 
@@ -493,7 +529,10 @@ const handleClearSavedProcurementData = () => {
   };
 
   const clearSearch = () => {
+    latestSearchQuery.current = '';
+    clearTimeout(semanticSearchTimer.current);
     setSearchQuery('');
+    setIsSearching(false);
     setSearchResults({ products: [], procurements: [] });
   };
 
@@ -86,6 +86,21 @@ export const searchAPI = {
     return apiRequest(`/search/smart?${params.toString()}`);
   },
 
+  // Семантический поиск по описанию потребности (ML сервис)
+  async semanticSearch(query, limit = 20) {
+    const response = await fetch('/api/ml/search', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ query, limit })
+    });
+
+    if (!response.ok) {
+      throw new Error(`HTTP ${response.status}: ${response.statusText}`);
+    }
+
+    return response.json();
+  },
+
   // Автодополнение
   async autocomplete(query, limit = 10) {
     const params = new URLSearchParams();
@@ -0,0 +1 @@
+# Сервисы рекомендаций (запускаются из py_back); офлайн-скрипты импортируют модули как py_back.<модуль>
@@ -0,0 +1,273 @@
+# attribute_store.py - Характеристики товаров (specifications) в колоночном виде с инвертированным индексом
+import json
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+# Единица -> (измерение, множитель к базовой единице измерения)
+UNITS = {
+    'мл': ('volume', 1.0), 'ml': ('volume', 1.0), 'л': ('volume', 1000.0), 'l': ('volume', 1000.0),
+    'мг': ('mass', 0.001), 'mg': ('mass', 0.001), 'г': ('mass', 1.0), 'гр': ('mass', 1.0), 'g': ('mass', 1.0),
+    'кг': ('mass', 1000.0), 'kg': ('mass', 1000.0),
+    'мм': ('length', 1.0), 'mm': ('length', 1.0), 'см': ('length', 10.0), 'cm': ('length', 10.0),
+    'м': ('length', 1000.0), 'm': ('length', 1000.0),
+    'шт': ('count', 1.0), 'штук': ('count', 1.0), 'pcs': ('count', 1.0),
+    'лист': ('sheets', 1.0), 'листов': ('sheets', 1.0),
+    'вт': ('power', 1.0), 'w': ('power', 1.0), 'квт': ('power', 1000.0), 'kw': ('power', 1000.0),
+    'мб': ('data', 1.0), 'mb': ('data', 1.0), 'гб': ('data', 1024.0), 'gb': ('data', 1024.0),
+    'тб': ('data', 1024.0 ** 2), 'tb': ('data', 1024.0 ** 2),
+    '%': ('percent', 1.0)
+}
+# Код измерения в колонке; 'number' - число без единицы
+DIMENSIONS = ['number'] + sorted({dimension for dimension, _ in UNITS.values()})
+
+_NUMBER_WITH_UNIT = re.compile(r'^(-?\d+(?:[.,]\d+)?)\s*([a-zа-яё%]+\.?)?$')
+_TEXT_PAIR = re.compile(r'"?([^":,{}]+)"?\s*:\s*"?([^",{}]*)"?')
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_value(value: Any) -> str:
+    return _SPACES.sub(' ', str(value)).strip().lower()
+
+
+def parse_quantity(value: Any) -> Tuple[float, int]:
+    """Значение -> (число в базовой единице, код измерения); (nan, -1) - не число"""
+    if isinstance(value, bool):
+        return np.nan, -1
+    if isinstance(value, (int, float)):
+        return float(value), 0
+
+    match = _NUMBER_WITH_UNIT.match(normalize_value(value))
+    if not match:
+        return np.nan, -1
+    number = float(match.group(1).replace(',', '.'))
+    unit = match.group(2)
+    if not unit:
+        return number, 0
+    known = UNITS.get(unit) or UNITS.get(unit.rstrip('.'))
+    if known is None:
+        return np.nan, -1
+    dimension, scale = known
+    return number * scale, DIMENSIONS.index(dimension)
+
+
+def parse_specifications(specifications: Any) -> List[Tuple[str, Any]]:
+    """specifications (JSON-объект, список {name, value} или текст "ключ: значение") -> пары (ключ, значение)"""
+    if specifications is None:
+        return []
+    if isinstance(specifications, str):
+        try:
+            specifications = json.loads(specifications)
+        except ValueError:
+            return [(key.strip(), value.strip()) for key, value in _TEXT_PAIR.findall(specifications) if value.strip()]
+
+    if isinstance(specifications, dict):
+        items = specifications.items()
+    elif isinstance(specifications, list):
+        items = [(item.get('name', item.get('key')), item.get('value'))
+                 for item in specifications if isinstance(item, dict)]
+    else:
+        return []
+
+    pairs = []
+    for key, value in items:
+        if key is None or value is None:
+            continue
+        # Несколько значений одной характеристики - отдельные пары
+        for item in value if isinstance(value, list) else [value]:
+            if item is not None and not isinstance(item, (dict, list)) and str(item).strip():
+                pairs.append((str(key).strip(), item))
+    return pairs
+
+
+class AttributeStore:
+    """Характеристики каталога, разобранные один раз.
+
+    Ключи и значения закодированы словарями, каждая пара (товар, ключ, значение) -
+    строка колонок entry_*. Строки отсортированы по (ключ, значение), поэтому
+    список товаров для пары - непрерывный срез (инвертированный индекс), а все
+    значения ключа - срез key_indptr. Числовые значения хранятся приведенными
+    к базовой единице своего измерения (мл, г, мм, ...).
+    """
+
+    def __init__(self, n_products: int = 0):
+        self.n_products = n_products
+        self.keys: List[str] = []
+        self.key_to_code: Dict[str, int] = {}
+        self.values: List[str] = []
+        self.value_to_code: Dict[str, int] = {}
+        self.entry_rows = np.zeros(0, dtype=np.int32)
+        self.entry_keys = np.zeros(0, dtype=np.int32)
+        self.entry_values = np.zeros(0, dtype=np.int32)
+        self.entry_numbers = np.zeros(0, dtype=np.float64)
+        self.entry_dimensions = np.zeros(0, dtype=np.int8)
+        self.pair_codes = np.zeros(0, dtype=np.int64)
+        self.key_indptr = np.zeros(1, dtype=np.int64)
+        self.pair_matrix = None
+
+    def __len__(self) -> int:
+        return len(self.entry_rows)
+
+    @classmethod
+    def build(cls, specifications: Iterable[Any]) -> 'AttributeStore':
+        """specifications - по одному значению на строку каталога (в порядке строк)"""
+        store = cls()
+        rows, keys, values = [], [], []
+        value_numbers, value_dimensions = [], []
+
+        n_products = 0
+        for row, spec in enumerate(specifications):
+            n_products = row + 1
+            for key, value in parse_specifications(spec):
+                key_code = store.key_to_code.setdefault(key.lower(), len(store.key_to_code))
+                if key_code == len(store.keys):
+                    store.keys.append(key)
+
+                normalized = normalize_value(value)
+                value_code = store.value_to_code.get(normalized)
+                if value_code is None:
+                    # Число и единица разбираются один раз на уникальное значение
+                    value_code = store.value_to_code[normalized] = len(store.values)
+                    store.values.append(normalized)
+                    number, dimension = parse_quantity(value)
+                    value_numbers.append(number)
+                    value_dimensions.append(dimension)
+
+                rows.append(row)
+                keys.append(key_code)
+                values.append(value_code)
+
+        store.n_products = n_products
+        rows = np.array(rows, dtype=np.int32)
+        keys = np.array(keys, dtype=np.int32)
+        values = np.array(values, dtype=np.int32)
+        pair_codes = keys.astype(np.int64) * max(len(store.values), 1) + values
+
+        order = np.lexsort((rows, pair_codes))
+        store.entry_rows = rows[order]
+        store.entry_keys = keys[order]
+        store.entry_values = values[order]
+        store.pair_codes = pair_codes[order]
+        store.entry_numbers = np.array(value_numbers, dtype=np.float64)[store.entry_values] if len(values) else np.zeros(0)
+        store.entry_dimensions = np.array(value_dimensions, dtype=np.int8)[store.entry_values] if len(values) else np.zeros(0, dtype=np.int8)
+        store.key_indptr = np.searchsorted(store.entry_keys, np.arange(len(store.keys) + 1)).astype(np.int64)
+        store._build_pair_matrix()
+        return store
+
+    def _build_pair_matrix(self):
+        # Товары × уникальные пары (ключ, значение), строки L2-нормированы: косинус - скалярное произведение
+        unique_pairs, pair_index = np.unique(self.pair_codes, return_inverse=True)
+        matrix = sparse.csr_matrix(
+            (np.ones(len(self.entry_rows)), (self.entry_rows, pair_index)),
+            shape=(self.n_products, len(unique_pairs))
+        )
+        matrix.data[:] = 1.0  # повтор одной пары у товара не усиливает ее
+        self.pair_matrix = normalize(matrix, norm='l2', axis=1).tocsr() if len(unique_pairs) else matrix
+
+    def _key_slice(self, key: str) -> Optional[slice]:
+        key_code = self.key_to_code.get(key.strip().lower())
+        if key_code is None:
+            return None
+        return slice(self.key_indptr[key_code], self.key_indptr[key_code + 1])
+
+    def rows_with(self, key: str, value: Any = None) -> np.ndarray:
+        """Строки каталога с характеристикой key (и значением value) - срез инвертированного индекса"""
+        entries = self._key_slice(key)
+        if entries is None:
+            return np.zeros(0, dtype=np.int32)
+        if value is None:
+            return np.unique(self.entry_rows[entries])
+
+        value_code = self.value_to_code.get(normalize_value(value))
+        if value_code is None:
+            return np.zeros(0, dtype=np.int32)
+        pair = self.key_to_code[key.strip().lower()] * max(len(self.values), 1) + value_code
+        start, end = np.searchsorted(self.pair_codes, [pair, pair + 1])
+        return self.entry_rows[start:end]
+
+    def rows_in_range(self, key: str, low: Optional[float] = None, high: Optional[float] = None,
+                      unit: Optional[str] = None) -> np.ndarray:
+        """Строки с числовым значением key в [low, high]; low/high в единицах unit (по умолчанию базовых)"""
+        entries = self._key_slice(key)
+        if entries is None:
+            return np.zeros(0, dtype=np.int32)
+
+        numbers = self.entry_numbers[entries]
+        dimensions = self.entry_dimensions[entries]
+        if unit:
+            if unit.lower() not in UNITS:
+                raise ValueError(f"Unknown unit: {unit}")
+            dimension, scale = UNITS[unit.lower()]
+            matched = dimensions == DIMENSIONS.index(dimension)
+        else:
+            scale = 1.0
+            matched = dimensions >= 0
+        if low is not None:
+            matched &= numbers >= low * scale
+        if high is not None:
+            matched &= numbers <= high * scale
+        return np.unique(self.entry_rows[entries][matched])
+
+    def match(self, rows: np.ndarray, filters: Dict[str, Any]) -> np.ndarray:
+        """Маска строк rows, подходящих под все фильтры.
+
+        Значение фильтра: строка/число - равенство, список - любое из значений,
+        {"min", "max", "unit"} - числовой диапазон, None - характеристика задана.
+        """
+        mask = np.ones(self.n_products, dtype=bool)
+        for key, condition in filters.items():
+            if isinstance(condition, dict):
+                matched = self.rows_in_range(key, condition.get('min'), condition.get('max'), condition.get('unit'))
+            elif isinstance(condition, list):
+                matched = np.concatenate([self.rows_with(key, value) for value in condition]) if condition else []
+            else:
+                matched = self.rows_with(key, condition)
+            key_mask = np.zeros(self.n_products, dtype=bool)
+            key_mask[matched] = True
+            mask &= key_mask
+        return mask[rows]
+
+    def numeric_column(self, key: str, unit: Optional[str] = None) -> np.ndarray:
+        """Плотная колонка чисел key по каталогу (nan - нет значения или другое измерение)"""
+        column = np.full(self.n_products, np.nan)
+        entries = self._key_slice(key)
+        if entries is None:
+            return column
+
+        numbers = self.entry_numbers[entries]
+        dimensions = self.entry_dimensions[entries]
+        matched = dimensions >= 0
+        scale = 1.0
+        if unit:
+            dimension, scale = UNITS[unit.lower()]
+            matched = dimensions == DIMENSIONS.index(dimension)
+        column[self.entry_rows[entries][matched]] = numbers[matched] / scale
+        return column
+
+    def categorical_column(self, key: str) -> np.ndarray:
+        """Плотная колонка кодов значений key (индексы в self.values, -1 - нет значения)"""
+        column = np.full(self.n_products, -1, dtype=np.int32)
+        entries = self._key_slice(key)
+        if entries is not None:
+            column[self.entry_rows[entries]] = self.entry_values[entries]
+        return column
+
+    def value_counts(self, key: str, top: int = 20) -> List[Tuple[str, int]]:
+        """Самые частые значения характеристики (для фасетов)"""
+        entries = self._key_slice(key)
+        if entries is None:
+            return []
+        codes, counts = np.unique(self.entry_values[entries], return_counts=True)
+        order = np.argsort(-counts, kind='stable')[:top]
+        return [(self.values[codes[i]], int(counts[i])) for i in order]
+
+    def similarity(self, source_rows: List[int], chunk_size: int = 32) -> np.ndarray:
+        """Максимальная доля общих пар (ключ, значение) каждого товара каталога с товарами source_rows"""
+        similarity = np.zeros(self.n_products)
+        for start in range(0, len(source_rows), chunk_size):
+            chunk = self.pair_matrix[source_rows[start:start + chunk_size]]
+            np.maximum(similarity, (chunk @ self.pair_matrix.T).max(axis=0).toarray().ravel(), out=similarity)
+        return similarity
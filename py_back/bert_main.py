@@ -1,23 +1,35 @@
 # main_bert.py - Production-ready система с BERT эмбеддингами
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Iterator, Tuple
 import asyncpg
 import os
 from datetime import datetime
 import logging
 from collections import defaultdict, Counter
 import math
-import re
 import numpy as np
 from sklearn.preprocessing import normalize
 import time
 import asyncio
+import hashlib
+import tempfile
+
+from shared_arrays import SharedArrayStore
+from embedding_cache import EmbeddingCache
+from vector_index import VectorIndex, create_vector_index, _top_k
+from quantized_store import QuantizedEmbeddingStore
+from query_encoder import MicroBatchEncoder
+from candidate_cache import CandidateCache
+from product_names import normalize_product_name, dedup_key
+from implicit_als import ImplicitALS
+from weighted_stats import weighted_centroid
+from product_texts import embedding_text, canonical_text, embedding_model_key
 
 # BERT эмбеддинги
-from sentence_transformers import SentenceTransformer
-import torch
+from encoder_backends import create_text_encoder
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -51,6 +63,16 @@ class RecommendationResponse(BaseModel):
     processing_time: float
     generated_at: str
 
+class SearchRequest(BaseModel):
+    query: str
+    limit: int = 20
+
+class SearchResponse(BaseModel):
+    query: str
+    results_count: int
+    results: List[Dict]
+    processing_time: float
+
 class BundleResponse(BaseModel):
     user_id: str
     bundle_size: int
@@ -89,6 +111,59 @@ class BERTRecommendationConfig:
         'mid': (3000, 10000), 
         'premium': (10000, float('inf'))
     }
+    
+    CATALOG_LIMIT = int(os.environ.get('BERT_CATALOG_LIMIT', 12000))
+    
+    # Персистентный кэш эмбеддингов: при рестарте кодируются только новые тексты
+    EMBEDDING_CACHE_DIR = os.environ.get('BERT_EMBEDDING_CACHE_DIR', 'embedding_cache')
+    EMBEDDING_CACHE_COMPACT_RATIO = 2.0  # компакция, если в кэше в 2 раза больше строк, чем в каталоге
+    
+    # Индекс ближайших соседей для отбора семантических кандидатов (exact | ivfpq)
+    VECTOR_INDEX = {
+        'backend': os.environ.get('BERT_VECTOR_INDEX', 'exact'),
+        'path': os.environ.get('BERT_VECTOR_INDEX_PATH'),
+        'params': {},
+        'candidates': 300
+    }
+    
+    # Хранение эмбеддингов в RAM: float32 | float16 | int8 | pq (точные векторы уходят в memmap)
+    EMBEDDING_STORAGE = os.environ.get('BERT_EMBEDDING_STORAGE', 'float32')
+    QUANTIZATION = {
+        'rerank': 300,           # сколько кандидатов переранжировать по точным векторам
+        'quality_queries': 20,   # запросов для замера качества при построении
+        'min_recall': 0.95       # допустимое снижение recall@15 относительно точного поиска
+    }
+    
+    # Свободный поиск: микро-батчинг конкурентных запросов и LRU-кэш векторов запросов
+    QUERY_ENCODER = {
+        'max_batch_size': int(os.environ.get('BERT_QUERY_MAX_BATCH', 32)),
+        'max_wait_ms': float(os.environ.get('BERT_QUERY_MAX_WAIT_MS', 5)),
+        'cache_size': 10000
+    }
+    SEARCH_MAX_LIMIT = 100
+    
+    # Пул скоринга пользователя переиспользуется рекомендациями и наборами в течение TTL
+    CANDIDATE_CACHE = {'ttl': 60.0, 'max_users': 1000}
+    
+    # Факторы implicit ALS (обучаются офлайн: python implicit_als.py --output <dir>), None - компонент выключен
+    MATRIX_FACTORIZATION = {
+        'model_dir': os.environ.get('BERT_ALS_DIR', os.environ.get('RECS_ALS_DIR')),
+        'weight': 0.15  # доля в итоговом скоре, если у пользователя есть вектор
+    }
+    
+    # Бэкенд инференса: torch | torch_int8 | onnx (бенчмарк: python encoder_backends.py)
+    ENCODER = {
+        'backend': os.environ.get('BERT_ENCODER_BACKEND', 'torch'),
+        'max_length': 128,
+        'max_tokens_per_batch': 8192,  # батчи набираются по длине в токенах, а не по числу текстов
+        'intra_op_threads': int(os.environ['BERT_INTRA_OP_THREADS']) if os.environ.get('BERT_INTRA_OP_THREADS') else None,
+        'inter_op_threads': int(os.environ['BERT_INTER_OP_THREADS']) if os.environ.get('BERT_INTER_OP_THREADS') else None,
+        'onnx_dir': os.environ.get('BERT_ONNX_DIR', 'onnx_models')
+    }
+    
+    # Общие memory-mapped массивы для нескольких воркеров (None - каждый процесс строит свой индекс)
+    SHARED_ARRAYS_DIR = os.environ.get('BERT_SHARED_ARRAYS_DIR')
+    SHARED_ARRAYS_MAX_AGE = 24 * 3600
 
 class DatabaseService:
     def __init__(self):
@@ -160,6 +235,13 @@ class DatabaseService:
             logger.error(f"Error getting user procurements: {e}")
             return []
     
+    async def _stream_rows(self, query: str, *args, prefetch: int = 2000):
+        # Серверный курсор: строки обрабатываются по мере получения, без материализации всего результата
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor(query, *args, prefetch=prefetch):
+                    yield row
+    
     async def get_available_products(self, limit: int = 15000) -> List[Dict]:
         try:
             query = """
@@ -174,13 +256,15 @@ class DatabaseService:
                 p.unit_of_measure,
                 p.specifications,
                 p.is_available,
+                p.normalized_name,
+                COALESCE(p.dedup_group_id, g.group_id) as dedup_group_id,
                 p.created_at,
-                (SELECT COUNT(*) FROM procurement_items pi WHERE pi.product_id = p.product_id) as purchase_count,
-                (SELECT COUNT(DISTINCT user_id) FROM procurements pr 
-                 JOIN procurement_items pi ON pr.procurement_id = pi.procurement_id 
-                 WHERE pi.product_id = p.product_id) as unique_buyers
+                COALESCE(s.purchase_count, 0) as purchase_count,
+                COALESCE(s.unique_buyers, 0) as unique_buyers
             FROM products p
             LEFT JOIN categories c ON p.category_id = c.category_id
+            LEFT JOIN product_name_groups g ON p.dedup_group_id IS NULL AND g.normalized_name = normalize_product_name(p.name)
+            LEFT JOIN product_stats s ON s.product_id = p.product_id
             WHERE p.is_available = true 
             AND p.average_price > 0
             AND p.name IS NOT NULL
@@ -189,18 +273,19 @@ class DatabaseService:
             LIMIT $1
             """
             
-            async with self.pool.acquire() as conn:
-                rows = await conn.fetch(query, limit)
-            
             products = []
-            seen_names = set()
+            seen_groups = set()
             
-            for row in rows:
-                normalized_name = self._normalize_product_name(row['name'])
-                
-                if normalized_name in seen_names:
+            async for row in self._stream_rows(query, limit):
+                # Группа дубликатов предрасчитана в БД, регулярки - только для строк до бэкфилла
+                group = dedup_key(row)
+                if group in seen_groups:
                     continue
-                seen_names.add(normalized_name)
+                seen_groups.add(group)
+                
+                normalized_name = row['normalized_name']
+                if normalized_name is None:
+                    normalized_name = self._normalize_product_name(row['name'])
                 
                 category_name = self._improve_category(row['category_name'], row['name'])
                 text_for_embedding = self._prepare_text_for_embedding(row)
@@ -231,17 +316,8 @@ class DatabaseService:
             return []
     
     def _normalize_product_name(self, name: str) -> str:
-        if not name:
-            return ""
-        
-        normalized = name.lower().strip()
-        normalized = re.sub(r'\s+', ' ', normalized)
-        normalized = re.sub(r'\s*\(\s*\d+\s*шт/\s*уп\s*\)', '', normalized)
-        normalized = re.sub(r'\s*\d+\s*шт/\s*уп\.?', '', normalized)
-        normalized = re.sub(r'\s*\(\s*[^)]*\d+\s*мм\s*[^)]*\)', '', normalized)
-        normalized = re.sub(r'\s*\[.*?\]', '', normalized)
-        
-        return normalized.strip()
+        # Fallback для строк, которые еще не прошли бэкфилл normalized_name
+        return normalize_product_name(name)
     
     def _improve_category(self, current_category: str, product_name: str) -> str:
         if current_category and current_category != 'Другое':
@@ -270,26 +346,8 @@ class DatabaseService:
         return 'Офисные товары'
     
     def _prepare_text_for_embedding(self, row) -> str:
-        texts = []
-        
-        if row['name']:
-            texts.append(str(row['name']))
-        if row['category_name']:
-            texts.append(str(row['category_name']))
-        if row['description']:
-            desc = str(row['description']).strip()
-            if len(desc) > 10:
-                texts.append(desc[:300])
-        if row['manufacturer']:
-            texts.append(str(row['manufacturer']))
-        if row['specifications']:
-            specs = str(row['specifications']).strip()
-            if len(specs) > 10:
-                texts.append(specs[:200])
-        if row['unit_of_measure']:
-            texts.append(str(row['unit_of_measure']))
-                
-        return ". ".join(texts)
+        # Тот же текст кодирует офлайн-задача clean_data/embedding_job.py - ключи кэша совпадают
+        return embedding_text(row)
     
     def _extract_product_features(self, row) -> Dict:
         features = {}
@@ -313,61 +371,528 @@ class BERTRecommendationEngine:
         self.product_features = {}
         self.product_ids = []
         self.embedding_index = None
+        self.quantized_embeddings = None
+        
+        # Состояние фоновой инициализации: starting -> loading_catalog [-> waiting_for_leader] -> embedding -> indexing -> ready | failed
+        self.state = 'starting'
+        self.catalog_ready = False   # каталог загружен, работает деградированный (несемантический) скоринг
+        self.semantic_ready = False  # эмбеддинги и индекс готовы
+        self.progress = {'embedded': 0, 'total': 0}
+        self.init_error = None
+        
+        self.query_encoder = MicroBatchEncoder(self._encode_queries, **self.config.QUERY_ENCODER)
+        self.candidate_cache = CandidateCache(**self.config.CANDIDATE_CACHE)
+        self.als_model = None
+        self.catalog_to_als = np.zeros(0, dtype=np.int64)
         
     async def initialize_engine(self):
         start_time = time.time()
         
         try:
-            logger.info(f"Loading BERT model: {self.config.MODEL_NAME}")
-            self.model = SentenceTransformer(self.config.MODEL_NAME)
-            
-            if torch.cuda.is_available():
-                self.model = self.model.to('cuda')
-                logger.info("Using CUDA for BERT embeddings")
+            if self.config.SHARED_ARRAYS_DIR:
+                await self._initialize_shared()
             else:
-                logger.info("Using CPU for BERT embeddings")
-            
-            products = await self.db.get_available_products(12000)
-            await self._build_semantic_index(products)
+                await self._initialize_from_database()
             
+            self.state = 'ready'
             init_time = time.time() - start_time
-            logger.info(f"BERT engine initialized in {init_time:.2f}s with {len(products)} products")
+            logger.info(f"BERT engine initialized in {init_time:.2f}s with {len(self.product_ids)} products")
             
         except Exception as e:
+            self.state = 'failed'
+            self.init_error = str(e)
             logger.error(f"BERT engine initialization failed: {e}")
             raise
     
-    async def _build_semantic_index(self, products: List[Dict]):
+    def status(self) -> Dict:
+        return {
+            'state': self.state,
+            'catalog_ready': self.catalog_ready,
+            'semantic_ready': self.semantic_ready,
+            'degraded': self.catalog_ready and not self.semantic_ready,
+            'progress': dict(self.progress),
+            'error': self.init_error
+        }
+    
+    def _load_model(self):
+        logger.info(f"Loading BERT model: {self.config.MODEL_NAME} ({self.config.ENCODER['backend']})")
+        self.model = create_text_encoder(self.config.MODEL_NAME, **self.config.ENCODER)
+    
+    def _embedding_model_key(self) -> str:
+        return embedding_model_key(self.config.MODEL_NAME, self.config.ENCODER['backend'])
+    
+    async def _initialize_from_database(self):
+        products = await self._load_products()
+        await self._build_semantic_index(products)
+    
+    async def _load_products(self) -> List[Dict]:
+        self.state = 'loading_catalog'
+        products = await self.db.get_available_products(self.config.CATALOG_LIMIT)
         if not products:
             raise ValueError("No products available for indexing")
+        return products
+    
+    async def _initialize_shared(self):
+        # Лидер строит индекс и публикует массивы, остальные воркеры подключаются к ним read-only
+        store = SharedArrayStore(
+            self.config.SHARED_ARRAYS_DIR, 'bert',
+            fingerprint=f"{self._embedding_model_key()}:{self.config.CATALOG_LIMIT}",
+            max_age=self.config.SHARED_ARRAYS_MAX_AGE
+        )
         
+        if not store.is_ready() and store.try_become_leader():
+            await self._build_and_publish(store)
+            return
+        
+        if not store.is_ready():
+            # Пока лидер кодирует, каталог уже обслуживает несемантический скоринг
+            products = await self._load_products()
+            self._set_catalog(products)
+            self.state = 'waiting_for_leader'
+            if not await store.wait_until_ready():
+                # Лидер не опубликовал индекс, блокировка теперь у нас - кодируем уже загруженный каталог
+                await self._build_and_publish(store)
+                return
+        
+        await self._attach_shared_index(store)
+    
+    async def _build_and_publish(self, store: SharedArrayStore):
+        try:
+            logger.info("Shared index leader: building embeddings")
+            if self.catalog_ready:
+                await self._embed_catalog()
+            else:
+                await self._initialize_from_database()
+            store.publish(
+                {'product_embeddings': self.product_embeddings},
+                {'products': [self.product_features[pid] for pid in self.product_ids]}
+            )
+        finally:
+            store.release()
+    
+    async def _attach_shared_index(self, store: SharedArrayStore):
+        arrays, metadata = store.attach()
+        products = metadata['products']
+        
+        # Строки эмбеддингов идут в порядке каталога лидера - берем его, если наш отличается
+        if [p['product_id'] for p in products] != self.product_ids:
+            self._set_catalog(products)
+        
+        self.product_embeddings = arrays['product_embeddings']
+        self.progress = {'embedded': len(self.product_ids), 'total': len(self.product_ids)}
+        logger.info(f"Attached shared embeddings: {self.product_embeddings.shape}")
+        await asyncio.get_running_loop().run_in_executor(None, self._index_embeddings)
+    
+    async def _build_semantic_index(self, products: List[Dict]):
+        # Каталог доступен сразу: до готовности эмбеддингов запросы обслуживает несемантический скоринг
+        self._set_catalog(products)
+        await self._embed_catalog()
+    
+    def _set_catalog(self, products: List[Dict]):
         self.product_features = {p['product_id']: p for p in products}
         self.product_ids = list(self.product_features.keys())
-        
+        self._index_catalog()
+    
+    async def _embed_catalog(self):
         texts = [self.product_features[pid]['text_for_embedding'] for pid in self.product_ids]
         
-        logger.info(f"Generating BERT embeddings for {len(texts)} products...")
-        
-        # Генерируем эмбеддинги батчами для оптимизации памяти
-        embeddings = []
-        for i in range(0, len(texts), self.config.BATCH_SIZE):
-            batch_texts = texts[i:i + self.config.BATCH_SIZE]
-            batch_embeddings = self.model.encode(
-                batch_texts, 
-                show_progress_bar=False,
-                convert_to_tensor=False,
-                normalize_embeddings=True
+        # Модель и кодирование - синхронные и тяжелые, выносим в executor, чтобы не блокировать event loop
+        self.state = 'embedding'
+        self.progress = {'embedded': 0, 'total': len(texts)}
+        loop = asyncio.get_running_loop()
+        encode = self._encode_with_cache if self.config.EMBEDDING_CACHE_DIR else self._encode_texts
+        embeddings = await loop.run_in_executor(None, encode, texts)
+        logger.info(f"Embeddings shape: {embeddings.shape}")
+        
+        self.state = 'indexing'
+        self.product_embeddings = embeddings
+        await loop.run_in_executor(None, self._index_embeddings)
+    
+    def _index_catalog(self):
+        # Создаем mapping для быстрого поиска
+        self.product_to_index = {pid: idx for idx, pid in enumerate(self.product_ids)}
+        self._build_product_arrays()
+        self._load_als_model()
+        self.catalog_ready = True
+    
+    def _load_als_model(self):
+        model_dir = self.config.MATRIX_FACTORIZATION['model_dir']
+        if not model_dir:
+            return
+        self.als_model = ImplicitALS.load(model_dir)
+        if self.als_model is None:
+            logger.warning(f"No ALS model published in {model_dir}, matrix factorization is disabled")
+            return
+        item_to_index = self.als_model.item_to_index
+        self.catalog_to_als = np.array([item_to_index.get(pid, -1) for pid in self.product_ids], dtype=np.int64)
+        logger.info(f"ALS model loaded: {len(self.als_model.user_ids)} buyers, {len(self.als_model.item_ids)} items")
+    
+    def _als_scores(self, user_profile: Dict) -> Optional[np.ndarray]:
+        """Скоры каталога в [0, 1] по вектору пользователя в ALS (fold-in по истории для новых)"""
+        if self.als_model is None:
+            return None
+        
+        scores = self.als_model.score_items(user_profile['user_id'], user_profile['product_frequencies'])
+        if scores is None:
+            return None
+        
+        mapping = self.catalog_to_als
+        catalog_scores = np.where(mapping >= 0, np.maximum(scores[np.maximum(mapping, 0)], 0), 0.0)
+        peak = catalog_scores.max() if len(catalog_scores) else 0
+        if peak <= 0:
+            return None
+        return catalog_scores / peak
+    
+    def _index_embeddings(self):
+        if self.config.EMBEDDING_STORAGE != 'float32':
+            self._quantize_embeddings()
+        self._build_vector_index()
+        self.semantic_ready = True
+    
+    def _build_product_arrays(self):
+        # Статические (не зависящие от пользователя) части скора считаются один раз при индексации
+        products = [self.product_features[pid] for pid in self.product_ids]
+        
+        self.category_names = sorted({p['category_name'] for p in products})
+        category_codes = {name: code for code, name in enumerate(self.category_names)}
+        name_codes = {}
+        
+        purchase_count = np.array([p['purchase_count'] for p in products], dtype=np.float64)
+        is_available = np.array([bool(p['is_available']) for p in products])
+        has_manufacturer = np.array([bool(p.get('manufacturer')) for p in products])
+        long_name = np.array([len(p['name']) > 10 for p in products])
+        long_description = np.array([bool(p['description']) and len(p['description']) > 20 for p in products])
+        
+        self.product_arrays = {
+            'price': np.array([p['average_price'] for p in products], dtype=np.float64),
+            'category': np.array([category_codes[p['category_name']] for p in products], dtype=np.int32),
+            'name': np.array([name_codes.setdefault(p['name'], len(name_codes)) for p in products], dtype=np.int64),
+            'popularity': np.where(purchase_count > 0, np.minimum(purchase_count / 100, 1.0), 0.1),
+            'business_rules': 0.6 * is_available + 0.3 * (purchase_count > 10) + 0.1 * has_manufacturer,
+            'data_quality': (0.2 * long_name + 0.2 * long_description + 0.1 * has_manufacturer
+                             + 0.3 * (purchase_count > 5) + 0.2 * is_available)
+        }
+    
+    def _quantize_embeddings(self):
+        store = QuantizedEmbeddingStore(self.config.EMBEDDING_STORAGE).build(self.product_embeddings)
+        
+        # Замер качества на запросах, похожих на центроиды пользователей (среднее 5 товаров)
+        rng = np.random.default_rng(42)
+        queries = np.stack([
+            np.asarray(self.product_embeddings[np.sort(rng.choice(len(self.product_ids), 5))]).mean(axis=0)
+            for _ in range(self.config.QUANTIZATION['quality_queries'])
+        ])
+        queries = normalize(queries).astype(np.float32)
+        quality = store.measure_quality(self.product_embeddings, queries, rerank=self.config.QUANTIZATION['rerank'])
+        logger.info(f"Embedding quantization quality: {quality}")
+        if quality['recall@15'] < self.config.QUANTIZATION['min_recall']:
+            logger.warning(f"Quantized recall@15 {quality['recall@15']:.3f} is below "
+                           f"{self.config.QUANTIZATION['min_recall']}, consider a larger rerank")
+        
+        # Точные float32 векторы держим в memmap: читаются только строки коротких списков
+        if not isinstance(self.product_embeddings, np.memmap):
+            cache_dir = self.config.EMBEDDING_CACHE_DIR or None
+            with tempfile.NamedTemporaryFile(suffix='.npy', dir=cache_dir, delete=False) as f:
+                np.save(f, np.ascontiguousarray(self.product_embeddings, dtype=np.float32))
+            self.product_embeddings = np.load(f.name, mmap_mode='r')
+            os.unlink(f.name)  # файл живет, пока открыт memmap
+        
+        self.quantized_embeddings = store
+    
+    def _vector_index_fingerprint(self) -> str:
+        """Отпечаток сохраненного индекса: модель, порядок товаров и сами векторы.
+        
+        Смена модели, текстов товаров или ключей кэша эмбеддингов меняет векторы,
+        поэтому старый IVF-PQ индекс с теми же product_ids не переиспользуется.
+        """
+        digest = hashlib.sha1(self._embedding_model_key().encode('utf-8'))
+        digest.update("\n".join(map(str, self.product_ids)).encode('utf-8'))
+        embeddings = self.product_embeddings
+        digest.update(str(embeddings.shape).encode('utf-8'))
+        for start in range(0, len(embeddings), 65536):
+            digest.update(np.ascontiguousarray(embeddings[start:start + 65536], dtype=np.float32).tobytes())
+        return digest.hexdigest()
+    
+    def _build_vector_index(self):
+        index_config = self.config.VECTOR_INDEX
+        if self.quantized_embeddings is not None and index_config['backend'] == 'exact':
+            # Точный скан выполняет квантованное хранилище с переранжированием
+            self.embedding_index = None
+            return
+        
+        # Точный индекс не сохраняется, а отпечаток хэширует все векторы - считаем его только для сохраняемого
+        path = index_config['path'] if index_config['backend'] != 'exact' else None
+        fingerprint = self._vector_index_fingerprint() if path else None
+        
+        if path and os.path.exists(path):
+            index = VectorIndex.load(path)
+            if index.backend == index_config['backend'] and index.meta.get('fingerprint') == fingerprint:
+                self.embedding_index = index
+                logger.info(f"Loaded {index.backend} vector index from {path}")
+                return
+        
+        params = dict(index_config['params'])
+        if index_config['backend'] == 'ivfpq':
+            params.setdefault('nlist', max(16, int(4 * math.sqrt(len(self.product_ids)))))
+        
+        index = create_vector_index(index_config['backend'], self.product_embeddings.shape[1], **params)
+        index.build(range(len(self.product_ids)), self.product_embeddings)
+        self.embedding_index = index
+        logger.info(f"Built {index.backend} vector index for {len(index)} products")
+        
+        if path:
+            index.save(path, meta={'fingerprint': fingerprint})
+    
+    def _semantic_candidates(self, user_profile: Dict) -> np.ndarray:
+        # Без семантического центроида или индекса оцениваем весь каталог
+        if user_profile['semantic_centroid'] is None:
+            return np.arange(len(self.product_ids))
+        
+        exclude = [self.product_to_index[pid] for pid in user_profile['purchased_products']
+                   if pid in self.product_to_index]
+        
+        if self.embedding_index is None and self.quantized_embeddings is None:
+            return np.arange(len(self.product_ids))
+        
+        rows, _ = self._search_embeddings(
+            user_profile['semantic_centroid'], self.config.VECTOR_INDEX['candidates'], exclude=exclude
+        )
+        # Порядок каталога сохраняет прежнюю логику устранения дубликатов по названию
+        return np.sort(rows)
+    
+    def _search_embeddings(self, query: np.ndarray, k: int, exclude: Optional[List[int]] = None):
+        """Ближайшие строки каталога к нормализованному вектору: (rows, scores) по убыванию"""
+        if self.embedding_index is not None:
+            search_params = {}
+            if self.embedding_index.backend == 'ivfpq':
+                search_params['refine_vectors'] = self.product_embeddings
+            return self.embedding_index.search(query, k, exclude=exclude, **search_params)
+        
+        if self.quantized_embeddings is not None:
+            return self.quantized_embeddings.search(
+                query, k,
+                exact_vectors=self.product_embeddings,
+                rerank=max(self.config.QUANTIZATION['rerank'], k),
+                exclude=exclude
             )
-            embeddings.append(batch_embeddings)
-            
-            if i % 1000 == 0:
-                logger.info(f"Processed {i}/{len(texts)} products")
         
-        self.product_embeddings = np.vstack(embeddings)
-        logger.info(f"Embeddings shape: {self.product_embeddings.shape}")
+        scores = np.asarray(self.product_embeddings @ np.asarray(query, dtype=np.float32))
+        if exclude:
+            scores[np.asarray(exclude, dtype=np.int64)] = -np.inf
+        rows = _top_k(scores, k)
+        rows = rows[np.isfinite(scores[rows])]
+        return rows, scores[rows]
+    
+    def _score_rows(self, rows: np.ndarray, user_profile: Dict) -> Dict[str, np.ndarray]:
+        """Векторизованный расчет компонент, итогового скора и уверенности для строк каталога"""
+        arrays = self.product_arrays
+        weights = self.config.WEIGHTS
         
-        # Создаем mapping для быстрого поиска
-        self.product_to_index = {pid: idx for idx, pid in enumerate(self.product_ids)}
+        # 1. Семантическая схожесть (BERT) - одно матрично-векторное умножение
+        semantic = np.zeros(len(rows))
+        if user_profile['semantic_centroid'] is not None:
+            centroid = np.asarray(user_profile['semantic_centroid'], dtype=self.product_embeddings.dtype)
+            # Для большой доли каталога дешевле полный скан, чем копирование строк
+            full_scan = len(rows) * 4 > len(self.product_ids)
+            if full_scan and self.quantized_embeddings is not None:
+                semantic = self.quantized_embeddings.approximate_scores(centroid)[rows]
+                # Лучшие по приближенному скору строки пересчитываем по точным векторам, как в search()
+                shortlist = _top_k(semantic, self.config.QUANTIZATION['rerank'])
+                shortlist = shortlist[np.argsort(rows[shortlist], kind='stable')]
+                semantic[shortlist] = np.asarray(self.product_embeddings[rows[shortlist]]) @ centroid
+            elif full_scan:
+                semantic = (self.product_embeddings @ centroid)[rows]
+            else:
+                semantic = np.asarray(self.product_embeddings[rows]) @ centroid
+            semantic = np.maximum(semantic.astype(np.float64), 0)
+        
+        # 2. Поведенческие паттерны: вес категории пользователя + популярность
+        category_weights = np.zeros(len(self.category_names))
+        for code, category in enumerate(self.category_names):
+            category_weights[code] = user_profile['category_weights'].get(category, 0)
+        behavioral = category_weights[arrays['category'][rows]] * 0.7 + arrays['popularity'][rows] * 0.3
+        
+        # 3. Бизнес-правила предрасчитаны
+        business = arrays['business_rules'][rows]
+        
+        # 4. Ценовая доступность
+        price_affordability = np.zeros(len(rows))
+        prices = arrays['price'][rows]
+        if user_profile['total_spent'] > 0:
+            user_avg_price = user_profile['total_spent'] / user_profile['total_items']
+            if user_avg_price > 0:
+                price_affordability = np.where(
+                    prices > 0,
+                    np.minimum(prices, user_avg_price) / np.maximum(prices, user_avg_price),
+                    0
+                )
+        
+        total = (semantic * weights['semantic_similarity'] + behavioral * weights['behavioral_patterns']
+                 + business * weights['business_rules'] + price_affordability * weights['price_affordability'])
+        
+        # 5. Матричная факторизация по истории закупок всех заказчиков
+        matrix_factorization = self._als_scores(user_profile)
+        if matrix_factorization is not None:
+            matrix_factorization = matrix_factorization[rows]
+            mf_weight = self.config.MATRIX_FACTORIZATION['weight']
+            total = total * (1 - mf_weight) + matrix_factorization * mf_weight
+        else:
+            matrix_factorization = np.zeros(len(rows))
+        
+        # Уверенность: среднее факторов семантики, качества данных и объема истории
+        semantic_factor = np.select([semantic > 0.3, semantic > 0.1], [0.9, 0.6], 0.3)
+        if user_profile['total_items'] > 10:
+            user_factor = 0.8
+        elif user_profile['total_items'] > 0:
+            user_factor = 0.5
+        else:
+            user_factor = 0.2
+        confidence = (semantic_factor + arrays['data_quality'][rows] + user_factor) / 3
+        
+        return {
+            'semantic_similarity': semantic,
+            'behavioral_patterns': behavioral,
+            'business_rules': business,
+            'price_affordability': price_affordability,
+            'matrix_factorization': matrix_factorization,
+            'total_score': total,
+            'confidence': confidence
+        }
+    
+    @staticmethod
+    def _canonical_text(text: str) -> str:
+        return canonical_text(text)
+    
+    def _iter_encoded_batches(self, texts: List[str]) -> Iterator[Tuple[List[int], np.ndarray]]:
+        """Кодирует тексты по возрастанию длины и отдает (позиции, векторы) по кускам.
+        
+        Куски соседних по длине текстов почти не требуют паддинга, а генератор
+        держит в памяти только текущий кусок - результат сразу уходит потребителю.
+        """
+        if self.model is None:
+            self._load_model()
+        
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        chunk_size = self.config.BATCH_SIZE * 16
+        for start in range(0, len(order), chunk_size):
+            positions = order[start:start + chunk_size]
+            vectors = self.model.encode([texts[i] for i in positions])
+            self.progress['embedded'] += len(positions)
+            logger.info(f"Processed {start + len(positions)}/{len(texts)} unique texts")
+            yield positions, vectors
+    
+    def _encode_texts(self, texts: List[str]) -> np.ndarray:
+        if self.model is None:
+            self._load_model()
+        
+        # Хэш-дедупликация: каждый уникальный текст кодируется один раз и раздается всем товарам
+        unique = {}
+        inverse = np.fromiter((unique.setdefault(self._canonical_text(text), len(unique)) for text in texts),
+                              dtype=np.int64, count=len(texts))
+        unique_texts = list(unique)
+        logger.info(f"Generating BERT embeddings for {len(unique_texts)} unique texts ({len(texts)} products)...")
+        self.progress = {'embedded': 0, 'total': len(unique_texts)}
+        
+        embeddings = np.empty((len(unique_texts), self.model.dim), dtype=np.float32)
+        for positions, vectors in self._iter_encoded_batches(unique_texts):
+            embeddings[positions] = vectors
+        
+        if len(unique_texts) == len(texts):
+            return embeddings
+        return embeddings[inverse]
+    
+    def _encode_queries(self, queries: List[str]) -> np.ndarray:
+        # Вызывается из потока MicroBatchEncoder одним батчем на несколько запросов
+        if self.model is None:
+            self._load_model()
+        return self.model.encode(queries)
+    
+    async def search_products(self, query: str, limit: int = 20) -> List[Dict]:
+        if not self.semantic_ready:
+            raise RuntimeError("Semantic search is not ready yet")
+        
+        query_vector = await self.query_encoder.encode(query)
+        rows, scores = self._search_embeddings(query_vector, limit)
+        
+        results = []
+        for row, score in zip(rows, scores):
+            product_id = self.product_ids[row]
+            product = self.product_features[product_id]
+            results.append({
+                'product_id': product_id,
+                'product_name': product['name'],
+                'product_category': product['category_name'],
+                'similarity': round(float(score), 4),
+                'average_price': product['average_price'],
+                'is_available': product['is_available'],
+                'manufacturer': product.get('manufacturer')
+            })
+        return results
+    
+    def _encode_with_cache(self, texts: List[str]) -> np.ndarray:
+        cache = EmbeddingCache(self.config.EMBEDDING_CACHE_DIR, self.config.EMBEDDING_DIM)
+        try:
+            return self._encode_with_open_cache(cache, texts)
+        finally:
+            # Отпускаем поколение кэша, чтобы компакция другого воркера могла удалить старые файлы
+            cache.close()
+    
+    @staticmethod
+    def _migrate_raw_text_keys(cache: EmbeddingCache, model_key: str, keys: List[str], texts: List[str],
+                               rows: np.ndarray) -> np.ndarray:
+        """Перенос записей кэша со старым ключом по исходному тексту под ключ канонического текста.
+        
+        До канонизации ключом был hash(модель, текст как есть). Канонизация меняет только
+        пробелы, токены и вектор те же - поэтому старые записи копируются, а не кодируются заново.
+        """
+        legacy = {}
+        for key, text, row in zip(keys, texts, rows):
+            if row < 0 and key not in legacy:
+                legacy[key] = EmbeddingCache.make_key(model_key, text)
+        
+        legacy_rows = cache.lookup(legacy.values())
+        found = legacy_rows >= 0
+        if not found.any():
+            return rows
+        
+        migrated = [key for key, ok in zip(legacy, found) if ok]
+        cache.append(migrated, np.asarray(cache.vectors()[legacy_rows[found]]))
+        logger.info(f"Embedding cache: {len(migrated)} entries migrated from raw-text keys")
+        return cache.lookup(keys)
+    
+    def _encode_with_open_cache(self, cache: EmbeddingCache, texts: List[str]) -> np.ndarray:
+        model_key = self._embedding_model_key()
+        keys = [EmbeddingCache.make_key(model_key, self._canonical_text(text)) for text in texts]
+        
+        rows = cache.lookup(keys)
+        if (rows < 0).any():
+            rows = self._migrate_raw_text_keys(cache, model_key, keys, texts, rows)
+        missing = {}
+        for key, text, row in zip(keys, texts, rows):
+            if row < 0 and key not in missing:
+                missing[key] = self._canonical_text(text)
+        
+        logger.info(f"Embedding cache: {len(texts) - int((rows < 0).sum())}/{len(texts)} hits, "
+                    f"{len(missing)} texts to encode")
+        # Прогресс в уникальных текстах: попадания в кэш считаются готовыми
+        unique_texts = len(set(keys))
+        self.progress = {'embedded': unique_texts - len(missing), 'total': unique_texts}
+        
+        # Кодируем по возрастанию длины и сохраняем каждый кусок, чтобы прерванный запуск не терял прогресс
+        missing_keys = list(missing.keys())
+        for positions, vectors in self._iter_encoded_batches(list(missing.values())):
+            cache.append([missing_keys[i] for i in positions], vectors)
+        
+        if missing_keys:
+            rows = cache.lookup(keys)
+        
+        # Векторы офлайн-задачи закреплены в кэше и компакцией не удаляются - учитываем их как живые
+        live_keys = set(keys) | cache.pinned_keys()
+        if len(cache) > self.config.EMBEDDING_CACHE_COMPACT_RATIO * max(len(live_keys), 1):
+            cache.compact(live_keys=live_keys)
+            rows = cache.lookup(keys)
+        
+        return np.asarray(cache.vectors()[rows])
     
     def _get_semantic_similarity(self, product_id1: str, product_id2: str) -> float:
         if product_id1 not in self.product_to_index or product_id2 not in self.product_to_index:
@@ -381,6 +906,7 @@ class BERTRecommendationEngine:
     
     def create_user_profile(self, user_id: str, procurements: List[Dict]) -> Dict:
         profile = {
+            'user_id': user_id,
             'purchased_products': set(),
             'product_frequencies': Counter(),
             'preferred_categories': Counter(),
@@ -390,13 +916,14 @@ class BERTRecommendationEngine:
             'category_weights': defaultdict(float),
             'price_ranges': defaultdict(dict),
             'semantic_centroid': None,  # Центроид эмбеддингов купленных товаров
+            'semantic': self.semantic_ready,  # профиль построен с эмбеддингами
             'behavioral_patterns': self._analyze_behavioral_patterns(procurements)
         }
         
         if not procurements:
             return profile
         
-        purchased_embeddings = []
+        purchased_rows, embedding_weights = [], []
         
         for proc in procurements:
             product_id = proc['product_id']
@@ -412,16 +939,15 @@ class BERTRecommendationEngine:
             profile['preferred_categories'][category] += quantity
             profile['price_preferences'][category].append(price)
             
-            if product_id in self.product_to_index:
-                idx = self.product_to_index[product_id]
-                # Учитываем частоту покупки при вычислении центроида
-                for _ in range(min(quantity, 3)):  # Ограничиваем влияние частых покупок
-                    purchased_embeddings.append(self.product_embeddings[idx])
+            if self.semantic_ready and product_id in self.product_to_index and quantity > 0:
+                purchased_rows.append(self.product_to_index[product_id])
+                # Учитываем частоту покупки при вычислении центроида, ограничивая влияние частых покупок
+                embedding_weights.append(min(quantity, 3))
         
         # Вычисляем семантический центроид пользователя
-        if purchased_embeddings:
-            profile['semantic_centroid'] = np.mean(purchased_embeddings, axis=0)
-            profile['semantic_centroid'] = normalize([profile['semantic_centroid']])[0]
+        if purchased_rows:
+            centroid = weighted_centroid(np.asarray(self.product_embeddings[purchased_rows]), embedding_weights)
+            profile['semantic_centroid'] = normalize([centroid])[0]
         
         # Вычисляем веса категорий
         total_items = profile['total_items']
@@ -468,103 +994,17 @@ class BERTRecommendationEngine:
         return patterns
     
     def calculate_product_score(self, product_id: str, user_profile: Dict) -> Dict:
-        product = self.product_features.get(product_id)
-        if not product:
+        if product_id not in self.product_to_index:
             return {'total_score': 0, 'component_scores': {}, 'confidence': 0}
         
-        scores = {
-            'semantic_similarity': 0,
-            'behavioral_patterns': 0,
-            'business_rules': 0,
-            'price_affordability': 0
-        }
-        
-        weights = self.config.WEIGHTS
-        
-        # 1. Семантическая схожесть (BERT)
-        if user_profile['semantic_centroid'] is not None and product_id in self.product_to_index:
-            idx = self.product_to_index[product_id]
-            product_embedding = self.product_embeddings[idx]
-            semantic_sim = float(np.dot(user_profile['semantic_centroid'], product_embedding))
-            scores['semantic_similarity'] = max(0, semantic_sim)  # Cosine similarity может быть отрицательной
-        
-        # 2. Поведенческие паттерны
-        category = product['category_name']
-        cat_weight = user_profile['category_weights'].get(category, 0)
-        
-        # Учитываем популярность товара
-        popularity = min(product['purchase_count'] / 100, 1.0) if product['purchase_count'] > 0 else 0.1
-        
-        scores['behavioral_patterns'] = (cat_weight * 0.7 + popularity * 0.3)
-        
-        # 3. Бизнес-правила
-        business_score = 0
-        if product['is_available']:
-            business_score += 0.6
-        if product['purchase_count'] > 10:  # Проверенный товар
-            business_score += 0.3
-        if product.get('manufacturer'):  # Есть производитель
-            business_score += 0.1
-            
-        scores['business_rules'] = business_score
-        
-        # 4. Ценовая доступность
-        product_price = product['average_price']
-        if product_price > 0 and user_profile['total_spent'] > 0:
-            user_avg_price = user_profile['total_spent'] / user_profile['total_items']
-            if user_avg_price > 0:
-                # Мягкое сравнение цен
-                price_ratio = min(product_price, user_avg_price) / max(product_price, user_avg_price)
-                scores['price_affordability'] = price_ratio
-        
-        # Итоговый score
-        total_score = sum(scores[factor] * weights[factor] for factor in scores)
-        
-        # Уверенность в рекомендации
-        confidence = self._calculate_confidence(scores, product, user_profile)
+        scores = self._score_rows(np.array([self.product_to_index[product_id]]), user_profile)
         
         return {
-            'total_score': total_score,
-            'component_scores': scores,
-            'confidence': confidence
+            'total_score': float(scores['total_score'][0]),
+            'component_scores': {name: float(scores[name][0]) for name in (*self.config.WEIGHTS, 'matrix_factorization')},
+            'confidence': float(scores['confidence'][0])
         }
     
-    def _calculate_confidence(self, scores: Dict, product: Dict, user_profile: Dict) -> float:
-        confidence_factors = []
-        
-        # Фактор семантической схожести
-        if scores['semantic_similarity'] > 0.3:
-            confidence_factors.append(0.9)
-        elif scores['semantic_similarity'] > 0.1:
-            confidence_factors.append(0.6)
-        else:
-            confidence_factors.append(0.3)
-        
-        # Фактор данных о товаре
-        data_quality = 0
-        if len(product['name']) > 10:
-            data_quality += 0.2
-        if product['description'] and len(product['description']) > 20:
-            data_quality += 0.2
-        if product['manufacturer']:
-            data_quality += 0.1
-        if product['purchase_count'] > 5:
-            data_quality += 0.3
-        if product['is_available']:
-            data_quality += 0.2
-            
-        confidence_factors.append(data_quality)
-        
-        # Фактор пользовательских данных
-        if user_profile['total_items'] > 10:
-            confidence_factors.append(0.8)
-        elif user_profile['total_items'] > 0:
-            confidence_factors.append(0.5)
-        else:
-            confidence_factors.append(0.2)
-        
-        return np.mean(confidence_factors)
-    
     def _generate_explanation(self, scores: Dict, product: Dict, user_profile: Dict) -> str:
         explanations = []
         
@@ -579,6 +1019,9 @@ class BERTRecommendationEngine:
         elif user_profile['category_weights'].get(category, 0) > 0:
             explanations.append("в интересующей вас категории")
         
+        if scores['matrix_factorization'] > 0.6:
+            explanations.append("покупают заказчики с похожей историей закупок")
+        
         if scores['business_rules'] > 0.8:
             explanations.append("популярный и доступный товар")
         elif scores['business_rules'] > 0.6:
@@ -597,90 +1040,116 @@ class BERTRecommendationEngine:
     async def generate_recommendations(self, user_id: str, limit: int = 15, strategy: str = "balanced"):
         start_time = time.time()
         
-        user_procurements = await self.db.get_user_procurements(user_id)
-        if user_id not in self.user_profiles:
-            self.create_user_profile(user_id, user_procurements)
+        if not self.catalog_ready:
+            raise RuntimeError("Recommendation engine is not ready yet")
         
-        user_profile = self.user_profiles[user_id]
-        purchased_products = user_profile['purchased_products']
-        
-        candidates = []
-        seen_names = set()
-        
-        # Оцениваем все товары кроме купленных
-        for product_id in self.product_ids:
-            if product_id in purchased_products:
-                continue
-            
-            product = self.product_features[product_id]
-            if product['name'] in seen_names:
-                continue
-            seen_names.add(product['name'])
-            
-            score_result = self.calculate_product_score(product_id, user_profile)
-            
-            if score_result['total_score'] > 0.15:  # Более высокий порог для качества
-                explanation = self._generate_explanation(score_result['component_scores'], product, user_profile)
-                
-                candidates.append({
-                    'product_id': product_id,
-                    'product_name': product['name'],
-                    'product_category': product['category_name'],
-                    'total_score': round(score_result['total_score'], 4),
-                    'component_scores': score_result['component_scores'],
-                    'confidence': round(score_result['confidence'], 3),
-                    'explanation': explanation,
-                    'price_range': {
-                        'avg': product['average_price'],
-                        'min': product['average_price'] * 0.8,
-                        'max': product['average_price'] * 1.2,
-                        'source': 'database'
-                    },
-                    'in_catalog': True,
-                    'is_available': product['is_available'],
-                    'purchase_count': product['purchase_count'],
-                    'manufacturer': product.get('manufacturer')
-                })
+        # Пул кандидатов общий для всех стратегий и для наборов - здесь только переранжирование
+        pool = await self.candidate_cache.get_or_compute(
+            user_id, (self.semantic_ready, len(self.product_ids)), lambda: self._build_candidate_pool(user_id)
+        )
+        rows, scores, user_profile = pool['rows'], pool['scores'], pool['profile']
         
         # Применяем стратегию сортировки
+        rounded_scores = np.round(scores['total_score'], 4)
+        prices = self.product_arrays['price'][rows]
         if strategy == "budget":
-            candidates.sort(key=lambda x: x['price_range']['avg'])
+            order = np.argsort(prices, kind='stable')
         elif strategy == "premium":
-            candidates.sort(key=lambda x: x['price_range']['avg'], reverse=True)
+            order = np.argsort(-prices, kind='stable')
         else:  # balanced
-            candidates.sort(key=lambda x: x['total_score'], reverse=True)
+            order = np.argsort(-rounded_scores, kind='stable')
         
-        # Диверсификация
-        final_recommendations = self._apply_diversification(candidates, limit)
+        # Диверсификация, словари и объяснения - только для итоговых top-N
+        selected = self._apply_diversification(order, self.product_arrays['category'][rows], rounded_scores, limit)
+        final_recommendations = [
+            self._build_recommendation(rows[i], {name: values[i] for name, values in scores.items()}, user_profile)
+            for i in selected
+        ]
         
         processing_time = time.time() - start_time
         logger.info(f"BERT generated {len(final_recommendations)} recommendations for user {user_id} in {processing_time:.3f}s")
         
         return final_recommendations, processing_time
     
-    def _apply_diversification(self, candidates: List[Dict], top_n: int) -> List[Dict]:
-        if len(candidates) <= top_n:
-            return candidates[:top_n]
+    async def _build_candidate_pool(self, user_id: str) -> Dict:
+        """История пользователя, отбор и скоринг кандидатов (кэшируется на TTL)"""
+        user_procurements = await self.db.get_user_procurements(user_id)
+        # Профили из деградированного режима (без центроида) пересобираем после готовности эмбеддингов
+        if user_id not in self.user_profiles or self.user_profiles[user_id]['semantic'] != self.semantic_ready:
+            self.create_user_profile(user_id, user_procurements)
+        
+        user_profile = self.user_profiles[user_id]
+        purchased_products = user_profile['purchased_products']
+        
+        rows = self._semantic_candidates(user_profile)
+        
+        # Исключаем купленные и дубликаты по названию (первое вхождение в порядке каталога)
+        purchased_rows = [self.product_to_index[pid] for pid in purchased_products if pid in self.product_to_index]
+        rows = rows[~np.isin(rows, purchased_rows)]
+        _, first_rows = np.unique(self.product_arrays['name'][rows], return_index=True)
+        rows = rows[np.sort(first_rows)]
+        
+        scores = self._score_rows(rows, user_profile)
+        passed = scores['total_score'] > 0.15  # Более высокий порог для качества
+        rows = rows[passed]
+        scores = {name: values[passed] for name, values in scores.items()}
+        
+        return {'rows': rows, 'scores': scores, 'profile': user_profile}
+    
+    def _build_recommendation(self, row: int, scores: Dict, user_profile: Dict) -> Dict:
+        product_id = self.product_ids[row]
+        product = self.product_features[product_id]
+        component_scores = {
+            'semantic_similarity': float(scores['semantic_similarity']),
+            'behavioral_patterns': float(scores['behavioral_patterns']),
+            'business_rules': float(scores['business_rules']),
+            'price_affordability': float(scores['price_affordability']),
+            'matrix_factorization': float(scores['matrix_factorization'])
+        }
+        
+        return {
+            'product_id': product_id,
+            'product_name': product['name'],
+            'product_category': product['category_name'],
+            'total_score': round(float(scores['total_score']), 4),
+            'component_scores': component_scores,
+            'confidence': round(float(scores['confidence']), 3),
+            'explanation': self._generate_explanation(component_scores, product, user_profile),
+            'price_range': {
+                'avg': product['average_price'],
+                'min': product['average_price'] * 0.8,
+                'max': product['average_price'] * 1.2,
+                'source': 'database'
+            },
+            'in_catalog': True,
+            'is_available': product['is_available'],
+            'purchase_count': product['purchase_count'],
+            'manufacturer': product.get('manufacturer')
+        }
+    
+    def _apply_diversification(self, order: np.ndarray, categories: np.ndarray,
+                               total_scores: np.ndarray, top_n: int) -> List[int]:
+        if len(order) <= top_n:
+            return list(order[:top_n])
         
         selected = []
         selected_categories = Counter()
+        max_per_category = self.config.DIVERSITY['max_per_category']
         
-        # Проходим по кандидатам в порядке убывания скора
-        for candidate in candidates:
+        # Проходим по кандидатам в порядке сортировки
+        for i in order:
             if len(selected) >= top_n:
                 break
-                
-            category = candidate['product_category']
-            max_per_category = self.config.DIVERSITY['max_per_category']
             
+            category = categories[i]
             if selected_categories[category] < max_per_category:
-                selected.append(candidate)
+                selected.append(i)
                 selected_categories[category] += 1
         
         # Если не набрали достаточно, добавляем лучшие из оставшихся
         if len(selected) < top_n:
-            remaining = [c for c in candidates if c not in selected]
-            remaining.sort(key=lambda x: x['total_score'], reverse=True)
+            remaining = np.setdiff1d(order, selected, assume_unique=True)
+            remaining = remaining[np.argsort(-total_scores[remaining], kind='stable')]
             selected.extend(remaining[:top_n - len(selected)])
         
         return selected[:top_n]
@@ -730,8 +1199,27 @@ bert_engine = BERTRecommendationEngine(db_service)
 @app.on_event("startup")
 async def startup_event():
     await db_service.connect()
-    await bert_engine.initialize_engine()
-    logger.info("BERT-Powered Recommendation API started successfully")
+    # Инициализация идет в фоне: процесс сразу принимает трафик, готовность видна в /health/ready
+    app.state.engine_init_task = asyncio.create_task(_initialize_engine_background())
+    logger.info("BERT-Powered Recommendation API started, engine is initializing in background")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await bert_engine.query_encoder.close()
+
+async def _initialize_engine_background():
+    try:
+        await bert_engine.initialize_engine()
+    except Exception:
+        # Ошибка уже залогирована и отражена в bert_engine.state
+        pass
+
+def _ensure_engine_ready():
+    if not bert_engine.catalog_ready:
+        raise HTTPException(status_code=503, detail=f"Engine is not ready: {bert_engine.state}")
+
+def _engine_label() -> str:
+    return "bert_v2" if bert_engine.semantic_ready else "bert_v2_degraded"
 
 @app.get("/")
 async def root():
@@ -761,7 +1249,10 @@ async def health_check():
             "total_products": stats['total_products'],
             "available_products": stats['available_products'],
             "bert_engine": {
-                "initialized": bert_engine.model is not None,
+                "initialized": bert_engine.semantic_ready,
+                "model_loaded": bert_engine.model is not None,
+                "encoder_backend": bert_engine.config.ENCODER['backend'],
+                **bert_engine.status(),
                 "products_loaded": len(bert_engine.product_features),
                 "embeddings_generated": bert_engine.product_embeddings is not None
             },
@@ -770,8 +1261,22 @@ async def health_check():
     except Exception as e:
         return {"status": "unhealthy", "error": str(e)}
 
+@app.get("/health/live")
+async def liveness_check():
+    # Процесс жив и event loop отвечает, даже пока строятся эмбеддинги
+    return {"status": "alive", "state": bert_engine.state}
+
+@app.get("/health/ready")
+async def readiness_check():
+    # Готов принимать трафик, как только загружен каталог (в деградированном режиме - без семантики)
+    status = bert_engine.status()
+    if not bert_engine.catalog_ready:
+        return JSONResponse(status_code=503, content={"status": "not_ready", **status})
+    return {"status": "ready" if bert_engine.semantic_ready else "degraded", **status}
+
 @app.post("/api/recommendations", response_model=RecommendationResponse)
 async def get_recommendations(request: RecommendationRequest):
+    _ensure_engine_ready()
     try:
         logger.info(f"Getting BERT recommendations for user: {request.user_id}")
         
@@ -785,7 +1290,7 @@ async def get_recommendations(request: RecommendationRequest):
             user_id=request.user_id,
             recommendations_count=len(recommendations),
             recommendations=recommendations,
-            engine="bert_v2",
+            engine=_engine_label(),
             processing_time=processing_time,
             generated_at=datetime.now().isoformat()
         )
@@ -796,6 +1301,7 @@ async def get_recommendations(request: RecommendationRequest):
 
 @app.post("/api/bundle", response_model=BundleResponse)
 async def generate_bundle(request: BundleRequest):
+    _ensure_engine_ready()
     try:
         logger.info(f"Generating BERT-powered procurement bundle for user: {request.user_id}")
         
@@ -811,10 +1317,36 @@ async def generate_bundle(request: BundleRequest):
         
         return BundleResponse(**bundle)
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Bundle generation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/search", response_model=SearchResponse)
+async def search_products(request: SearchRequest):
+    query = request.query.strip()
+    if not query:
+        raise HTTPException(status_code=400, detail="Empty search query")
+    if not bert_engine.semantic_ready:
+        raise HTTPException(status_code=503, detail=f"Semantic search is not ready: {bert_engine.state}")
+    
+    try:
+        start_time = time.time()
+        limit = max(1, min(request.limit, bert_engine.config.SEARCH_MAX_LIMIT))
+        results = await bert_engine.search_products(query, limit)
+        
+        return SearchResponse(
+            query=query,
+            results_count=len(results),
+            results=results,
+            processing_time=time.time() - start_time
+        )
+        
+    except Exception as e:
+        logger.error(f"Semantic search error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/api/engine-info")
 async def get_engine_info():
     info = {
@@ -822,6 +1354,9 @@ async def get_engine_info():
         "embedding_dimension": bert_engine.config.EMBEDDING_DIM,
         "products_in_index": len(bert_engine.product_features),
         "user_profiles_loaded": len(bert_engine.user_profiles),
+        "engine_status": bert_engine.status(),
+        "query_encoder": bert_engine.query_encoder.stats,
+        "candidate_cache": {**bert_engine.candidate_cache.stats, "users": len(bert_engine.candidate_cache)},
         "weights_config": bert_engine.config.WEIGHTS
     }
     return info
@@ -0,0 +1,63 @@
+# candidate_cache.py - Короткоживущий кэш пулов кандидатов по пользователям
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class CandidateCache:
+    """Кэш посчитанных кандидатов (строки каталога, скоры, цены, категории).
+
+    /api/recommendations и /api/bundle с любой стратегией переранжируют один
+    и тот же пул, поэтому повторные вызовы в пределах TTL не ходят в БД и не
+    пересчитывают скоры. Одновременные запросы одного пользователя ждут одно
+    и то же вычисление. version отделяет пулы разных состояний движка
+    (например, до и после готовности эмбеддингов).
+    """
+
+    def __init__(self, ttl: float = 60.0, max_users: int = 1000):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.stats = {'hits': 0, 'misses': 0, 'shared': 0}
+        self._entries: OrderedDict = OrderedDict()
+        self._inflight: Dict[Tuple[str, Hashable], asyncio.Future] = {}
+
+    async def get_or_compute(self, user_id: str, version: Hashable,
+                             compute: Callable[[], Awaitable[Any]]) -> Any:
+        key = (user_id, version)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.stats['misses'] += 1
+            task = asyncio.ensure_future(compute())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done, key=key: self._on_done(key, done))
+        else:
+            self.stats['shared'] += 1
+
+        # shield: отмена одного запроса не отменяет расчет для остальных
+        return await asyncio.shield(task)
+
+    def _on_done(self, key: Tuple[str, Hashable], task: asyncio.Future):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, task.result())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: Optional[str] = None):
+        if user_id is None:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries if key[0] == user_id]:
+            del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
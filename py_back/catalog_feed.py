@@ -0,0 +1,242 @@
+# catalog_feed.py - Резидентный каталог товаров, обновляемый по PostgreSQL LISTEN/NOTIFY
+import asyncio
+import bisect
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogFeed:
+    """Снимок каталога в памяти процесса, который патчится по ленте изменений.
+
+    Триггеры в БД (server/DB.sql) шлют в канал product_id измененных товаров,
+    фид собирает уведомления пачкой (debounce) и перечитывает только эти
+    строки. Товары, которые перестали проходить фильтр загрузчика, удаляются.
+    Уведомление '*', слишком большая пачка и обрыв соединения приводят к
+    полной перезагрузке - пропущенные за время разрыва изменения не теряются.
+    Раз в resync_interval снимок сверяется полностью на всякий случай.
+
+    В памяти держится только окно из window лучших по sort_key товаров,
+    упорядоченное по (sort_key, product_id): патч переставляет только
+    измененные товары, выдача top-limit - проход по началу окна.
+    """
+
+    RELOAD = '*'
+
+    def __init__(self, load: Callable[..., Awaitable[List[Dict]]],
+                 connect: Callable[[], Awaitable[Any]], sort_key: Callable[[Dict], Any],
+                 dedupe_key: Optional[str] = None, channel: str = 'catalog_changes', window: Optional[int] = None,
+                 debounce: float = 0.5, max_delay: float = 5.0, reload_threshold: int = 20000,
+                 resync_interval: float = 3600, reconnect_delay: float = 5.0):
+        self._load = load
+        self._connect = connect
+        self.sort_key = sort_key
+        self.dedupe_key = dedupe_key
+        self.channel = channel
+        self.window = window
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.reload_threshold = reload_threshold
+        self.resync_interval = resync_interval
+        self.reconnect_delay = reconnect_delay
+
+        self.products: Dict[str, Dict] = {}
+        self.version = 0
+        self.ready = False
+        self.stats = {'full_reloads': 0, 'patches': 0, 'patched_products': 0, 'notifications': 0, 'reconnects': 0,
+                      'coalesced_reloads': 0}
+
+        # Окно, отсортированное по (sort_key, product_id); товары вне окна не лучше _boundary
+        self._order: List[tuple] = []
+        self._boundary = None
+        self._reloaded_version = 0
+
+        self._pending = set()
+        self._reload_requested = False
+        self._wakeup = asyncio.Event()
+        self._views: Dict[int, tuple] = {}
+        self._task = None
+
+    async def start(self) -> bool:
+        """Первая загрузка (дожидаемся) и фоновая подписка на изменения. False - снимок пока не загружен"""
+        first_load = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._run(first_load))
+        return await asyncio.shield(first_load)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def view(self, limit: int) -> List[Dict]:
+        """Top-limit товаров по sort_key без дубликатов по dedupe_key (пересчет только после изменений)"""
+        cached = self._views.get(limit)
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+
+        top, seen, last_key = [], set(), None
+        for key, product_id in self._order:
+            if len(top) >= limit:
+                break
+            product = self.products[product_id]
+            last_key = key
+            if self.dedupe_key:
+                if product[self.dedupe_key] in seen:
+                    continue
+                seen.add(product[self.dedupe_key])
+            top.append(product)
+
+        # Выдача точна, пока не залезает в товары на границе окна
+        if self._boundary is not None and (len(top) < limit or not last_key < self._boundary):
+            if self.version != self._reloaded_version:
+                self._request_reload()
+            else:
+                logger.warning(f"Catalog window of {self.window} products is too small for view({limit})")
+
+        self._views = {key: value for key, value in self._views.items() if value[0] == self.version}
+        self._views[limit] = (self.version, top)
+        return top
+
+    def _entries(self, products: Iterable[Dict]) -> List[tuple]:
+        return sorted((self.sort_key(product), product['product_id']) for product in products)
+
+    def _trim(self, products: Dict[str, Dict], order: List[tuple]):
+        """Обрезает окно до window товаров, сдвигая границу"""
+        if self.window is None or len(order) <= self.window:
+            return
+        evicted = order[self.window:]
+        del order[self.window:]
+        for _, product_id in evicted:
+            products.pop(product_id, None)
+        if self._boundary is None or evicted[0][0] < self._boundary:
+            self._boundary = evicted[0][0]
+
+    async def reload(self):
+        start_time = time.time()
+        products = await self._load(None, self.window)
+        # Сортировка окна - вне event loop
+        order = await asyncio.get_running_loop().run_in_executor(None, self._entries, products)
+        self.products = {product['product_id']: product for product in products}
+        self._order = order
+        self._boundary = None
+        if self.window is not None and len(order) >= self.window:
+            self._boundary = order[-1][0]
+        self.version += 1
+        self._reloaded_version = self.version
+        self.ready = True
+        self.stats['full_reloads'] += 1
+        logger.info(f"Catalog snapshot loaded: {len(self.products)} products in {time.time() - start_time:.2f}s")
+
+    async def apply_changes(self, product_ids: List[str]):
+        fresh = {product['product_id']: product for product in await self._load(product_ids)}
+        products = self.products
+        order = self._order
+        if len(product_ids) * 16 > len(order):
+            # Крупный патч: окно пересобирается целиком в executor, снимок подменяется после сортировки
+            products = dict(products)
+            for product_id in product_ids:
+                products.pop(product_id, None)
+            products.update(fresh)
+            order = await asyncio.get_running_loop().run_in_executor(None, self._entries, list(products.values()))
+        else:
+            for product_id in product_ids:
+                old = products.pop(product_id, None)
+                if old is not None:
+                    entry = (self.sort_key(old), product_id)
+                    position = bisect.bisect_left(order, entry)
+                    if position < len(order) and order[position] == entry:
+                        del order[position]
+                if product_id in fresh:
+                    products[product_id] = fresh[product_id]
+                    bisect.insort(order, (self.sort_key(fresh[product_id]), product_id))
+
+        self._trim(products, order)
+        self.products, self._order = products, order
+        self.version += 1
+        self.stats['patches'] += 1
+        self.stats['patched_products'] += len(product_ids)
+        logger.info(f"Catalog snapshot patched: {len(fresh)} updated, {len(product_ids) - len(fresh)} removed")
+
+    def _request_reload(self):
+        self._reload_requested = True
+        self._pending.clear()
+        self._wakeup.set()
+
+    def _on_notification(self, connection, pid, channel, payload):
+        self.stats['notifications'] += 1
+        # Будим консьюмер и при уже запрошенной перезагрузке: пачка продолжается, пауза сдвигается
+        self._wakeup.set()
+        if self._reload_requested:
+            return
+        if payload == self.RELOAD:
+            self._request_reload()
+            return
+        self._pending.add(payload)
+        if len(self._pending) > self.reload_threshold:
+            # Массовый пересчет (product_stats, бэкфилл) дешевле перечитать целиком, чем патчить
+            self.stats['coalesced_reloads'] += 1
+            self._request_reload()
+
+    async def _run(self, first_load: asyncio.Future):
+        while True:
+            conn = None
+            try:
+                conn = await self._connect()
+                conn.add_termination_listener(lambda _: self._wakeup.set())
+                # Подписка до загрузки: изменения во время загрузки придут уведомлениями
+                await conn.add_listener(self.channel, self._on_notification)
+                await self.reload()
+                if not first_load.done():
+                    first_load.set_result(True)
+                await self._consume(conn)
+                logger.warning("Catalog change feed connection lost, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Catalog change feed error: {e}")
+                if not first_load.done():
+                    # Сервис стартует и без снимка, подписка будет повторена
+                    first_load.set_result(False)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+
+            self.stats['reconnects'] += 1
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _consume(self, conn):
+        deadline = time.monotonic() + self.resync_interval
+        while not conn.is_closed():
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                self._reload_requested = True
+            if conn.is_closed():
+                break
+
+            # Собираем пачку уведомлений: ждем паузы в debounce секунд, но не дольше max_delay
+            burst_deadline = time.monotonic() + self.max_delay
+            while not conn.is_closed():
+                self._wakeup.clear()
+                timeout = min(self.debounce, burst_deadline - time.monotonic())
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            if self._reload_requested:
+                self._reload_requested = False
+                self._pending.clear()
+                await self.reload()
+                deadline = time.monotonic() + self.resync_interval
+            elif self._pending:
+                product_ids, self._pending = list(self._pending), set()
+                await self.apply_changes(product_ids)
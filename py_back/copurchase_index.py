@@ -0,0 +1,221 @@
+# copurchase_index.py - Индекс совместных покупок (item-to-item collaborative filtering)
+import json
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+
+class CoPurchaseIndex:
+    """Разреженная матрица item×item по корзинам закупок (procurement_id).
+
+    counts - сырые совместные встречаемости (без диагонали), item_counts -
+    число корзин с товаром. Из них строится нормированная (cosine или lift)
+    матрица scores с top-K соседями в строке. Новые закупки и поздние позиции
+    уже учтенных закупок добавляются дельтой к counts, scores пересчитываются
+    только в затронутых строках.
+    """
+
+    NORMALIZATIONS = ('cosine', 'lift')
+
+    def __init__(self, normalization: str = 'cosine', top_k: int = 100, min_count: int = 1):
+        if normalization not in self.NORMALIZATIONS:
+            raise ValueError(f"Unknown normalization: {normalization}")
+        self.normalization = normalization
+        self.top_k = top_k
+        self.min_count = min_count
+        self.item_ids: List[str] = []
+        self.item_to_index: Dict[str, int] = {}
+        self.item_counts = np.zeros(0, dtype=np.int64)
+        self.n_baskets = 0
+        self.counts = sparse.csr_matrix((0, 0), dtype=np.float64)
+        self.scores = sparse.csr_matrix((0, 0), dtype=np.float32)
+        self._basket_items: Dict[str, frozenset] = {}
+
+    def __len__(self) -> int:
+        return len(self.item_ids)
+
+    def _incidence(self, rows: List[List[int]]) -> sparse.csr_matrix:
+        """Бинарная матрица корзина×товар по спискам индексов товаров"""
+        indptr = np.cumsum([0] + [len(columns) for columns in rows], dtype=np.int64)
+        indices = np.fromiter((column for columns in rows for column in columns), dtype=np.int64, count=indptr[-1])
+        return sparse.csr_matrix((np.ones(len(indices), dtype=np.float64), indices, indptr),
+                                 shape=(len(rows), len(self.item_ids)))
+
+    def add_baskets(self, baskets: Dict[str, Iterable[str]]) -> int:
+        """Добавить корзины {procurement_id: [product_id, ...]}.
+
+        Для уже учтенных корзин добавляются только новые позиции (поздно
+        закоммиченные строки закупки), повторно прочитанные не учитываются.
+        Возвращает число изменившихся корзин.
+        """
+        new_rows, old_rows, n_new_baskets = [], [], 0
+        for bid, items in baskets.items():
+            columns = {self.item_to_index.setdefault(item, len(self.item_to_index)) for item in items}
+            known = self._basket_items.get(bid)
+            if known is None:
+                n_new_baskets += 1
+                known = frozenset()
+            added = columns - known
+            if not added:
+                continue
+            new_rows.append(sorted(added))
+            old_rows.append(sorted(known))
+            self._basket_items[bid] = known | added
+
+        for item in list(self.item_to_index)[len(self.item_ids):]:
+            self.item_ids.append(item)
+        if not new_rows:
+            return 0
+
+        n_items = len(self.item_ids)
+        added_incidence = self._incidence(new_rows)
+        known_incidence = self._incidence(old_rows)
+
+        # f·fᵀ - o·oᵀ = n·nᵀ + n·oᵀ + o·nᵀ, где f = o + n (старые и новые позиции корзины)
+        cross = (added_incidence.T @ known_incidence).tocsr()
+        delta = (added_incidence.T @ added_incidence + cross + cross.T).tocsr()
+        basket_counts = np.asarray(delta.diagonal()).astype(np.int64)
+        delta.setdiag(0)
+        delta.eliminate_zeros()
+
+        counts = self.counts
+        if counts.shape[0] < n_items:
+            counts = sparse.csr_matrix((counts.data, counts.indices, counts.indptr), shape=counts.shape)
+            counts.resize((n_items, n_items))
+        self.counts = (counts + delta).tocsr()
+
+        item_counts = np.zeros(n_items, dtype=np.int64)
+        item_counts[:len(self.item_counts)] = self.item_counts
+        self.item_counts = item_counts + basket_counts
+        previous_baskets = self.n_baskets
+        self.n_baskets += n_new_baskets
+
+        self._renormalize(np.flatnonzero(basket_counts), previous_baskets)
+        logger.info(f"Co-purchase index: {len(new_rows)} baskets changed (+{n_new_baskets} new), "
+                    f"{self.n_baskets} total, {n_items} items, {self.scores.nnz} pairs after pruning")
+        return len(new_rows)
+
+    def _renormalize(self, touched: np.ndarray, previous_baskets: int):
+        """Пересчет scores только для строк, которые задевает дельта.
+
+        Изменились n_i затронутых товаров, поэтому пересчитываются их строки и
+        строки всех их соседей (в них поменялись значения в столбцах touched,
+        и top_k мог сдвинуться). Для lift остальные строки лишь умножаются на
+        общий множитель n_baskets - порядок внутри строки не меняется.
+        """
+        n_items = self.counts.shape[0]
+        if previous_baskets == 0 or len(touched) > n_items // 2:
+            return self._normalize()
+
+        affected = np.zeros(n_items, dtype=bool)
+        affected[touched] = True
+        affected[self.counts[touched].indices] = True
+        rows = np.flatnonzero(affected)
+
+        scores = self.scores.tocoo()
+        keep = ~affected[scores.row]
+        kept_values = scores.data[keep]
+        if self.normalization == 'lift':
+            kept_values = kept_values * np.float32(self.n_baskets / previous_baskets)
+
+        recomputed = self._score_rows(rows).tocoo()
+        self.scores = sparse.csr_matrix(
+            (np.concatenate([kept_values, recomputed.data]),
+             (np.concatenate([scores.row[keep], rows[recomputed.row]]),
+              np.concatenate([scores.col[keep], recomputed.col]))),
+            shape=(n_items, n_items))
+
+    def _normalize(self):
+        self.scores = self._score_rows(np.arange(self.counts.shape[0]))
+
+    def _score_rows(self, rows: np.ndarray) -> sparse.csr_matrix:
+        """Нормированные и обрезанные до top_k строки rows (матрица len(rows)×n_items)"""
+        counts = self.counts[rows].tocoo()
+        keep = counts.data >= self.min_count
+        row, cols, values = counts.row[keep], counts.col[keep], counts.data[keep]
+
+        n_i = self.item_counts[rows[row]].astype(np.float64)
+        n_j = self.item_counts[cols].astype(np.float64)
+        if self.normalization == 'cosine':
+            values = values / np.sqrt(n_i * n_j)
+        else:
+            values = values * self.n_baskets / (n_i * n_j)
+
+        scores = sparse.csr_matrix((values.astype(np.float32), (row, cols)), shape=(len(rows), self.counts.shape[1]))
+        return self._prune(scores)
+
+    def _prune(self, matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+        """Оставляет top_k значений в каждой строке"""
+        row_nnz = np.diff(matrix.indptr)
+        if self.top_k is None or not len(row_nnz) or row_nnz.max() <= self.top_k:
+            return matrix
+
+        # Сортировка по (строка, -значение) и ранг внутри строки - без цикла по строкам
+        rows = np.repeat(np.arange(matrix.shape[0]), row_nnz)
+        order = np.lexsort((-matrix.data, rows))
+        rank = np.arange(matrix.nnz) - matrix.indptr[rows[order]]
+        keep = np.sort(order[rank < self.top_k])
+        return sparse.csr_matrix((matrix.data[keep], (rows[keep], matrix.indices[keep])), shape=matrix.shape)
+
+    def history_vector(self, history: Dict[str, float]) -> Optional[sparse.csr_matrix]:
+        """Разреженная строка весов истории пользователя (None, если товаров нет в индексе)"""
+        columns = [(self.item_to_index[item], weight) for item, weight in history.items() if item in self.item_to_index]
+        if not columns:
+            return None
+        cols, weights = zip(*columns)
+        return sparse.csr_matrix((np.array(weights, dtype=np.float32), (np.zeros(len(cols), dtype=np.int64), cols)),
+                                 shape=(1, len(self.item_ids)))
+
+    def score_history(self, history: Dict[str, float]) -> Optional[np.ndarray]:
+        """CF-скоры всех товаров индекса: сумма строк scores по истории (одно sparse-умножение)"""
+        vector = self.history_vector(history)
+        if vector is None:
+            return None
+        return np.asarray((vector @ self.scores).todense()).ravel()
+
+    def similar_items(self, item_id: str, k: int = 10) -> List[Tuple[str, float]]:
+        if item_id not in self.item_to_index:
+            return []
+        row = self.scores.getrow(self.item_to_index[item_id])
+        order = np.argsort(-row.data, kind='stable')[:k]
+        return [(self.item_ids[row.indices[i]], float(row.data[i])) for i in order]
+
+    def save(self, path: str):
+        counts = self.counts.tocsr()
+        basket_ids = sorted(self._basket_items)
+        params = {'normalization': self.normalization, 'top_k': self.top_k, 'min_count': self.min_count}
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                params=np.array(json.dumps(params)),
+                item_ids=np.array(self.item_ids, dtype=str),
+                item_counts=self.item_counts,
+                n_baskets=np.array(self.n_baskets),
+                counts_data=counts.data, counts_indices=counts.indices, counts_indptr=counts.indptr,
+                basket_ids=np.array(basket_ids, dtype=str),
+                basket_indptr=np.cumsum([0] + [len(self._basket_items[bid]) for bid in basket_ids], dtype=np.int64),
+                basket_indices=np.array([i for bid in basket_ids for i in sorted(self._basket_items[bid])], dtype=np.int64)
+            )
+
+    @classmethod
+    def load(cls, path: str) -> 'CoPurchaseIndex':
+        with np.load(path, allow_pickle=False) as data:
+            index = cls(**json.loads(str(data['params'])))
+            index.item_ids = data['item_ids'].tolist()
+            index.item_to_index = {item: i for i, item in enumerate(index.item_ids)}
+            index.item_counts = data['item_counts']
+            index.n_baskets = int(data['n_baskets'])
+            n_items = len(index.item_ids)
+            index.counts = sparse.csr_matrix(
+                (data['counts_data'], data['counts_indices'], data['counts_indptr']), shape=(n_items, n_items))
+            indptr, indices = data['basket_indptr'], data['basket_indices']
+            index._basket_items = {
+                bid: frozenset(indices[indptr[i]:indptr[i + 1]].tolist())
+                for i, bid in enumerate(data['basket_ids'].tolist())
+            }
+        index._normalize()
+        return index
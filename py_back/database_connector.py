@@ -1,167 +1,520 @@
 import asyncpg
 import asyncio
-from typing import List, Dict, Any
+import time
+from typing import List, Dict, Any, AsyncIterator, Iterable, Optional
 import logging
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
+DB_CONFIG = {
+    'user': 'store_app1',
+    'host': 'localhost',
+    'database': 'pc_db',
+    'password': '1234',
+    'port': 5432
+}
+
+class CategoryCache:
+    """Вся таблица categories в памяти: названия, родители и пути в иерархии"""
+    
+    DEFAULT_NAME = "Другое"
+    
+    def __init__(self):
+        self.categories: Dict[str, Dict] = {}
+        self.loaded_at = 0.0
+        self.version = 0
+    
+    def load(self, rows: Iterable):
+        categories = {
+            str(row['category_id']): {
+                'name': row['name'],
+                'parent_id': str(row['parent_category_id']) if row['parent_category_id'] else None,
+                'level': row['level']
+            }
+            for row in rows
+        }
+        
+        for category in categories.values():
+            # Путь от корня по родительским ссылкам (с защитой от циклов)
+            path, seen, current = [], set(), category
+            while current is not None and id(current) not in seen:
+                seen.add(id(current))
+                path.append(current['name'])
+                current = categories.get(current['parent_id'])
+            category['path'] = path[::-1]
+        
+        self.categories = categories
+        self.loaded_at = time.monotonic()
+        self.version += 1
+    
+    def name(self, category_id) -> str:
+        category = self.categories.get(str(category_id)) if category_id else None
+        return category['name'] if category else self.DEFAULT_NAME
+    
+    def path(self, category_id) -> List[str]:
+        category = self.categories.get(str(category_id)) if category_id else None
+        return category['path'] if category else [self.DEFAULT_NAME]
+    
+    def resolve(self, category_ids: Iterable) -> List[str]:
+        return [self.name(category_id) for category_id in category_ids]
+    
+    def resolve_column(self, category_ids: np.ndarray):
+        """Колонка ID -> (названия уникальных ID, код каждой строки): одно обращение на категорию, а не на товар"""
+        codes: Dict[Any, int] = {}
+        inverse = np.fromiter((codes.setdefault(category_id, len(codes)) for category_id in category_ids.tolist()),
+                              dtype=np.int64, count=len(category_ids))
+        return np.array(self.resolve(codes), dtype=object), inverse
+    
+    def __len__(self) -> int:
+        return len(self.categories)
+
+def _column_array(values: List) -> np.ndarray:
+    """Колонка пачки в массив: int без NULL - int64, float - float64 (NULL -> nan), остальное - object.
+
+    Целые с NULL остаются object с None: в float64 они стали бы nan у построчных потребителей.
+    """
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, bool) for value in present):
+        return np.array(values, dtype=bool) if len(present) == len(values) else np.array(values, dtype=object)
+    if present and all(isinstance(value, int) and not isinstance(value, bool) for value in present):
+        if len(present) == len(values):
+            return np.array(values, dtype=np.int64)
+    elif present and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    # fromiter не разворачивает вложенные списки (jsonb) во второе измерение
+    return np.fromiter(values, dtype=object, count=len(values))
+
+def _column_values(column: np.ndarray) -> List:
+    """Колонка обратно в список значений: nan float-колонки - снова None, как в asyncpg.Record"""
+    values = column.tolist()
+    if column.dtype.kind == 'f' and np.isnan(column).any():
+        values = [None if value != value else value for value in values]
+    return values
+
+def records_to_columns(records: List) -> Dict[str, np.ndarray]:
+    """Пачка asyncpg.Record -> словарь колонок"""
+    if not records:
+        return {}
+    return {
+        name: _column_array([record[i] for record in records])
+        for i, name in enumerate(records[0].keys())
+    }
+
+def concat_columns(chunks: List[Dict[str, np.ndarray]], names: Iterable[str] = ()) -> Dict[str, np.ndarray]:
+    """Склейка пачек колонок; для пустого результата - пустые колонки names"""
+    if not chunks:
+        return {name: np.empty(0, dtype=object) for name in names}
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+class PreparedConnection(asyncpg.Connection):
+    """Соединение пула, которое держит подготовленные именованные запросы DatabaseConnector"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.named_statements: Dict[str, Any] = {}
+        self.statements_generation = 0
+    
+    async def named_statement(self, name: str, sql: str, generation: int = 0):
+        """Подготовленный запрос: PREPARE один раз на соединение, дальше только bind/execute.
+        
+        generation - поколение схемы у владельца пула: при его смене запросы готовятся заново.
+        """
+        if generation != self.statements_generation:
+            self.named_statements.clear()
+            self.statements_generation = generation
+        statement = self.named_statements.get(name)
+        if statement is None:
+            statement = self.named_statements[name] = await self.prepare(sql)
+        return statement
+
 class DatabaseConnector:
+    # Страховочный TTL кэша категорий, если уведомления об изменениях недоступны
+    CATEGORY_CACHE_MAX_AGE = 600
+    CATEGORY_CHANGES_CHANNEL = 'catalog_changes'  # '*' шлет триггер на categories (server/DB.sql)
+    # Строк в одной пачке серверного курсора
+    FETCH_CHUNK_SIZE = 2000
+    # Сколько результатов именованных запросов держать в кэше
+    QUERY_CACHE_MAX_ENTRIES = 256
+    
+    AVAILABLE_PRODUCTS_QUERY = """
+    SELECT 
+        product_id, 
+        name, 
+        description, 
+        category_id,
+        manufacturer, 
+        COALESCE(average_price, 0)::float8 as average_price, 
+        unit_of_measure,
+        specifications,
+        is_available
+    FROM products 
+    WHERE is_available = true
+    AND average_price > 0
+    AND name IS NOT NULL
+    ORDER BY average_price DESC
+    LIMIT $1
+    """
+    
+    USER_PROCUREMENTS_QUERY = """
+    SELECT 
+        p.procurement_id,
+        pi.product_id,
+        pr.name as product_name,
+        pr.category_id,
+        c.name as category_name,
+        pi.quantity,
+        COALESCE(pi.unit_price, 0)::float8 as unit_price,
+        COALESCE(pr.average_price, 0)::float8 as average_price,
+        p.procurement_date
+    FROM procurements p
+    JOIN procurement_items pi ON p.procurement_id = pi.procurement_id
+    JOIN products pr ON pi.product_id = pr.product_id
+    LEFT JOIN categories c ON pr.category_id = c.category_id
+    WHERE p.user_id = $1
+    ORDER BY p.procurement_date DESC
+    LIMIT 1000
+    """
+    
+    POPULAR_PRODUCTS_QUERY = """
+    SELECT 
+        p.product_id,
+        p.name,
+        p.average_price::float8 as average_price,
+        p.category_id,
+        COUNT(pi.procurement_item_id) as purchase_count
+    FROM products p
+    JOIN procurement_items pi ON p.product_id = pi.product_id
+    WHERE p.is_available = true
+    GROUP BY p.product_id, p.name, p.average_price, p.category_id
+    ORDER BY purchase_count DESC
+    LIMIT $1
+    """
+    
+    PURCHASE_EVENTS_QUERY = """
+    SELECT 
+        pi.procurement_item_id,
+        pi.product_id,
+        EXTRACT(EPOCH FROM COALESCE(p.procurement_date::timestamp, pi.created_at))::float8 as event_time,
+        pi.created_at
+    FROM procurement_items pi
+    LEFT JOIN procurements p ON p.procurement_id = pi.procurement_id
+    WHERE pi.product_id IS NOT NULL
+    AND COALESCE(p.procurement_date::timestamp, pi.created_at) IS NOT NULL
+    AND ($1::timestamp IS NULL OR pi.created_at > $1)
+    """
+    
+    CATEGORIES_QUERY = "SELECT category_id, parent_category_id, name, level FROM categories"
+    
+    # Именованные запросы: ttl - секунды жизни результата в кэше (0 - не кэшировать),
+    # tables - ключи инвалидации, columns - колонки пустого результата
+    QUERIES = {
+        'available_products': {
+            'sql': AVAILABLE_PRODUCTS_QUERY,
+            'ttl': 300,
+            'tables': ('products',),
+            'columns': ('product_id', 'name', 'description', 'category_id', 'manufacturer',
+                        'average_price', 'unit_of_measure', 'specifications', 'is_available')
+        },
+        'popular_products': {
+            'sql': POPULAR_PRODUCTS_QUERY,
+            'ttl': 600,  # новые позиции закупок уведомлений не шлют, остается только TTL
+            'tables': ('products', 'procurement_items'),
+            'columns': ('product_id', 'name', 'average_price', 'category_id', 'purchase_count')
+        },
+        'user_procurements': {
+            'sql': USER_PROCUREMENTS_QUERY,
+            'ttl': 0,
+            'tables': ('procurements', 'procurement_items', 'products', 'categories'),
+            'columns': ('procurement_id', 'product_id', 'product_name', 'category_id', 'category_name',
+                        'quantity', 'unit_price', 'average_price', 'procurement_date')
+        },
+        'purchase_events': {
+            'sql': PURCHASE_EVENTS_QUERY,
+            'ttl': 0,
+            'tables': ('procurement_items',),
+            'columns': ('procurement_item_id', 'product_id', 'event_time', 'created_at')
+        },
+        'categories': {
+            'sql': CATEGORIES_QUERY,
+            'ttl': 0,  # сам справочник кэширует CategoryCache
+            'tables': ('categories',),
+            'columns': ('category_id', 'parent_category_id', 'name', 'level')
+        }
+    }
+    
     def __init__(self):
         self.pool = None
+        self.categories = CategoryCache()
+        self._categories_lock = asyncio.Lock()
+        self._listener = None
+        
+        # (имя запроса, аргументы) -> (истекает, колонки)
+        self._results: Dict[tuple, tuple] = {}
+        # Поколение кэша: результат, начатый до инвалидации, в кэш не попадает
+        self._cache_generation = 0
+        # Поколение подготовленных запросов: растет при изменении схемы, сбрасывает их на всех соединениях
+        self._statement_generation = 0
+        self._query_stats = {name: self._empty_query_stats() for name in self.QUERIES}
         
     async def connect(self):
         """Подключение к PostgreSQL БД"""
         try:
-            self.pool = await asyncpg.create_pool(
-                user='store_app1',
-                host='localhost',
-                database='pc_db',
-                password='1234',
-                port=5432,
-                min_size=1,
-                max_size=10
-            )
+            self.pool = await asyncpg.create_pool(**DB_CONFIG, min_size=1, max_size=10,
+                                                  connection_class=PreparedConnection)
             logger.info("✅ Successfully connected to PostgreSQL database")
         except Exception as e:
             logger.error(f"❌ Database connection error: {e}")
             raise
+        
+        await self.refresh_categories()
+        await self._listen_category_changes()
     
-    async def get_user_procurements(self, user_id: str) -> List[Dict]:
-        """Получить историю закупок пользователя"""
+    async def close(self):
+        self.log_query_stats()
+        if self._listener is not None and not self._listener.is_closed():
+            await self._listener.close()
+        if self.pool is not None:
+            await self.pool.close()
+    
+    async def refresh_categories(self):
+        """Перезагрузка справочника категорий целиком"""
+        async with self._categories_lock:
+            rows = self._column_records(await self.query('categories'))
+            self.categories.load(rows)
+        logger.info(f"🗂 Loaded {len(self.categories)} categories into cache")
+    
+    async def _listen_category_changes(self):
         try:
-            query = """
-            SELECT 
-                p.procurement_id,
-                pi.product_id,
-                pi.quantity,
-                pi.unit_price,
-                pr.name as product_name,
-                pr.category_id,
-                c.name as category_name,
-                pr.average_price,
-                p.procurement_date
-            FROM procurements p
-            JOIN procurement_items pi ON p.procurement_id = pi.procurement_id
-            JOIN products pr ON pi.product_id = pr.product_id
-            LEFT JOIN categories c ON pr.category_id = c.category_id
-            WHERE p.user_id = $1
-            ORDER BY p.procurement_date DESC
-            LIMIT 1000
-            """
-            
-            rows = await self.pool.fetch(query, user_id)
-            
-            # Преобразуем в список словарей
-            procurements = []
-            for row in rows:
-                procurements.append({
-                    'procurement_id': row['procurement_id'],
-                    'product_id': row['product_id'],
-                    'product_name': row['product_name'],
-                    'category_id': row['category_id'],
-                    'category_name': row['category_name'],
-                    'quantity': row['quantity'],
-                    'unit_price': float(row['unit_price']) if row['unit_price'] else 0,
-                    'average_price': float(row['average_price']) if row['average_price'] else 0,
-                    'procurement_date': row['procurement_date']
-                })
-            
-            logger.info(f"📊 Loaded {len(procurements)} procurement items for user {user_id}")
-            return procurements
+            self._listener = await asyncpg.connect(**DB_CONFIG)
+            await self._listener.add_listener(self.CATEGORY_CHANGES_CHANNEL, self._on_catalog_change)
+        except Exception as e:
+            self._listener = None
+            logger.warning(f"Category change notifications unavailable, using TTL refresh: {e}")
+    
+    def _on_catalog_change(self, connection, pid, channel, payload):
+        if payload == '*':
+            self.invalidate('categories')
+            asyncio.ensure_future(self.refresh_categories())
+        else:
+            # Остальные уведомления - product_id измененного товара
+            self.invalidate('products')
+    
+    async def _ensure_categories(self):
+        listening = self._listener is not None and not self._listener.is_closed()
+        stale = time.monotonic() - self.categories.loaded_at > self.CATEGORY_CACHE_MAX_AGE
+        if not len(self.categories) or (stale and not listening):
+            try:
+                await self.refresh_categories()
+            except Exception as e:
+                logger.error(f"Error refreshing categories: {e}")
+    
+    async def resolve_category_names(self, category_ids: Iterable) -> List[str]:
+        """Названия категорий для списка ID одним обращением к кэшу"""
+        await self._ensure_categories()
+        return self.categories.resolve(category_ids)
+    
+    async def resolve_category_column(self, category_ids: np.ndarray):
+        """Колоночный вариант resolve_category_names: (названия уникальных категорий, коды строк)"""
+        await self._ensure_categories()
+        return self.categories.resolve_column(category_ids)
+    
+    async def get_category_path(self, category_id: str) -> List[str]:
+        """Путь категории от корня иерархии"""
+        await self._ensure_categories()
+        return self.categories.path(category_id)
+    
+    async def stream_columns(self, query: str, *args, chunk_size: Optional[int] = None) -> AsyncIterator[Dict[str, np.ndarray]]:
+        """Результат запроса пачками через серверный курсор, каждая пачка - словарь колонок.
+        
+        query - имя из QUERIES (подготовленный на соединении запрос) или текст SQL.
+        Весь результат не материализуется ни в asyncpg, ни в Python: в памяти одна пачка Record.
+        """
+        async with self.pool.acquire() as conn:
+            # Курсор на стороне сервера живет только внутри транзакции
+            async with conn.transaction(readonly=True):
+                if query in self.QUERIES:
+                    try:
+                        statement = await conn.named_statement(query, self.QUERIES[query]['sql'],
+                                                               self._statement_generation)
+                        cursor = await statement.cursor(*args)
+                        records = await cursor.fetch(chunk_size or self.FETCH_CHUNK_SIZE)
+                    except asyncpg.exceptions.InvalidCachedStatementError:
+                        # Схема таблиц изменилась - все соединения пула подготовят запросы заново
+                        self._statement_generation += 1
+                        raise
+                else:
+                    cursor = await conn.cursor(query, *args)
+                    records = await cursor.fetch(chunk_size or self.FETCH_CHUNK_SIZE)
+                
+                while records:
+                    yield records_to_columns(records)
+                    records = await cursor.fetch(chunk_size or self.FETCH_CHUNK_SIZE)
+    
+    @staticmethod
+    def _empty_query_stats() -> Dict:
+        return {'calls': 0, 'cache_hits': 0, 'db_calls': 0, 'errors': 0, 'rows': 0, 'total_time': 0.0, 'max_time': 0.0}
+    
+    async def query(self, name: str, *args) -> Dict[str, np.ndarray]:
+        """Именованный запрос колонками: подготовленный на соединении, с кэшем результата на ttl.
+        
+        Колонки из кэша общие для всех вызывающих - их нельзя менять на месте.
+        """
+        spec = self.QUERIES[name]
+        stats = self._query_stats[name]
+        stats['calls'] += 1
+        
+        key = (name, args)
+        if spec['ttl'] > 0:
+            cached = self._results.get(key)
+            if cached is not None:
+                if cached[0] > time.monotonic():
+                    stats['cache_hits'] += 1
+                    return cached[1]
+                # Просроченный результат не держим до вытеснения
+                del self._results[key]
+        
+        generation = self._cache_generation
+        start_time = time.perf_counter()
+        try:
+            try:
+                columns = await self.fetch_columns(name, *args, names=spec['columns'])
+            except asyncpg.exceptions.InvalidCachedStatementError:
+                columns = await self.fetch_columns(name, *args, names=spec['columns'])
+        except Exception:
+            stats['errors'] += 1
+            raise
+        
+        elapsed = time.perf_counter() - start_time
+        stats['db_calls'] += 1
+        stats['rows'] += len(next(iter(columns.values()), ()))
+        stats['total_time'] += elapsed
+        stats['max_time'] = max(stats['max_time'], elapsed)
+        
+        if spec['ttl'] > 0 and generation == self._cache_generation:
+            now = time.monotonic()
+            self._results = {k: v for k, v in self._results.items() if v[0] > now and k != key}
+            self._results[key] = (now + spec['ttl'], columns)
+            while len(self._results) > self.QUERY_CACHE_MAX_ENTRIES:
+                # Вытесняем самый давно сохраненный результат
+                self._results.pop(next(iter(self._results)))
+        return columns
+    
+    def invalidate(self, *tables: str):
+        """Сброс кэшированных результатов запросов, читающих эти таблицы (без аргументов - всех)"""
+        self._cache_generation += 1
+        self._results = {
+            key: value for key, value in self._results.items()
+            if tables and not set(tables) & set(self.QUERIES[key[0]]['tables'])
+        }
+    
+    def query_stats(self) -> Dict[str, Dict]:
+        """Время, число вызовов, попаданий в кэш и строк по каждому именованному запросу"""
+        return {
+            name: {
+                **stats,
+                'avg_ms': round(stats['total_time'] / stats['db_calls'] * 1000, 2) if stats['db_calls'] else 0.0,
+                'hit_rate': round(stats['cache_hits'] / stats['calls'], 3) if stats['calls'] else 0.0
+            }
+            for name, stats in self._query_stats.items()
+        }
+    
+    def log_query_stats(self):
+        for name, stats in sorted(self.query_stats().items(), key=lambda item: -item[1]['total_time']):
+            if stats['calls']:
+                logger.info(f"🧮 {name}: {stats['calls']} calls, hit rate {stats['hit_rate']:.0%}, "
+                            f"{stats['db_calls']} db calls avg {stats['avg_ms']:.1f} ms "
+                            f"(max {stats['max_time'] * 1000:.1f} ms), {stats['rows']} rows")
+    
+    async def fetch_columns(self, query: str, *args, names: Iterable[str] = (),
+                            chunk_size: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """Весь результат запроса колонками (names - колонки пустого результата)"""
+        chunks = [chunk async for chunk in self.stream_columns(query, *args, chunk_size=chunk_size)]
+        return concat_columns(chunks, names)
+    
+    async def stream_record_batches(self, query: str, *args, chunk_size: Optional[int] = None):
+        """То же, что stream_columns, но пачками pyarrow.RecordBatch"""
+        try:
+            import pyarrow as pa
+        except ImportError as e:
+            raise ImportError("record batches require the pyarrow package") from e
+        
+        async for chunk in self.stream_columns(query, *args, chunk_size=chunk_size):
+            yield pa.RecordBatch.from_pydict({
+                # object-колонки (UUID, даты, jsonb) pyarrow разбирает сам по значениям
+                name: column.tolist() if column.dtype == object else column
+                for name, column in chunk.items()
+            })
+    
+    @staticmethod
+    def _column_records(columns: Dict[str, np.ndarray]) -> List[Dict]:
+        """Колонки -> список словарей (для старых потребителей построчного API)"""
+        names = list(columns)
+        return [dict(zip(names, row)) for row in zip(*(_column_values(columns[name]) for name in names))]
+    
+    async def get_user_procurements_columns(self, user_id: str) -> Dict[str, np.ndarray]:
+        """История закупок пользователя колонками"""
+        try:
+            columns = await self.query('user_procurements', user_id)
+            logger.info(f"📊 Loaded {len(columns['product_id'])} procurement items for user {user_id}")
+            return columns
             
         except Exception as e:
             logger.error(f"Error getting user procurements: {e}")
+            raise
+    
+    async def get_user_procurements(self, user_id: str) -> List[Dict]:
+        """Получить историю закупок пользователя"""
+        try:
+            return self._column_records(await self.get_user_procurements_columns(user_id))
+        except Exception:
             return []
     
-    async def get_available_products(self, limit: int = 15000) -> List[Dict]:
-        """Получить доступные товары с реальными ценами"""
+    async def get_available_products_columns(self, limit: int = 15000) -> Dict[str, np.ndarray]:
+        """Доступные товары колонками (average_price - float64)"""
         try:
-            query = """
-            SELECT 
-                product_id, 
-                name, 
-                description, 
-                category_id,
-                manufacturer, 
-                average_price, 
-                unit_of_measure,
-                specifications,
-                is_available
-            FROM products 
-            WHERE is_available = true
-            AND average_price > 0
-            AND name IS NOT NULL
-            ORDER BY average_price DESC
-            LIMIT $1
-            """
-            
-            rows = await self.pool.fetch(query, limit)
-            
-            products = []
-            for row in rows:
-                products.append({
-                    'product_id': row['product_id'],
-                    'name': row['name'],
-                    'description': row['description'],
-                    'category_id': row['category_id'],
-                    'manufacturer': row['manufacturer'],
-                    'average_price': float(row['average_price']) if row['average_price'] else 0,
-                    'unit_of_measure': row['unit_of_measure'],
-                    'specifications': row['specifications'],
-                    'is_available': row['is_available']
-                })
-            
-            logger.info(f"📦 Loaded {len(products)} available products from database")
-            return products
+            columns = await self.query('available_products', limit)
+            logger.info(f"📦 Loaded {len(columns['product_id'])} available products from database")
+            return columns
             
         except Exception as e:
             logger.error(f"Error getting available products: {e}")
+            raise
+    
+    async def get_available_products(self, limit: int = 15000) -> List[Dict]:
+        """Получить доступные товары с реальными ценами"""
+        try:
+            return self._column_records(await self.get_available_products_columns(limit))
+        except Exception:
             return []
     
     async def get_category_name(self, category_id: str) -> str:
         """Получить название категории по ID"""
-        if not category_id:
-            return "Другое"
-            
-        try:
-            query = "SELECT name FROM categories WHERE category_id = $1"
-            row = await self.pool.fetchrow(query, category_id)
-            return row['name'] if row else "Другое"
-        except:
-            return "Другое"
+        await self._ensure_categories()
+        return self.categories.name(category_id)
     
-    async def get_popular_products(self, limit: int = 100) -> List[Dict]:
-        """Получить популярные товары (часто закупаемые)"""
+    async def get_purchase_events(self, since: Optional[Any] = None) -> List[Dict]:
+        """Позиции закупок как события покупки: время - дата закупки или время добавления позиции"""
         try:
-            query = """
-            SELECT 
-                p.product_id,
-                p.name,
-                p.average_price,
-                p.category_id,
-                COUNT(pi.procurement_item_id) as purchase_count
-            FROM products p
-            JOIN procurement_items pi ON p.product_id = pi.product_id
-            WHERE p.is_available = true
-            GROUP BY p.product_id, p.name, p.average_price, p.category_id
-            ORDER BY purchase_count DESC
-            LIMIT $1
-            """
+            return self._column_records(await self.query('purchase_events', since))
             
-            rows = await self.pool.fetch(query, limit)
-            
-            popular_products = []
-            for row in rows:
-                popular_products.append({
-                    'product_id': row['product_id'],
-                    'name': row['name'],
-                    'average_price': float(row['average_price']),
-                    'category_id': row['category_id'],
-                    'purchase_count': row['purchase_count']
-                })
-            
-            return popular_products
+        except Exception as e:
+            logger.error(f"Error getting purchase events: {e}")
+            return []
+    
+    async def get_popular_products_columns(self, limit: int = 100) -> Dict[str, np.ndarray]:
+        """Популярные товары колонками"""
+        try:
+            return await self.query('popular_products', limit)
             
         except Exception as e:
             logger.error(f"Error getting popular products: {e}")
-            return []
\ No newline at end of file
+            raise
+    
+    async def get_popular_products(self, limit: int = 100) -> List[Dict]:
+        """Получить популярные товары (часто закупаемые)"""
+        try:
+            return self._column_records(await self.get_popular_products_columns(limit))
+        except Exception:
+            return []
@@ -0,0 +1,351 @@
+# embedding_cache.py - Персистентный content-addressed кэш эмбеддингов
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import zlib
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """Кэш эмбеддингов на диске с ключом hash(модель, текст).
+
+    Векторы лежат в одном float32 файле (читается через memmap), ключи -
+    в текстовом индексе "ключ crc32" построчно. Новые векторы дописываются
+    в конец, поэтому при рестарте кодируются только новые/измененные тексты.
+    Компакция пишет новое поколение файлов и атомарно переключает CURRENT.
+
+    Каталог кэша общий для воркеров uvicorn: запись, компакция и чтение
+    индекса идут под flock каталога, а каждый процесс держит разделяемую
+    блокировку своего поколения - старое поколение удаляется только когда
+    его больше никто не читает.
+
+    Наборы ключей, закрепленные через pin() (векторы офлайн-задачи
+    clean_data/embedding_job.py), компакция не удаляет.
+    """
+
+    CURRENT_FILE = 'CURRENT'
+    LOCK_FILE = '.lock'
+    _PINNED_FILE = re.compile(r'pinned\.[\w.-]+\.txt')
+    _GENERATION_FILE = re.compile(r'(?:vectors|keys|readers)\.(\d+)\.(?:f32|txt|lock)')
+
+    def __init__(self, cache_dir: str, dim: int):
+        self.cache_dir = cache_dir
+        self.dim = dim
+        self.row_bytes = dim * np.dtype(np.float32).itemsize
+        self.generation = 0
+        self.index: Dict[str, int] = {}
+        self._keys: List[str] = []
+        self._checksums: List[int] = []
+        self._vectors = None
+        self._keys_offset = 0  # байт файла ключей, уже прочитанных этим процессом
+        self._reader_fd = None
+        self._reader_generation = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._locked():
+            self._open()
+            self._remove_stale_generations()
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        return hashlib.sha1(f"{model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def _vectors_path(self, generation: int) -> str:
+        return os.path.join(self.cache_dir, f"vectors.{generation}.f32")
+
+    def _keys_path(self, generation: int) -> str:
+        return os.path.join(self.cache_dir, f"keys.{generation}.txt")
+
+    def _readers_path(self, generation: int) -> str:
+        return os.path.join(self.cache_dir, f"readers.{generation}.lock")
+
+    def _pinned_path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, f"pinned.{name}.txt")
+
+    @contextmanager
+    def _locked(self):
+        """Эксклюзивная блокировка каталога кэша между процессами (не реентерабельна)"""
+        fd = os.open(os.path.join(self.cache_dir, self.LOCK_FILE), os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _read_current(self) -> Optional[Dict]:
+        try:
+            with open(os.path.join(self.cache_dir, self.CURRENT_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _hold_generation(self, generation: int):
+        """Разделяемая блокировка читаемого поколения: пока она взята, его файлы не удаляются"""
+        if self._reader_generation == generation:
+            return
+        fd = os.open(self._readers_path(generation), os.O_CREAT | os.O_RDWR, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        self.close()
+        self._reader_fd, self._reader_generation = fd, generation
+
+    def close(self):
+        """Отпустить поколение (векторы, полученные через vectors(), читать после этого нельзя)"""
+        if self._reader_fd is not None:
+            os.close(self._reader_fd)
+            self._reader_fd = self._reader_generation = None
+        self._vectors = None
+
+    def _open(self):
+        """Полное чтение текущего поколения с отрезанием недописанного хвоста (под блокировкой)"""
+        current = self._read_current()
+        if current is not None:
+            if current['dim'] != self.dim:
+                raise ValueError(f"Embedding cache dim {current['dim']} != expected {self.dim}")
+            self.generation = current['generation']
+        else:
+            self._write_current(self.generation)
+        self._hold_generation(self.generation)
+
+        vectors_path = self._vectors_path(self.generation)
+        keys_path = self._keys_path(self.generation)
+        for path in (vectors_path, keys_path):
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+
+        self._keys, self._checksums, self._keys_offset = [], [], 0
+        self._read_new_keys()
+
+        # Проверка целостности: число строк в индексе и векторов должно совпадать
+        vector_rows = os.path.getsize(vectors_path) // self.row_bytes
+        valid_rows = min(vector_rows, len(self._keys))
+        if (vector_rows != len(self._keys) or os.path.getsize(vectors_path) % self.row_bytes
+                or self._keys_offset != os.path.getsize(keys_path)):
+            logger.warning(f"Embedding cache truncated to {valid_rows} rows "
+                           f"(vectors: {vector_rows}, keys: {len(self._keys)})")
+            self._keys = self._keys[:valid_rows]
+            self._checksums = self._checksums[:valid_rows]
+            self._truncate(valid_rows)
+
+        self.index = {key: row for row, key in enumerate(self._keys)}
+        self._vectors = None
+        logger.info(f"Embedding cache opened: {len(self._keys)} vectors, generation {self.generation}")
+
+    def _read_new_keys(self):
+        """Дочитать целые строки индекса ключей после self._keys_offset"""
+        with open(self._keys_path(self.generation), 'rb') as f:
+            f.seek(self._keys_offset)
+            data = f.read()
+        for line in data.split(b'\n')[:-1]:
+            parts = line.split()
+            if len(parts) != 2:
+                break  # Недописанная строка после аварийного завершения
+            self._keys.append(parts[0].decode('ascii'))
+            self._checksums.append(int(parts[1]))
+            self._keys_offset += len(line) + 1
+
+    def _refresh(self):
+        """Подхватить строки, дописанные другими процессами, и смену поколения после компакции (под блокировкой)"""
+        current = self._read_current()
+        if current is None or current['generation'] != self.generation:
+            self._open()
+            return
+
+        known = len(self._keys)
+        self._read_new_keys()
+        if os.path.getsize(self._vectors_path(self.generation)) != len(self._keys) * self.row_bytes:
+            self._open()
+            return
+        for row in range(known, len(self._keys)):
+            self.index[self._keys[row]] = row
+
+    def refresh(self):
+        with self._locked():
+            self._refresh()
+
+    def _write_current(self, generation: int):
+        current_path = os.path.join(self.cache_dir, self.CURRENT_FILE)
+        tmp_path = current_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'generation': generation, 'dim': self.dim}, f)
+        os.replace(tmp_path, current_path)
+
+    def _truncate(self, rows: int):
+        with open(self._vectors_path(self.generation), 'r+b') as f:
+            f.truncate(rows * self.row_bytes)
+        with open(self._keys_path(self.generation), 'w', encoding='utf-8') as f:
+            for key, checksum in zip(self._keys, self._checksums):
+                f.write(f"{key} {checksum}\n")
+        self._keys_offset = os.path.getsize(self._keys_path(self.generation))
+
+    def _remove_stale_generations(self):
+        """Удаление файлов старых поколений, которые больше никто не держит (под блокировкой)"""
+        stale = set()
+        for name in os.listdir(self.cache_dir):
+            match = self._GENERATION_FILE.fullmatch(name)
+            if match and int(match.group(1)) < self.generation:
+                stale.add(int(match.group(1)))
+
+        for generation in sorted(stale):
+            fd = os.open(self._readers_path(generation), os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                logger.info(f"Embedding cache generation {generation} is still in use, removal deferred")
+                continue
+            try:
+                for path in (self._vectors_path(generation), self._keys_path(generation),
+                             self._readers_path(generation)):
+                    if os.path.exists(path):
+                        os.remove(path)
+            finally:
+                os.close(fd)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def vectors(self) -> np.ndarray:
+        """Все векторы кэша как read-only memmap (n, dim)"""
+        if self._vectors is None or len(self._vectors) != len(self._keys):
+            if not self._keys:
+                return np.empty((0, self.dim), dtype=np.float32)
+            self._vectors = np.memmap(self._vectors_path(self.generation), dtype=np.float32,
+                                      mode='r', shape=(len(self._keys), self.dim))
+        return self._vectors
+
+    def lookup(self, keys: Iterable[str]) -> np.ndarray:
+        """Номера строк для ключей, -1 для отсутствующих (с учетом дописанного другими процессами)"""
+        self.refresh()
+        return np.fromiter((self.index.get(key, -1) for key in keys), dtype=np.int64)
+
+    def append(self, keys: List[str], vectors: np.ndarray):
+        """Дописать новые векторы. Сначала векторы, потом ключи - так
+        недописанный хвост при сбое отрезается проверкой при открытии.
+        Номера строк берутся из длины файла под блокировкой каталога."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with self._locked():
+            # Ключи, уже дописанные другим воркером, и смена поколения после чужой компакции
+            self._refresh()
+            new_rows = [(key, row) for key, row in zip(keys, vectors) if key not in self.index]
+            if not new_rows:
+                return
+
+            checksums = [zlib.crc32(row.tobytes()) for _, row in new_rows]
+            with open(self._vectors_path(self.generation), 'ab') as f:
+                first_row = f.seek(0, os.SEEK_END) // self.row_bytes
+                for _, row in new_rows:
+                    f.write(row.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self._keys_path(self.generation), 'a', encoding='utf-8') as f:
+                for (key, _), checksum in zip(new_rows, checksums):
+                    f.write(f"{key} {checksum}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._keys_offset = os.path.getsize(self._keys_path(self.generation))
+
+            for row, ((key, _), checksum) in enumerate(zip(new_rows, checksums), start=first_row):
+                self.index[key] = row
+                self._keys.append(key)
+                self._checksums.append(checksum)
+
+    def verify(self, deep: bool = False) -> Dict:
+        """Проверка целостности: размеры файлов, дубликаты ключей, а при deep=True
+        еще crc32 и конечность каждого вектора."""
+        self.refresh()
+        report = {
+            'rows': len(self._keys),
+            'size_consistent': os.path.getsize(self._vectors_path(self.generation)) == len(self._keys) * self.row_bytes,
+            'duplicate_keys': len(self._keys) - len(self.index),
+            'corrupted_rows': []
+        }
+        if deep and self._keys:
+            vectors = self.vectors()
+            for row in range(len(self._keys)):
+                vector = vectors[row]
+                if zlib.crc32(vector.tobytes()) != self._checksums[row] or not np.isfinite(vector).all():
+                    report['corrupted_rows'].append(row)
+        report['ok'] = (report['size_consistent'] and not report['duplicate_keys']
+                        and not report['corrupted_rows'])
+        return report
+
+    def pin(self, name: str, keys: Iterable[str]):
+        """Закрепить ключи под именем name (заменяет прежний набор с этим именем)"""
+        path = self._pinned_path(name)
+        if not self._PINNED_FILE.fullmatch(os.path.basename(path)):
+            raise ValueError(f"Invalid pin name: {name!r}")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key in dict.fromkeys(keys):
+                f.write(f"{key}\n")
+        os.replace(tmp_path, path)
+
+    def pinned_keys(self) -> Set[str]:
+        """Ключи всех закрепленных наборов"""
+        keys = set()
+        for name in os.listdir(self.cache_dir):
+            if self._PINNED_FILE.fullmatch(name):
+                with open(os.path.join(self.cache_dir, name), 'r', encoding='utf-8') as f:
+                    keys.update(line.strip() for line in f if line.strip())
+        return keys
+
+    def compact(self, live_keys: Optional[Iterable[str]] = None, drop_rows: Iterable[int] = ()):
+        """Переписать кэш, оставив только живые и закрепленные ключи (и без поврежденных строк).
+
+        Файлы старого поколения удаляются сразу, только если их не читает
+        другой процесс; иначе - при следующей компакции или открытии кэша.
+        """
+        with self._locked():
+            self._refresh()
+            drop = set(drop_rows)
+            if live_keys is None:
+                rows = [row for row in range(len(self._keys)) if row not in drop]
+            else:
+                live_keys = set(live_keys) | self.pinned_keys()
+                rows = sorted({self.index[key] for key in live_keys if key in self.index} - drop)
+
+            new_generation = self.generation + 1
+            vectors = self.vectors()
+            with open(self._vectors_path(new_generation), 'wb') as f:
+                for start in range(0, len(rows), 4096):
+                    f.write(np.ascontiguousarray(vectors[rows[start:start + 4096]]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self._keys_path(new_generation), 'w', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(f"{self._keys[row]} {self._checksums[row]}\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            removed = len(self._keys) - len(rows)
+            self._vectors = None
+            self._write_current(new_generation)
+            self._open()
+            self._remove_stale_generations()
+        logger.info(f"Embedding cache compacted: removed {removed} rows, {len(self._keys)} left")
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Проверка и обслуживание кэша эмбеддингов")
+    parser.add_argument('cache_dir')
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--repair', action='store_true', help="удалить поврежденные строки")
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.cache_dir, args.dim)
+    report = cache.verify(deep=True)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    if args.repair and not report['ok']:
+        cache.compact(drop_rows=report['corrupted_rows'])
@@ -0,0 +1,249 @@
+# encoder_backends.py - Бэкенды CPU-инференса для кодирования текстов товаров
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ENCODER_BACKENDS = ('torch', 'torch_int8', 'onnx')
+
+
+class TextEncoder:
+    """Кодировщик текстов поверх HF-трансформера с mean pooling.
+
+    Бэкенды:
+    - torch: eager PyTorch (как раньше через SentenceTransformer)
+    - torch_int8: динамическое int8-квантование Linear слоев (только CPU)
+    - onnx: экспорт локально загруженной модели в ONNX и инференс в ONNX Runtime
+
+    Тексты токенизируются один раз, сортируются по числу токенов и режутся
+    на батчи с бюджетом max_tokens_per_batch - паддинг почти исчезает,
+    а результат не зависит от состава батча (pooling учитывает маску).
+    """
+
+    def __init__(self, model_name: str, backend: str = 'torch', max_length: int = 128,
+                 normalize: bool = True, max_tokens_per_batch: int = 8192, max_batch_size: int = 256,
+                 intra_op_threads: Optional[int] = None, inter_op_threads: Optional[int] = None,
+                 onnx_dir: str = 'onnx_models', device: Optional[str] = None):
+        if backend not in ENCODER_BACKENDS:
+            raise ValueError(f"Unknown encoder backend: {backend}. Available: {ENCODER_BACKENDS}")
+
+        from transformers import AutoModel, AutoTokenizer
+
+        self.model_name = model_name
+        self.backend = backend
+        self.max_length = max_length
+        self.normalize = normalize
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.max_batch_size = max_batch_size
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.stats = {'texts': 0, 'batches': 0, 'tokens': 0, 'padded_tokens': 0}
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.pad_token_id = self.tokenizer.pad_token_id or 0
+        self.session = None
+        self.model = None
+
+        if backend == 'onnx':
+            onnx_path = os.path.join(onnx_dir, model_name.replace('/', '__') + '.onnx')
+            if not os.path.exists(onnx_path):
+                model = AutoModel.from_pretrained(model_name).eval()
+                _export_onnx(model, onnx_path, max_length)
+                del model
+            self._create_onnx_session(onnx_path)
+            self.dim = self.session.get_outputs()[0].shape[-1]
+        else:
+            import torch
+
+            self._configure_torch_threads()
+            model = AutoModel.from_pretrained(model_name).eval()
+            self.dim = model.config.hidden_size
+            if backend == 'torch_int8':
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                self.device = 'cpu'
+            else:
+                self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+                model = model.to(self.device)
+            self.model = model
+
+        logger.info(f"Text encoder ready: {model_name}, backend={backend}, dim={self.dim}")
+
+    def _configure_torch_threads(self):
+        import torch
+
+        if self.intra_op_threads:
+            torch.set_num_threads(self.intra_op_threads)
+        if self.inter_op_threads:
+            try:
+                torch.set_num_interop_threads(self.inter_op_threads)
+            except RuntimeError:
+                # Можно задать только до первой параллельной операции в процессе
+                logger.warning("torch inter-op threads are already initialized, keeping current value")
+
+    def _create_onnx_session(self, onnx_path: str):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("onnx backend requires the onnxruntime package") from e
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        if self.intra_op_threads:
+            options.intra_op_num_threads = self.intra_op_threads
+        if self.inter_op_threads:
+            options.inter_op_num_threads = self.inter_op_threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        return self.tokenizer(list(texts), truncation=True, max_length=self.max_length)['input_ids']
+
+    def _length_buckets(self, lengths: np.ndarray) -> List[np.ndarray]:
+        """Батчи индексов, отсортированных по длине, с ограничением на число токенов (с паддингом)"""
+        order = np.argsort(lengths, kind='stable')
+        batches, start = [], 0
+        while start < len(order):
+            end = start + 1
+            # Длины растут, поэтому паддинг батча = длина последнего элемента
+            while (end < len(order) and end - start < self.max_batch_size
+                   and (end - start + 1) * lengths[order[end]] <= self.max_tokens_per_batch):
+                end += 1
+            batches.append(order[start:end])
+            start = end
+        return batches
+
+    def _forward(self, input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        if self.session is not None:
+            return self.session.run(None, {'input_ids': input_ids, 'attention_mask': attention_mask})[0]
+
+        import torch
+
+        with torch.inference_mode():
+            output = self.model(
+                input_ids=torch.from_numpy(input_ids).to(self.device),
+                attention_mask=torch.from_numpy(attention_mask).to(self.device)
+            )
+        return output[0].float().cpu().numpy()
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, self.dim), dtype=np.float32)
+
+        token_ids = self.tokenize(texts)
+        lengths = np.fromiter((len(ids) for ids in token_ids), dtype=np.int64, count=len(token_ids))
+        result = np.empty((len(texts), self.dim), dtype=np.float32)
+
+        for batch in self._length_buckets(lengths):
+            width = int(lengths[batch].max())
+            input_ids = np.full((len(batch), width), self.pad_token_id, dtype=np.int64)
+            attention_mask = np.zeros((len(batch), width), dtype=np.int64)
+            for row, idx in enumerate(batch):
+                input_ids[row, :lengths[idx]] = token_ids[idx]
+                attention_mask[row, :lengths[idx]] = 1
+
+            hidden = self._forward(input_ids, attention_mask)
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            if self.normalize:
+                pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+            result[batch] = pooled
+
+            self.stats['batches'] += 1
+            self.stats['tokens'] += int(lengths[batch].sum())
+            self.stats['padded_tokens'] += width * len(batch)
+
+        self.stats['texts'] += len(texts)
+        return result
+
+
+def _export_onnx(model, onnx_path: str, max_length: int):
+    import torch
+
+    class _LastHiddenState(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+    os.makedirs(os.path.dirname(onnx_path) or '.', exist_ok=True)
+    dummy = torch.ones((2, min(16, max_length)), dtype=torch.long)
+    tmp_path = onnx_path + '.tmp'
+    torch.onnx.export(
+        _LastHiddenState(model), (dummy, dummy), tmp_path,
+        input_names=['input_ids', 'attention_mask'],
+        output_names=['last_hidden_state'],
+        dynamic_axes={
+            'input_ids': {0: 'batch', 1: 'sequence'},
+            'attention_mask': {0: 'batch', 1: 'sequence'},
+            'last_hidden_state': {0: 'batch', 1: 'sequence'}
+        },
+        opset_version=14
+    )
+    os.replace(tmp_path, onnx_path)
+    logger.info(f"Exported ONNX model to {onnx_path}")
+
+
+def create_text_encoder(model_name: str, backend: str = 'torch', **params) -> TextEncoder:
+    return TextEncoder(model_name, backend=backend, **params)
+
+
+def benchmark(model_name: str, texts: List[str], backends: List[str], **params) -> List[Dict]:
+    """Скорость (текстов/сек) каждого бэкенда и близость векторов к первому из них"""
+    results, reference = [], None
+    for backend in backends:
+        encoder = create_text_encoder(model_name, backend, **params)
+        encoder.encode(texts[:32])  # прогрев
+
+        start = time.time()
+        vectors = encoder.encode(texts)
+        elapsed = time.time() - start
+
+        if reference is None:
+            reference = vectors
+        cosine = (vectors * reference).sum(axis=1) / np.maximum(
+            np.linalg.norm(vectors, axis=1) * np.linalg.norm(reference, axis=1), 1e-12)
+        results.append({
+            'backend': backend,
+            'texts_per_sec': round(len(texts) / elapsed, 1),
+            'seconds': round(elapsed, 2),
+            'padding_overhead': round(encoder.stats['padded_tokens'] / max(encoder.stats['tokens'], 1) - 1, 3),
+            'min_cosine_vs_' + backends[0]: round(float(cosine.min()), 4)
+        })
+        logger.info(f"{results[-1]}")
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Бенчмарк бэкендов кодирования текстов товаров")
+    parser.add_argument('--model', default='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+    parser.add_argument('--backends', nargs='+', default=list(ENCODER_BACKENDS), choices=ENCODER_BACKENDS)
+    parser.add_argument('--input', help="файл с текстами, по одному на строку")
+    parser.add_argument('--limit', type=int, default=2000)
+    parser.add_argument('--max-tokens', type=int, default=8192, help="токенов (с паддингом) в батче")
+    parser.add_argument('--threads', type=int, help="intra-op потоков")
+    parser.add_argument('--inter-op-threads', type=int)
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()][:args.limit]
+    else:
+        rng = np.random.default_rng(42)
+        words = ['бумага', 'А4', 'для', 'принтера', 'ручка', 'шариковая', 'синяя', 'стол', 'офисный',
+                 'кресло', 'картридж', 'лазерный', 'папка', 'скоросшиватель', 'монитор', 'клавиатура']
+        texts = [' '.join(rng.choice(words, rng.integers(3, 40))) for _ in range(args.limit)]
+
+    report = benchmark(args.model, texts, args.backends, max_tokens_per_batch=args.max_tokens,
+                       intra_op_threads=args.threads, inter_op_threads=args.inter_op_threads)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
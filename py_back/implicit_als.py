@@ -0,0 +1,282 @@
+# implicit_als.py - Матричная факторизация по неявному фидбэку (implicit ALS) для истории закупок
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+from shared_arrays import SharedArrayStore
+
+logger = logging.getLogger(__name__)
+
+DB_CONFIG = {
+    'user': 'store_app1',
+    'host': 'localhost',
+    'database': 'pc_db',
+    'password': '1234',
+    'port': 5432
+}
+
+# Покупатель - пользователь платформы, а для импортированных закупок - организация
+INTERACTIONS_QUERY = """
+SELECT
+    COALESCE(pr.user_id::text, NULLIF(pr.organization_inn, ''), pr.organization_name) AS entity_id,
+    pi.product_id,
+    SUM(COALESCE(pi.quantity, 1)) AS quantity
+FROM procurement_items pi
+JOIN procurements pr ON pr.procurement_id = pi.procurement_id
+WHERE pi.product_id IS NOT NULL
+AND COALESCE(pr.user_id::text, NULLIF(pr.organization_inn, ''), pr.organization_name) IS NOT NULL
+GROUP BY 1, 2
+"""
+
+MODEL_NAMESPACE = 'als'
+
+
+class ImplicitALS:
+    """Implicit ALS (Hu, Koren, Volinsky) с решением шагов методом сопряженных градиентов.
+
+    Уверенность c_ui = 1 + alpha * log(1 + quantity), предпочтение p_ui = 1
+    для купленных товаров. На каждом полушаге системы всех покупателей блока
+    решаются одновременно несколькими итерациями CG с теплым стартом от
+    прошлых факторов - без обращения матриц f×f. Блоки считаются в пуле
+    потоков (тяжелые операции numpy/scipy отпускают GIL).
+    """
+
+    def __init__(self, factors: int = 64, regularization: float = 0.05, alpha: float = 10.0,
+                 iterations: int = 15, cg_steps: int = 3, threads: Optional[int] = None,
+                 block_size: int = 4096, random_state: int = 42):
+        self.factors = factors
+        self.regularization = regularization
+        self.alpha = alpha
+        self.iterations = iterations
+        self.cg_steps = cg_steps
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self.random_state = random_state
+        self.user_ids: List[str] = []
+        self.item_ids: List[str] = []
+        self.user_to_index: Dict[str, int] = {}
+        self.item_to_index: Dict[str, int] = {}
+        self.user_factors: Optional[np.ndarray] = None
+        self.item_factors: Optional[np.ndarray] = None
+        self.user_items: Optional[sparse.csr_matrix] = None
+        self._item_gram: Optional[np.ndarray] = None
+
+    def confidence(self, quantity: np.ndarray) -> np.ndarray:
+        return 1.0 + self.alpha * np.log1p(np.maximum(np.asarray(quantity, dtype=np.float32), 0))
+
+    def build_interactions(self, rows: List[Tuple[str, str, float]]) -> sparse.csr_matrix:
+        """Матрица покупатель×товар из строк (entity_id, product_id, quantity)"""
+        user_index, item_index = {}, {}
+        user_codes = np.fromiter((user_index.setdefault(u, len(user_index)) for u, _, _ in rows),
+                                 dtype=np.int64, count=len(rows))
+        item_codes = np.fromiter((item_index.setdefault(i, len(item_index)) for _, i, _ in rows),
+                                 dtype=np.int64, count=len(rows))
+        quantities = np.fromiter((q or 1 for _, _, q in rows), dtype=np.float32, count=len(rows))
+
+        self.user_ids, self.item_ids = list(user_index), list(item_index)
+        self.user_to_index, self.item_to_index = user_index, item_index
+        # Повторы одной пары складываются при конвертации в CSR
+        matrix = sparse.coo_matrix((quantities, (user_codes, item_codes)),
+                                   shape=(len(user_index), len(item_index))).tocsr()
+        matrix.sort_indices()
+        return matrix
+
+    def fit(self, quantities: sparse.csr_matrix):
+        """Обучение по матрице количеств покупатель×товар"""
+        start_time = time.time()
+        self.user_items = quantities.tocsr().astype(np.float32)
+        confidence = self.user_items.copy()
+        confidence.data = self.confidence(confidence.data)
+        confidence_t = confidence.T.tocsr()
+
+        rng = np.random.default_rng(self.random_state)
+        n_users, n_items = confidence.shape
+        self.user_factors = (rng.standard_normal((n_users, self.factors)) * 0.01).astype(np.float32)
+        self.item_factors = (rng.standard_normal((n_items, self.factors)) * 0.01).astype(np.float32)
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for iteration in range(self.iterations):
+                iteration_start = time.time()
+                self._solve(confidence, self.user_factors, self.item_factors, executor)
+                self._solve(confidence_t, self.item_factors, self.user_factors, executor)
+                logger.info(f"ALS iteration {iteration + 1}/{self.iterations}: {time.time() - iteration_start:.2f}s")
+
+        self._item_gram = None
+        logger.info(f"ALS trained: {n_users} users, {n_items} items, {confidence.nnz} interactions, "
+                    f"{self.factors} factors in {time.time() - start_time:.1f}s")
+        return self
+
+    def _solve(self, confidence: sparse.csr_matrix, X: np.ndarray, Y: np.ndarray, executor: ThreadPoolExecutor):
+        """Полушаг ALS: обновляет X на месте при фиксированных Y"""
+        gram = Y.T @ Y + self.regularization * np.eye(self.factors, dtype=np.float32)
+        blocks = range(0, X.shape[0], self.block_size)
+        for _ in executor.map(lambda start: self._solve_block(confidence, X, Y, gram, start), blocks):
+            pass
+
+    def _solve_block(self, confidence: sparse.csr_matrix, X: np.ndarray, Y: np.ndarray,
+                     gram: np.ndarray, start: int):
+        end = min(start + self.block_size, X.shape[0])
+        block = confidence[start:end]
+        X[start:end] = self._conjugate_gradient(block, X[start:end], Y, gram)
+
+    def _conjugate_gradient(self, block: sparse.csr_matrix, x: np.ndarray, Y: np.ndarray,
+                            gram: np.ndarray) -> np.ndarray:
+        """CG для систем (YtY + Yt(C_u - I)Y + reg*I) x_u = Yt C_u p_u всех строк блока сразу"""
+        rows = np.repeat(np.arange(block.shape[0]), np.diff(block.indptr))
+        item_vectors = Y[block.indices]
+        extra = block.data - 1.0
+
+        def matvec(P: np.ndarray) -> np.ndarray:
+            weights = np.einsum('ij,ij->i', item_vectors, P[rows]) * extra
+            weighted = sparse.csr_matrix((weights, block.indices, block.indptr), shape=block.shape)
+            return P @ gram + weighted @ Y
+
+        x = x.astype(np.float32, copy=True)
+        r = block @ Y - matvec(x)
+        p = r.copy()
+        rs_old = np.einsum('ij,ij->i', r, r)
+        for _ in range(self.cg_steps):
+            Ap = matvec(p)
+            denominator = np.einsum('ij,ij->i', p, Ap)
+            step = np.divide(rs_old, denominator, out=np.zeros_like(rs_old), where=denominator > 1e-20)
+            x += step[:, None] * p
+            r -= step[:, None] * Ap
+            rs_new = np.einsum('ij,ij->i', r, r)
+            beta = np.divide(rs_new, rs_old, out=np.zeros_like(rs_new), where=rs_old > 1e-20)
+            p = r + beta[:, None] * p
+            rs_old = rs_new
+        return x
+
+    def fold_in(self, history: Dict[str, float]) -> Optional[np.ndarray]:
+        """Вектор покупателя, которого нет в модели, по его истории {product_id: quantity}"""
+        items = [(self.item_to_index[item], quantity) for item, quantity in history.items()
+                 if item in self.item_to_index]
+        if not items:
+            return None
+
+        indices, quantities = zip(*items)
+        Y = np.asarray(self.item_factors[list(indices)], dtype=np.float64)
+        confidence = self.confidence(np.array(quantities)).astype(np.float64)
+        if self._item_gram is None:
+            item_factors = np.asarray(self.item_factors, dtype=np.float64)
+            self._item_gram = item_factors.T @ item_factors
+        A = self._item_gram + (Y.T * (confidence - 1)) @ Y + self.regularization * np.eye(self.factors)
+        return np.linalg.solve(A, Y.T @ confidence).astype(np.float32)
+
+    def user_vector(self, user_id: str, history: Optional[Dict[str, float]] = None) -> Optional[np.ndarray]:
+        if user_id in self.user_to_index:
+            return np.asarray(self.user_factors[self.user_to_index[user_id]])
+        if history:
+            return self.fold_in(history)
+        return None
+
+    def score_items(self, user_id: str, history: Optional[Dict[str, float]] = None) -> Optional[np.ndarray]:
+        """Скоры всех товаров модели для покупателя (None - нет ни факторов, ни истории)"""
+        vector = self.user_vector(user_id, history)
+        if vector is None:
+            return None
+        return self.item_factors @ vector
+
+    def recommend(self, user_id: str, k: int = 20, history: Optional[Dict[str, float]] = None,
+                  exclude_purchased: bool = True) -> List[Tuple[str, float]]:
+        scores = self.score_items(user_id, history)
+        if scores is None:
+            return []
+
+        if exclude_purchased:
+            purchased = [self.item_to_index[item] for item in (history or ()) if item in self.item_to_index]
+            if user_id in self.user_to_index:
+                row = self.user_to_index[user_id]
+                purchased.extend(self.user_items.indices[self.user_items.indptr[row]:self.user_items.indptr[row + 1]])
+            if purchased:
+                scores = scores.copy()
+                scores[np.asarray(purchased, dtype=np.int64)] = -np.inf
+
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(self.item_ids[i], float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    def save(self, model_dir: str):
+        """Публикация факторов в .npy, которые воркеры подключают через memmap"""
+        store = SharedArrayStore(model_dir, MODEL_NAMESPACE, fingerprint='implicit-als')
+        if not store.try_become_leader():
+            raise RuntimeError(f"Another process is publishing ALS factors to {store.path}")
+        try:
+            store.publish(
+                {'user_factors': self.user_factors, 'item_factors': self.item_factors, 'user_items': self.user_items},
+                metadata={
+                    'params': {'factors': self.factors, 'regularization': self.regularization, 'alpha': self.alpha},
+                    'user_ids': self.user_ids,
+                    'item_ids': self.item_ids
+                }
+            )
+        finally:
+            store.release()
+
+    @classmethod
+    def load(cls, model_dir: str) -> Optional['ImplicitALS']:
+        store = SharedArrayStore(model_dir, MODEL_NAMESPACE, fingerprint='implicit-als')
+        if not store.is_ready():
+            return None
+
+        arrays, metadata = store.attach()
+        model = cls(**metadata['params'])
+        model.user_ids, model.item_ids = metadata['user_ids'], metadata['item_ids']
+        model.user_to_index = {user_id: i for i, user_id in enumerate(model.user_ids)}
+        model.item_to_index = {item_id: i for i, item_id in enumerate(model.item_ids)}
+        model.user_factors = arrays['user_factors']
+        model.item_factors = arrays['item_factors']
+        model.user_items = arrays['user_items']
+        return model
+
+
+async def load_interactions() -> List[Tuple[str, str, float]]:
+    import asyncpg
+
+    conn = await asyncpg.connect(**DB_CONFIG)
+    try:
+        rows = []
+        async with conn.transaction():
+            async for row in conn.cursor(INTERACTIONS_QUERY, prefetch=10000):
+                rows.append((row['entity_id'], row['product_id'], float(row['quantity'])))
+        return rows
+    finally:
+        await conn.close()
+
+
+def train(model_dir: str, **params) -> ImplicitALS:
+    rows = asyncio.run(load_interactions())
+    logger.info(f"Loaded {len(rows)} buyer-product interactions")
+
+    model = ImplicitALS(**params)
+    model.fit(model.build_interactions(rows))
+    model.save(model_dir)
+    return model
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Обучение implicit ALS на истории закупок")
+    parser.add_argument('--output', default=os.environ.get('RECS_ALS_DIR', 'als_model'))
+    parser.add_argument('--factors', type=int, default=64)
+    parser.add_argument('--iterations', type=int, default=15)
+    parser.add_argument('--regularization', type=float, default=0.05)
+    parser.add_argument('--alpha', type=float, default=10.0)
+    parser.add_argument('--cg-steps', type=int, default=3)
+    parser.add_argument('--threads', type=int)
+    args = parser.parse_args()
+
+    train(args.output, factors=args.factors, iterations=args.iterations, regularization=args.regularization,
+          alpha=args.alpha, cg_steps=args.cg_steps, threads=args.threads)
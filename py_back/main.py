@@ -2,14 +2,17 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Optional
 import asyncpg
 import os
 from datetime import datetime
 import logging
 from collections import defaultdict, Counter
 import math
-import re
+
+from catalog_feed import CatalogFeed
+from weighted_stats import weighted_summary
+from product_names import normalize_product_name, dedup_key
 
 # Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -38,6 +41,39 @@ class RecommendationResponse(BaseModel):
     engine: str
     generated_at: str
 
+DB_CONFIG = {
+    'user': 'store_app1',
+    'host': 'localhost',
+    'database': 'pc_db',
+    'password': '1234',
+    'port': 5432
+}
+
+CATALOG_QUERY = """
+SELECT 
+    p.product_id,
+    p.name,
+    p.description,
+    p.category_id,
+    c.name as category_name,
+    p.manufacturer,
+    p.average_price,
+    p.unit_of_measure,
+    p.specifications,
+    p.is_available,
+    p.normalized_name,
+    COALESCE(p.dedup_group_id, g.group_id) as dedup_group_id,
+    COALESCE(s.purchase_count, 0) as purchase_count
+FROM products p
+LEFT JOIN categories c ON p.category_id = c.category_id
+LEFT JOIN product_name_groups g ON p.dedup_group_id IS NULL AND g.normalized_name = normalize_product_name(p.name)
+LEFT JOIN product_stats s ON s.product_id = p.product_id
+WHERE p.is_available = true 
+AND p.average_price > 0
+AND p.name IS NOT NULL
+AND LENGTH(TRIM(p.name)) > 5
+"""
+
 # Database Service
 class DatabaseService:
     def __init__(self):
@@ -46,15 +82,7 @@ class DatabaseService:
     async def connect(self):
         """Подключение к PostgreSQL"""
         try:
-            self.pool = await asyncpg.create_pool(
-                user='store_app1',
-                host='localhost',
-                database='pc_db',
-                password='1234',
-                port=5432,
-                min_size=3,
-                max_size=10
-            )
+            self.pool = await asyncpg.create_pool(**DB_CONFIG, min_size=3, max_size=10)
             logger.info("✅ Connected to PostgreSQL database pc_db")
             
         except Exception as e:
@@ -107,64 +135,86 @@ class DatabaseService:
             logger.error(f"Error getting user procurements: {e}")
             return []
     
+    async def _stream_rows(self, query: str, *args, prefetch: int = 2000):
+        # Серверный курсор: строки обрабатываются по мере получения, без материализации всего результата
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor(query, *args, prefetch=prefetch):
+                    yield row
+    
+    async def connect_listener(self):
+        """Отдельное соединение для LISTEN (соединения пула возвращаются и переиспользуются)"""
+        return await asyncpg.connect(**DB_CONFIG)
+    
+    async def fetch_catalog_products(self, product_ids: Optional[List[str]] = None,
+                                     limit: Optional[int] = None) -> List[Dict]:
+        """Top-limit доступных товаров по популярности (или только product_ids) без дедупликации - для резидентного каталога.
+        
+        Ошибки не глушатся: пустой результат из-за сбоя БД удалил бы товары из снимка.
+        """
+        query = CATALOG_QUERY + """
+        AND ($1::varchar[] IS NULL OR p.product_id = ANY($1::varchar[]))
+        ORDER BY purchase_count DESC, p.average_price DESC
+        LIMIT $2
+        """
+        products = [self._catalog_product(row) async for row in self._stream_rows(query, product_ids, limit)]
+        
+        if product_ids is None:
+            category_dist = Counter(p['category_name'] for p in products)
+            logger.info(f"📦 Loaded {len(products)} available products into catalog snapshot")
+            logger.info(f"📊 Category distribution: {dict(category_dist.most_common(8))}")
+        
+        return products
+    
+    def _catalog_product(self, row) -> Dict:
+        return {
+            'product_id': row['product_id'],
+            'name': row['name'],
+            # Нормализованное название и группа дубликатов считаются в БД при вставке товара
+            'normalized_name': row['normalized_name'] if row['normalized_name'] is not None
+                               else self._normalize_product_name(row['name']),
+            'dedup_group': dedup_key(row),
+            'description': row['description'],
+            'category_id': row['category_id'],
+            # Улучшаем категоризацию
+            'category_name': self._improve_category(row['category_name'], row['name']),
+            'manufacturer': row['manufacturer'],
+            'average_price': float(row['average_price']),
+            'unit_of_measure': row['unit_of_measure'],
+            'specifications': row['specifications'],
+            'is_available': row['is_available'],
+            'purchase_count': row['purchase_count'] or 0
+        }
+    
     async def get_available_products(self, limit: int = 20000) -> List[Dict]:
-        """Получить доступные товары для рекомендаций с улучшенной фильтрацией"""
+        """Получить доступные товары для рекомендаций с улучшенной фильтрацией.
+        
+        limit - число уникальных товаров после дедупликации, как в CatalogFeed.view.
+        """
         try:
-            query = """
-            SELECT 
-                p.product_id,
-                p.name,
-                p.description,
-                p.category_id,
-                c.name as category_name,
-                p.manufacturer,
-                p.average_price,
-                p.unit_of_measure,
-                p.specifications,
-                p.is_available,
-                (SELECT COUNT(*) FROM procurement_items pi WHERE pi.product_id = p.product_id) as purchase_count
-            FROM products p
-            LEFT JOIN categories c ON p.category_id = c.category_id
-            WHERE p.is_available = true 
-            AND p.average_price > 0
-            AND p.name IS NOT NULL
-            AND LENGTH(TRIM(p.name)) > 5
+            # LIMIT до дедупликации дал бы меньше limit товаров - читаем курсор, пока не наберем limit уникальных
+            query = CATALOG_QUERY + """
             ORDER BY purchase_count DESC, p.average_price DESC
-            LIMIT $1
             """
             
-            async with self.pool.acquire() as conn:
-                rows = await conn.fetch(query, limit)
-            
             products = []
-            seen_names = set()  # Для устранения дубликатов
+            seen_groups = set()  # Для устранения дубликатов
             
-            for row in rows:
-                # Нормализуем название для устранения дубликатов
-                normalized_name = self._normalize_product_name(row['name'])
-                
-                # Пропускаем дубликаты
-                if normalized_name in seen_names:
-                    continue
-                seen_names.add(normalized_name)
-                
-                # Улучшаем категоризацию
-                category_name = self._improve_category(row['category_name'], row['name'])
-                
-                products.append({
-                    'product_id': row['product_id'],
-                    'name': row['name'],
-                    'normalized_name': normalized_name,
-                    'description': row['description'],
-                    'category_id': row['category_id'],
-                    'category_name': category_name,
-                    'manufacturer': row['manufacturer'],
-                    'average_price': float(row['average_price']),
-                    'unit_of_measure': row['unit_of_measure'],
-                    'specifications': row['specifications'],
-                    'is_available': row['is_available'],
-                    'purchase_count': row['purchase_count'] or 0
-                })
+            rows = self._stream_rows(query)
+            try:
+                async for row in rows:
+                    product = self._catalog_product(row)
+                    
+                    # Пропускаем дубликаты
+                    if product['dedup_group'] in seen_groups:
+                        continue
+                    seen_groups.add(product['dedup_group'])
+                    products.append(product)
+                    if len(products) >= limit:
+                        break
+            finally:
+                # Закрываем курсор сразу, а не при сборке генератора: соединение возвращается в пул
+                await rows.aclose()
             
             # Логируем статистику
             category_dist = Counter(p['category_name'] for p in products)
@@ -178,24 +228,8 @@ class DatabaseService:
             return []
     
     def _normalize_product_name(self, name: str) -> str:
-        """Нормализация названия товара для устранения дубликатов"""
-        if not name:
-            return ""
-        
-        # Приводим к нижнему регистру
-        normalized = name.lower().strip()
-        
-        # Удаляем лишние пробелы
-        normalized = re.sub(r'\s+', ' ', normalized)
-        
-        # Удаляем размеры упаковки в скобках (100 шт/уп и т.д.)
-        normalized = re.sub(r'\s*\(\s*\d+\s*шт/\s*уп\s*\)', '', normalized)
-        normalized = re.sub(r'\s*\d+\s*шт/\s*уп\.?', '', normalized)
-        
-        # Удаляем повторяющиеся характеристики
-        normalized = re.sub(r'\s*\(\s*[^)]*\d+\s*мм\s*[^)]*\)', '', normalized)
-        
-        return normalized.strip()
+        """Нормализация названия товара для устранения дубликатов (fallback для строк без normalized_name)"""
+        return normalize_product_name(name)
     
     def _improve_category(self, current_category: str, product_name: str) -> str:
         """Улучшение категоризации на основе названия товара"""
@@ -223,8 +257,20 @@ class DatabaseService:
 
 # Smart Recommendation Engine
 class SmartRecommendationEngine:
+    CATALOG_LIMIT = 15000
+    CATALOG_WINDOW_FACTOR = 4
+    
     def __init__(self, db_service):
         self.db = db_service
+        # Каталог загружается один раз и патчится по уведомлениям catalog_changes из БД.
+        # В памяти - окно с запасом на дубликаты и товары, выпадающие из выдачи между перезагрузками
+        self.catalog = CatalogFeed(
+            load=db_service.fetch_catalog_products,
+            connect=db_service.connect_listener,
+            sort_key=lambda p: (-p['purchase_count'], -p['average_price']),
+            dedupe_key='dedup_group',
+            window=self.CATALOG_LIMIT * self.CATALOG_WINDOW_FACTOR
+        )
         
     async def generate_recommendations(self, user_id: str, limit: int = 15) -> List[Dict]:
         """Генерация умных рекомендаций"""
@@ -232,8 +278,11 @@ class SmartRecommendationEngine:
         # 1. Получаем историю пользователя
         user_procurements = await self.db.get_user_procurements(user_id)
         
-        # 2. Получаем доступные товары
-        available_products = await self.db.get_available_products(15000)
+        # 2. Доступные товары из резидентного снимка (из БД - только пока снимок не загружен)
+        if self.catalog.ready:
+            available_products = self.catalog.view(self.CATALOG_LIMIT)
+        else:
+            available_products = await self.db.get_available_products(self.CATALOG_LIMIT)
         
         # 3. Анализируем профиль пользователя
         user_profile = self._analyze_user_profile(user_procurements)
@@ -248,8 +297,8 @@ class SmartRecommendationEngine:
             if product['product_id'] in purchased_products:
                 continue
             
-            # Пропускаем дубликаты по нормализованному названию
-            if product['normalized_name'] in seen_recommendations:
+            # Пропускаем дубликаты по группе нормализованного названия
+            if product['dedup_group'] in seen_recommendations:
                 continue
             
             score_data = self._calculate_product_score(product, user_profile)
@@ -275,7 +324,7 @@ class SmartRecommendationEngine:
                 }
                 
                 recommendations.append(recommendation)
-                seen_recommendations.add(product['normalized_name'])
+                seen_recommendations.add(product['dedup_group'])
         
         # Сортируем и ограничиваем
         recommendations.sort(key=lambda x: x['total_score'], reverse=True)
@@ -298,7 +347,8 @@ class SmartRecommendationEngine:
         profile = {
             'purchased_products': set(),
             'categories': Counter(),
-            'price_points': [],
+            'price_points': [],    # цены строк закупок
+            'price_weights': [],   # их количества (веса), строки не размножаются
             'total_spent': 0,
             'total_items': 0,
             'preferred_price_range': None,
@@ -322,21 +372,13 @@ class SmartRecommendationEngine:
             profile['total_items'] += quantity
             
             # Собираем ценовые точки
-            for _ in range(quantity):
-                profile['price_points'].append(price)
-        
-        # Анализ ценовых предпочтений
-        if profile['price_points']:
-            sorted_prices = sorted(profile['price_points'])
-            n = len(sorted_prices)
-            profile['preferred_price_range'] = {
-                'min': sorted_prices[0],
-                'max': sorted_prices[-1],
-                'avg': sum(sorted_prices) / n,
-                'median': sorted_prices[n // 2],
-                'q1': sorted_prices[n // 4],
-                'q3': sorted_prices[3 * n // 4]
-            }
+            profile['price_points'].append(price)
+            profile['price_weights'].append(quantity)
+        
+        # Анализ ценовых предпочтений: взвешенные по количеству квартили
+        price_summary = weighted_summary(profile['price_points'], profile['price_weights'])
+        if price_summary:
+            profile['preferred_price_range'] = price_summary
         
         # Анализ категориальных предпочтений
         if profile['categories']:
@@ -459,8 +501,13 @@ recommendation_engine = SmartRecommendationEngine(db_service)
 @app.on_event("startup")
 async def startup_event():
     await db_service.connect()
+    await recommendation_engine.catalog.start()
     logger.info("✅ Smart recommendation engine initialized")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await recommendation_engine.catalog.stop()
+
 # API Endpoints
 @app.get("/")
 async def root():
@@ -486,6 +533,11 @@ async def health_check():
             "database": "connected", 
             "total_products": stats['total_products'],
             "available_products": stats['available_products'],
+            "catalog_snapshot": {
+                "ready": recommendation_engine.catalog.ready,
+                "products": len(recommendation_engine.catalog.products),
+                **recommendation_engine.catalog.stats
+            },
             "timestamp": datetime.now().isoformat()
         }
     except Exception as e:
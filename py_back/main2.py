@@ -2,21 +2,27 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Dict, Optional
+from typing import List, Dict, Any, Optional
+import asyncio
 import asyncpg
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 from collections import defaultdict, Counter
 import math
-import re
 import json
 import pandas as pd
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.preprocessing import normalize
 
+from shared_arrays import SharedArrayStore
+from candidate_cache import CandidateCache
+from product_names import normalize_product_name, dedup_key
+from copurchase_index import CoPurchaseIndex
+from implicit_als import ImplicitALS
+from attribute_store import AttributeStore
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
@@ -34,6 +40,13 @@ class RecommendationRequest(BaseModel):
     user_id: str
     limit: int = 15
     strategy: str = "balanced"  # balanced, budget, premium
+    # Фильтр по характеристикам: {"Цвет": "синий", "Объем": {"min": 0.5, "max": 1, "unit": "л"}}
+    attributes: Optional[Dict[str, Any]] = None
+
+class SimilarProductsRequest(BaseModel):
+    product_id: str
+    limit: int = 10
+    attributes: Optional[Dict[str, Any]] = None
 
 class BundleRequest(BaseModel):
     user_id: str
@@ -91,6 +104,33 @@ class EnhancedRecommendationConfig:
         'min_categories': 3,
         'category_penalty': 0.1
     }
+    
+    # Схожесть считается по запросу из разреженной TF-IDF матрицы (память O(nnz)), поэтому каталог не режется до 10K
+    CATALOG_LIMIT = int(os.environ.get('RECS_CATALOG_LIMIT', 200000))
+    CONTENT_SIMILARITY_CHUNK = 32  # купленных товаров на одно разреженное произведение
+    
+    # Общие memory-mapped массивы для нескольких воркеров (None - каждый процесс строит свою матрицу)
+    SHARED_ARRAYS_DIR = os.environ.get('RECS_SHARED_ARRAYS_DIR')
+    SHARED_ARRAYS_MAX_AGE = 24 * 3600
+    
+    # Отсортированный пул кандидатов пользователя переиспользуется рекомендациями и наборами
+    CANDIDATE_CACHE = {'ttl': 60.0, 'max_users': 200}
+    
+    # Item-to-item CF по совместным покупкам в одной закупке
+    COPURCHASE = {
+        'params': {'normalization': 'cosine', 'top_k': 100, 'min_count': 1},
+        'refresh_interval': 600,  # секунд между дозагрузками новых закупок
+        'watermark_overlap': 300  # запас на поздно закоммиченные позиции
+    }
+    
+    # Доля схожести по характеристикам (specifications) в поиске похожих товаров, остальное - TF-IDF
+    ATTRIBUTE_SIMILARITY_WEIGHT = 0.5
+    
+    # Факторы implicit ALS (обучаются офлайн: python implicit_als.py --output <dir>), None - компонент выключен
+    MATRIX_FACTORIZATION = {
+        'model_dir': os.environ.get('RECS_ALS_DIR'),
+        'weight': 0.15  # доля в итоговом скоре, если у пользователя есть вектор
+    }
 
 class DatabaseService:
     def __init__(self):
@@ -158,6 +198,39 @@ class DatabaseService:
             logger.error(f"Error getting user procurements: {e}")
             return []
     
+    async def get_procurement_baskets(self, since: Optional[datetime] = None):
+        """Корзины {procurement_id: [product_id]} (все или затронутые после since) и максимальный created_at"""
+        try:
+            query = """
+            SELECT pi.procurement_id, pi.product_id, pi.created_at
+            FROM procurement_items pi
+            WHERE pi.product_id IS NOT NULL
+            AND pi.procurement_id IS NOT NULL
+            AND ($1::timestamp IS NULL OR pi.procurement_id IN (
+                SELECT procurement_id FROM procurement_items WHERE created_at > $1
+            ))
+            """
+            
+            baskets = defaultdict(list)
+            watermark = since
+            async for row in self._stream_rows(query, since):
+                baskets[row['procurement_id']].append(row['product_id'])
+                if row['created_at'] and (watermark is None or row['created_at'] > watermark):
+                    watermark = row['created_at']
+            
+            return baskets, watermark
+            
+        except Exception as e:
+            logger.error(f"Error getting procurement baskets: {e}")
+            return {}, since
+    
+    async def _stream_rows(self, query: str, *args, prefetch: int = 2000):
+        # Серверный курсор: строки обрабатываются по мере получения, без материализации всего результата
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                async for row in conn.cursor(query, *args, prefetch=prefetch):
+                    yield row
+    
     async def get_available_products(self, limit: int = 20000) -> List[Dict]:
         try:
             query = """
@@ -172,9 +245,13 @@ class DatabaseService:
                 p.unit_of_measure,
                 p.specifications,
                 p.is_available,
-                (SELECT COUNT(*) FROM procurement_items pi WHERE pi.product_id = p.product_id) as purchase_count
+                p.normalized_name,
+                COALESCE(p.dedup_group_id, g.group_id) as dedup_group_id,
+                COALESCE(s.purchase_count, 0) as purchase_count
             FROM products p
             LEFT JOIN categories c ON p.category_id = c.category_id
+            LEFT JOIN product_name_groups g ON p.dedup_group_id IS NULL AND g.normalized_name = normalize_product_name(p.name)
+            LEFT JOIN product_stats s ON s.product_id = p.product_id
             WHERE p.is_available = true 
             AND p.average_price > 0
             AND p.name IS NOT NULL
@@ -183,18 +260,19 @@ class DatabaseService:
             LIMIT $1
             """
             
-            async with self.pool.acquire() as conn:
-                rows = await conn.fetch(query, limit)
-            
             products = []
-            seen_names = set()
+            seen_groups = set()
             
-            for row in rows:
-                normalized_name = self._normalize_product_name(row['name'])
-                
-                if normalized_name in seen_names:
+            async for row in self._stream_rows(query, limit):
+                # Группа дубликатов предрасчитана в БД, регулярки - только для строк до бэкфилла
+                group = dedup_key(row)
+                if group in seen_groups:
                     continue
-                seen_names.add(normalized_name)
+                seen_groups.add(group)
+                
+                normalized_name = row['normalized_name']
+                if normalized_name is None:
+                    normalized_name = self._normalize_product_name(row['name'])
                 
                 category_name = self._improve_category(row['category_name'], row['name'])
                 
@@ -225,16 +303,8 @@ class DatabaseService:
             return []
     
     def _normalize_product_name(self, name: str) -> str:
-        if not name:
-            return ""
-        
-        normalized = name.lower().strip()
-        normalized = re.sub(r'\s+', ' ', normalized)
-        normalized = re.sub(r'\s*\(\s*\d+\s*шт/\s*уп\s*\)', '', normalized)
-        normalized = re.sub(r'\s*\d+\s*шт/\s*уп\.?', '', normalized)
-        normalized = re.sub(r'\s*\(\s*[^)]*\d+\s*мм\s*[^)]*\)', '', normalized)
-        
-        return normalized.strip()
+        # Fallback для строк, которые еще не прошли бэкфилл normalized_name
+        return normalize_product_name(name)
     
     def _improve_category(self, current_category: str, product_name: str) -> str:
         if current_category and current_category != 'Без категории':
@@ -279,16 +349,135 @@ class EnhancedRecommendationEngine:
         self.db = db_service
         self.config = EnhancedRecommendationConfig()
         self.user_profiles = {}
-        self.similarity_matrix = None
+        self.tfidf_matrix = None  # L2-нормированные TF-IDF векторы товаров (CSR)
         self.product_to_index = {}
         self.product_features = {}
+        self.candidate_cache = CandidateCache(**self.config.CANDIDATE_CACHE)
+        self.copurchase_index = None
+        self.copurchase_watermark = None
+        self.catalog_to_copurchase = np.zeros(0, dtype=np.int64)
+        self.als_model = None
+        self.catalog_to_als = np.zeros(0, dtype=np.int64)
+        self.attribute_store = AttributeStore()
         
     async def initialize_engine(self):
-        products = await self.db.get_available_products(10000)
-        self._build_similarity_matrix(products)
+        if self.config.SHARED_ARRAYS_DIR:
+            await self._initialize_shared()
+        else:
+            products = await self.db.get_available_products(self.config.CATALOG_LIMIT)
+            self._build_content_index(products)
+        await self._build_copurchase_index()
+        self._load_als_model()
         logger.info("Enhanced recommendation engine initialized")
     
-    def _build_similarity_matrix(self, products: List[Dict]):
+    def _load_als_model(self):
+        model_dir = self.config.MATRIX_FACTORIZATION['model_dir']
+        if not model_dir:
+            return
+        self.als_model = ImplicitALS.load(model_dir)
+        if self.als_model is None:
+            logger.warning(f"No ALS model published in {model_dir}, matrix factorization is disabled")
+            return
+        item_to_index = self.als_model.item_to_index
+        self.catalog_to_als = np.array([item_to_index.get(pid, -1) for pid in self.product_ids], dtype=np.int64)
+        logger.info(f"ALS model loaded: {len(self.als_model.user_ids)} buyers, {len(self.als_model.item_ids)} items")
+    
+    def _als_scores(self, user_profile: Dict) -> Optional[np.ndarray]:
+        """Скоры каталога в [0, 1] по вектору пользователя в ALS (fold-in по истории для новых)"""
+        if self.als_model is None:
+            return None
+        
+        scores = self.als_model.score_items(user_profile['user_id'], user_profile['product_frequencies'])
+        if scores is None:
+            return None
+        
+        mapping = self.catalog_to_als
+        catalog_scores = np.where(mapping >= 0, np.maximum(scores[np.maximum(mapping, 0)], 0), 0.0)
+        peak = catalog_scores.max() if len(catalog_scores) else 0
+        if peak <= 0:
+            return None
+        return catalog_scores / peak
+    
+    async def _build_copurchase_index(self):
+        baskets, self.copurchase_watermark = await self.db.get_procurement_baskets()
+        index = CoPurchaseIndex(**self.config.COPURCHASE['params'])
+        index.add_baskets(baskets)
+        self.copurchase_index = index
+        self._map_copurchase_items()
+    
+    async def refresh_copurchase_index(self):
+        """Дозагрузка новых закупок дельтой к счетчикам совместных покупок.
+        
+        Закупки, затронутые после watermark (с запасом watermark_overlap), перечитываются целиком:
+        в уже учтенных добавляются только новые позиции.
+        """
+        if self.copurchase_index is None or self.copurchase_watermark is None:
+            return await self._build_copurchase_index()
+        
+        since = self.copurchase_watermark - timedelta(seconds=self.config.COPURCHASE['watermark_overlap'])
+        baskets, watermark = await self.db.get_procurement_baskets(since)
+        self.copurchase_watermark = max(watermark, self.copurchase_watermark)
+        if self.copurchase_index.add_baskets(baskets):
+            self._map_copurchase_items()
+            self.candidate_cache.invalidate()
+    
+    def _map_copurchase_items(self):
+        # Строка каталога -> индекс товара в CF-матрице (-1, если товар ни разу не покупали)
+        item_to_index = self.copurchase_index.item_to_index
+        self.catalog_to_copurchase = np.array([item_to_index.get(pid, -1) for pid in self.product_ids], dtype=np.int64)
+    
+    def _copurchase_scores(self, user_profile: Dict) -> Optional[np.ndarray]:
+        """CF-скоры каталога в [0, 1] по истории пользователя, None - нет сигнала"""
+        if self.copurchase_index is None or not user_profile['purchased_products']:
+            return None
+        
+        scores = self.copurchase_index.score_history({pid: 1.0 for pid in user_profile['purchased_products']})
+        if scores is None:
+            return None
+        
+        mapping = self.catalog_to_copurchase
+        catalog_scores = np.where(mapping >= 0, scores[np.maximum(mapping, 0)], 0.0)
+        peak = catalog_scores.max() if len(catalog_scores) else 0
+        if peak <= 0:
+            return None
+        return catalog_scores / peak
+    
+    async def _initialize_shared(self):
+        # Лидер строит TF-IDF матрицу и публикует её, остальные воркеры подключаются read-only
+        store = SharedArrayStore(
+            self.config.SHARED_ARRAYS_DIR, 'enhanced',
+            fingerprint=f"tfidf-csr:{self.config.CATALOG_LIMIT}",
+            max_age=self.config.SHARED_ARRAYS_MAX_AGE
+        )
+        
+        if store.is_ready() or (not store.try_become_leader() and await store.wait_until_ready()):
+            self._attach_shared_matrix(store)
+            return
+        
+        try:
+            products = await self.db.get_available_products(self.config.CATALOG_LIMIT)
+            self._build_content_index(products)
+            if self.tfidf_matrix is not None:
+                store.publish(
+                    {'tfidf_matrix': self.tfidf_matrix},
+                    {'products': [self.product_features[pid] for pid in self.product_ids]}
+                )
+        finally:
+            store.release()
+    
+    def _attach_shared_matrix(self, store: SharedArrayStore):
+        arrays, metadata = store.attach()
+        products = metadata['products']
+        
+        self.product_features = {p['product_id']: p for p in products}
+        self.product_ids = [p['product_id'] for p in products]
+        self.tfidf_matrix = arrays['tfidf_matrix']
+        self.product_to_index = {pid: idx for idx, pid in enumerate(self.product_ids)}
+        self._build_product_arrays()
+        
+        logger.info(f"Attached shared TF-IDF matrix for {len(self.product_ids)} products")
+    
+    def _build_content_index(self, products: List[Dict]):
         if not products:
             logger.warning("No products for similarity matrix")
             return
@@ -323,11 +512,34 @@ class EnhancedRecommendationEngine:
             )
             
             tfidf_matrix = self.vectorizer.fit_transform(descriptions)
-            tfidf_matrix_normalized = normalize(tfidf_matrix, norm='l2', axis=1)
-            self.similarity_matrix = cosine_similarity(tfidf_matrix_normalized)
+            # Косинус нормированных векторов - скалярное произведение, плотная N×N матрица не нужна
+            self.tfidf_matrix = normalize(tfidf_matrix, norm='l2', axis=1).tocsr()
             self.product_to_index = {pid: idx for idx, pid in enumerate(self.product_ids)}
+            self._build_product_arrays()
             
-            logger.info(f"Built similarity matrix for {len(self.product_ids)} products")
+            logger.info(f"Built TF-IDF index for {len(self.product_ids)} products "
+                        f"({self.tfidf_matrix.nnz} non-zeros, {self.tfidf_matrix.data.nbytes / 2**20:.1f} MB)")
+    
+    def _build_product_arrays(self):
+        # Не зависящие от пользователя поля каталога в виде массивов для векторного скоринга
+        products = [self.product_features[pid] for pid in self.product_ids]
+        
+        self.category_names = sorted({p.get('category_name', 'Офисные товары') for p in products})
+        category_codes = {name: code for code, name in enumerate(self.category_names)}
+        name_codes = {}
+        
+        self.product_arrays = {
+            'price': np.array([p.get('average_price', 0) for p in products], dtype=np.float64),
+            'category': np.array([category_codes[p.get('category_name', 'Офисные товары')] for p in products],
+                                 dtype=np.int32),
+            'name': np.array([name_codes.setdefault(p['name'], len(name_codes)) for p in products], dtype=np.int64),
+            'availability': np.array([0.9 if p.get('is_available', False) else 0.3 for p in products])
+        }
+        
+        # Характеристики разбираются один раз: фильтры и схожесть дальше - операции над массивами
+        self.attribute_store = AttributeStore.build(p.get('specifications') for p in products)
+        logger.info(f"Attribute store: {len(self.attribute_store.keys)} keys, "
+                    f"{len(self.attribute_store.values)} values, {len(self.attribute_store)} entries")
     
     def _get_product_similarity(self, product_id1, product_id2):
         if (product_id1 in self.product_to_index and 
@@ -336,12 +548,32 @@ class EnhancedRecommendationEngine:
             idx1 = self.product_to_index[product_id1]
             idx2 = self.product_to_index[product_id2]
             
-            return self.similarity_matrix[idx1, idx2]
+            return self.tfidf_matrix[idx1].multiply(self.tfidf_matrix[idx2]).sum()
         
         return 0
     
+    def _content_similarity(self, user_profile: Dict) -> np.ndarray:
+        """Максимальная схожесть каждого товара каталога с купленными.
+        
+        Результат живет в пуле кандидатов пользователя (CandidateCache), а не в профиле,
+        чтобы память на пользователя не росла вместе с каталогом.
+        """
+        purchased_rows = sorted({self.product_to_index[pid] for pid in user_profile['purchased_products']
+                                 if pid in self.product_to_index})
+        similarity = np.zeros(len(self.product_ids))
+        
+        # Одно разреженное произведение купленных строк на всю матрицу и максимум по столбцам
+        chunk_size = self.config.CONTENT_SIMILARITY_CHUNK
+        for start in range(0, len(purchased_rows), chunk_size):
+            chunk = self.tfidf_matrix[purchased_rows[start:start + chunk_size]]
+            products = chunk @ self.tfidf_matrix.T
+            np.maximum(similarity, products.max(axis=0).toarray().ravel(), out=similarity)
+        
+        return similarity
+    
     def create_user_profile(self, user_id: str, procurements: List[Dict]):
         user_profile = {
+            'user_id': user_id,
             'product_frequencies': Counter(),
             'preferred_categories': Counter(),
             'price_preferences': defaultdict(list),
@@ -410,47 +642,87 @@ class EnhancedRecommendationEngine:
         return patterns
     
     def calculate_enhanced_product_score(self, product_id: str, user_profile: Dict):
-        product = self.product_features.get(product_id, {})
+        if product_id not in self.product_to_index:
+            return {'total_score': 0, 'component_scores': {}, 'explanation': '', 'confidence': 0}
+        
+        product = self.product_features[product_id]
+        scores = self._score_rows(np.array([self.product_to_index[product_id]]), user_profile)
+        component_scores = {factor: float(scores[factor][0]) for factor in (*self.config.WEIGHTS, 'matrix_factorization')}
         
-        scores = {
-            'content_similarity': 0,
-            'collaborative_filtering': 0,
-            'availability': 0,
-            'price_affordability': 0
+        return {
+            'total_score': float(scores['total_score'][0]),
+            'component_scores': component_scores,
+            'explanation': self._generate_enhanced_explanation(component_scores, product, user_profile),
+            'confidence': self._calculate_confidence_level(component_scores, product)
         }
+    
+    def _user_signals(self, rows: np.ndarray, user_profile: Dict) -> Dict[str, Optional[np.ndarray]]:
+        """Дорогие пользовательские сигналы для строк каталога (хранятся в пуле кандидатов)"""
+        content_similarity = np.zeros(len(rows))
+        if user_profile['purchased_products']:
+            content_similarity = self._content_similarity(user_profile)[rows]
         
+        copurchase = self._copurchase_scores(user_profile)
+        matrix_factorization = self._als_scores(user_profile)
+        return {
+            'content_similarity': content_similarity,
+            'copurchase': copurchase[rows] if copurchase is not None else None,
+            'matrix_factorization': matrix_factorization[rows] if matrix_factorization is not None else None
+        }
+    
+    def _score_rows(self, rows: np.ndarray, user_profile: Dict,
+                    signals: Optional[Dict[str, Optional[np.ndarray]]] = None) -> Dict[str, np.ndarray]:
+        """Векторизованный расчет компонент и итогового скора для строк каталога"""
+        arrays = self.product_arrays
         weights = self.config.WEIGHTS
         
-        if user_profile['purchased_products']:
-            max_similarity = 0
-            for purchased_id in user_profile['purchased_products']:
-                similarity = self._get_product_similarity(purchased_id, product_id)
-                max_similarity = max(max_similarity, similarity)
-            
-            scores['content_similarity'] = max_similarity
+        if signals is None:
+            signals = self._user_signals(rows, user_profile)
+        content_similarity = signals['content_similarity']
         
-        category = product.get('category_name', 'Офисные товары')
-        if category in user_profile['category_weights']:
-            scores['collaborative_filtering'] = user_profile['category_weights'][category]
+        if signals['copurchase'] is not None:
+            # Совместные покупки с товарами из истории пользователя
+            collaborative = signals['copurchase']
         else:
-            scores['collaborative_filtering'] = 0.1
+            # Нет сигнала совместных покупок: вес категории пользователя, для незнакомых категорий - 0.1
+            category_weights = np.full(len(self.category_names), 0.1)
+            for code, category in enumerate(self.category_names):
+                if category in user_profile['category_weights']:
+                    category_weights[code] = user_profile['category_weights'][category]
+            collaborative = category_weights[arrays['category'][rows]]
         
-        scores['availability'] = 0.9 if product.get('is_available', False) else 0.3
+        availability = arrays['availability'][rows]
         
-        product_price = product.get('average_price', 0)
-        if product_price > 0 and user_profile['total_spent'] > 0:
+        price_affordability = np.zeros(len(rows))
+        if user_profile['total_spent'] > 0:
             user_avg_price = user_profile['total_spent'] / max(1, sum(user_profile['product_frequencies'].values()))
             if user_avg_price > 0:
-                price_ratio = min(product_price, user_avg_price) / max(product_price, user_avg_price)
-                scores['price_affordability'] = price_ratio
-        
-        total_score = sum(scores[factor] * weights[factor] for factor in scores)
+                prices = arrays['price'][rows]
+                price_affordability = np.where(
+                    prices > 0,
+                    np.minimum(prices, user_avg_price) / np.maximum(prices, user_avg_price),
+                    0
+                )
+        
+        total = (content_similarity * weights['content_similarity']
+                 + collaborative * weights['collaborative_filtering']
+                 + availability * weights['availability']
+                 + price_affordability * weights['price_affordability'])
+        
+        matrix_factorization = signals['matrix_factorization']
+        if matrix_factorization is not None:
+            mf_weight = self.config.MATRIX_FACTORIZATION['weight']
+            total = total * (1 - mf_weight) + matrix_factorization * mf_weight
+        else:
+            matrix_factorization = np.zeros(len(rows))
         
         return {
-            'total_score': total_score,
-            'component_scores': scores,
-            'explanation': self._generate_enhanced_explanation(scores, product, user_profile),
-            'confidence': self._calculate_confidence_level(scores, product)
+            'content_similarity': content_similarity,
+            'collaborative_filtering': collaborative,
+            'availability': availability,
+            'price_affordability': price_affordability,
+            'matrix_factorization': matrix_factorization,
+            'total_score': total
         }
     
     def _generate_enhanced_explanation(self, scores: Dict, product: Dict, user_profile: Dict):
@@ -464,6 +736,9 @@ class EnhancedRecommendationEngine:
         if scores['collaborative_filtering'] > 0.6:
             explanations.append("соответствует вашим предпочтениям")
         
+        if scores['matrix_factorization'] > 0.6:
+            explanations.append("покупают заказчики с похожей историей закупок")
+        
         if scores['availability'] > 0.8:
             explanations.append("доступен для заказа")
         
@@ -503,59 +778,36 @@ class EnhancedRecommendationEngine:
         
         return np.mean(confidence_factors)
     
-    async def generate_recommendations(self, user_id: str, limit: int = 15, strategy: str = "balanced"):
-        user_procurements = await self.db.get_user_procurements(user_id)
-        
-        if user_id not in self.user_profiles:
-            self.create_user_profile(user_id, user_procurements)
-        
-        user_profile = self.user_profiles[user_id]
-        purchased_products = user_profile['purchased_products']
-        
-        recommendations = []
-        seen_names = set()
-        
-        for product_id in self.product_ids:
-            if product_id in purchased_products:
-                continue
-            
-            product = self.product_features[product_id]
-            product_name = product['name']
-            
-            if product_name in seen_names:
-                continue
-            seen_names.add(product_name)
-            
-            score_result = self.calculate_enhanced_product_score(product_id, user_profile)
-            
-            if score_result['total_score'] > 0.1:
-                recommendations.append({
-                    'product_id': product_id,
-                    'product_name': product_name,
-                    'product_category': product.get('category_name', 'Офисные товары'),
-                    'total_score': round(score_result['total_score'], 4),
-                    'component_scores': score_result['component_scores'],
-                    'explanation': score_result['explanation'],
-                    'confidence': score_result['confidence'],
-                    'price_range': {
-                        'avg': product.get('average_price', 0),
-                        'min': product.get('average_price', 0) * 0.8,
-                        'max': product.get('average_price', 0) * 1.2,
-                        'source': 'database_real'
-                    },
-                    'in_catalog': True,
-                    'is_available': product.get('is_available', False),
-                    'purchase_count': product.get('purchase_count', 0)
-                })
+    async def generate_recommendations(self, user_id: str, limit: int = 15, strategy: str = "balanced",
+                                       attributes: Optional[Dict[str, Any]] = None):
+        # Пул общий для всех стратегий и для наборов - здесь только переранжирование
+        pool = await self.candidate_cache.get_or_compute(
+            user_id, len(self.product_ids), lambda: self._build_candidate_pool(user_id)
+        )
+        rows, total_scores = pool['rows'], pool['total_score']
         
-        recommendations.sort(key=lambda x: x['total_score'], reverse=True)
+        # Фильтр по характеристикам - маска по инвертированному индексу, пул не пересчитывается
+        order = np.arange(len(rows))
+        if attributes:
+            order = order[self.attribute_store.match(rows, attributes)]
         
+        # Пул отсортирован по скору; стабильная сортировка по цене сохраняет его для равных цен
         if strategy == "budget":
-            recommendations.sort(key=lambda x: x['price_range']['avg'])
+            order = order[np.argsort(self.product_arrays['price'][rows[order]], kind='stable')]
         elif strategy == "premium":
-            recommendations.sort(key=lambda x: x['price_range']['avg'], reverse=True)
+            order = order[np.argsort(-self.product_arrays['price'][rows[order]], kind='stable')]
+        
+        selected = self._apply_diversification(order, self.product_arrays['category'][rows], total_scores, limit)
         
-        final_recommendations = self._apply_diversification(recommendations, limit)
+        # Компоненты, объяснения и словари - только для итоговых top-N
+        selected_rows = rows[selected]
+        signals = {name: values[selected] if values is not None else None for name, values in pool['signals'].items()}
+        scores = self._score_rows(selected_rows, self.user_profiles[user_id], signals)
+        final_recommendations = [
+            self._build_recommendation(row, {name: values[i] for name, values in scores.items()},
+                                       total_scores[index], self.user_profiles[user_id])
+            for i, (row, index) in enumerate(zip(selected_rows, selected))
+        ]
         
         if final_recommendations:
             scores = [r['total_score'] for r in final_recommendations]
@@ -563,28 +815,119 @@ class EnhancedRecommendationEngine:
         
         return final_recommendations
     
-    def _apply_diversification(self, candidates: List[Dict], top_n: int):
+    async def _build_candidate_pool(self, user_id: str) -> Dict:
+        """Скоринг каталога для пользователя, кандидаты по убыванию скора (кэшируется на TTL)"""
+        user_procurements = await self.db.get_user_procurements(user_id)
+        
+        if user_id not in self.user_profiles:
+            self.create_user_profile(user_id, user_procurements)
+        
+        user_profile = self.user_profiles[user_id]
+        
+        # Исключаем купленные и дубликаты по названию (первое вхождение в порядке каталога)
+        purchased_rows = [self.product_to_index[pid] for pid in user_profile['purchased_products']
+                          if pid in self.product_to_index]
+        rows = np.arange(len(self.product_ids))
+        rows = rows[~np.isin(rows, purchased_rows)]
+        _, first_rows = np.unique(self.product_arrays['name'][rows], return_index=True)
+        rows = rows[np.sort(first_rows)]
+        
+        signals = self._user_signals(rows, user_profile)
+        scores = self._score_rows(rows, user_profile, signals)
+        total_scores = np.round(scores['total_score'], 4)
+        passed = np.flatnonzero(scores['total_score'] > 0.1)
+        
+        order = passed[np.argsort(-total_scores[passed], kind='stable')]
+        return {
+            'rows': rows[order],
+            'total_score': total_scores[order],
+            'signals': {name: values[order] if values is not None else None for name, values in signals.items()}
+        }
+    
+    def _build_recommendation(self, row: int, component_scores: Dict, total_score: float, user_profile: Dict) -> Dict:
+        product_id = self.product_ids[row]
+        product = self.product_features[product_id]
+        component_scores = {factor: float(component_scores[factor]) for factor in (*self.config.WEIGHTS, 'matrix_factorization')}
+        
+        return {
+            'product_id': product_id,
+            'product_name': product['name'],
+            'product_category': product.get('category_name', 'Офисные товары'),
+            'total_score': float(total_score),
+            'component_scores': component_scores,
+            'explanation': self._generate_enhanced_explanation(component_scores, product, user_profile),
+            'confidence': self._calculate_confidence_level(component_scores, product),
+            'price_range': {
+                'avg': product.get('average_price', 0),
+                'min': product.get('average_price', 0) * 0.8,
+                'max': product.get('average_price', 0) * 1.2,
+                'source': 'database_real'
+            },
+            'in_catalog': True,
+            'is_available': product.get('is_available', False),
+            'purchase_count': product.get('purchase_count', 0)
+        }
+    
+    def _apply_diversification(self, order: np.ndarray, categories: np.ndarray,
+                               total_scores: np.ndarray, top_n: int) -> List[int]:
         selected = []
         selected_categories = Counter()
+        max_per_category = self.config.DIVERSITY['max_per_category']
         
-        for candidate in candidates:
+        for i in order:
             if len(selected) >= top_n:
                 break
-                
-            category = candidate['product_category']
-            max_per_category = self.config.DIVERSITY['max_per_category']
             
+            category = categories[i]
             if selected_categories[category] < max_per_category:
-                selected.append(candidate)
+                selected.append(i)
                 selected_categories[category] += 1
         
         if len(selected) < top_n:
-            remaining = [c for c in candidates if c not in selected]
-            remaining.sort(key=lambda x: x['total_score'], reverse=True)
+            remaining = np.setdiff1d(order, selected, assume_unique=True)
+            remaining = remaining[np.argsort(-total_scores[remaining], kind='stable')]
             selected.extend(remaining[:top_n - len(selected)])
         
         return selected[:top_n]
     
+    def similar_products(self, product_id: str, limit: int = 10,
+                         attributes: Optional[Dict[str, Any]] = None) -> List[Dict]:
+        """Похожие товары: TF-IDF и общие характеристики, с необязательным фильтром по характеристикам"""
+        if product_id not in self.product_to_index:
+            return []
+        
+        row = self.product_to_index[product_id]
+        weight = self.config.ATTRIBUTE_SIMILARITY_WEIGHT
+        content = (self.tfidf_matrix[row] @ self.tfidf_matrix.T).toarray().ravel()
+        by_attributes = self.attribute_store.similarity([row])
+        similarity = content * (1 - weight) + by_attributes * weight
+        
+        # Без самого товара и его дубликатов по названию
+        candidates = np.flatnonzero(self.product_arrays['name'] != self.product_arrays['name'][row])
+        if attributes:
+            candidates = candidates[self.attribute_store.match(candidates, attributes)]
+        candidates = candidates[similarity[candidates] > 0]
+        
+        if len(candidates) > limit:
+            top = np.argpartition(-similarity[candidates], limit - 1)[:limit]
+            candidates = candidates[top]
+        candidates = candidates[np.argsort(-similarity[candidates], kind='stable')]
+        
+        results = []
+        for candidate in candidates:
+            product = self.product_features[self.product_ids[candidate]]
+            results.append({
+                'product_id': product['product_id'],
+                'product_name': product['name'],
+                'product_category': product.get('category_name', 'Офисные товары'),
+                'similarity': round(float(similarity[candidate]), 4),
+                'content_similarity': round(float(content[candidate]), 4),
+                'attribute_similarity': round(float(by_attributes[candidate]), 4),
+                'price': product.get('average_price', 0),
+                'is_available': product.get('is_available', False)
+            })
+        return results
+    
     async def generate_procurement_bundle(self, user_id: str, target_budget: float = 50000, 
                                         max_items: int = 10, strategy: str = "balanced"):
         recommendations = await self.generate_recommendations(user_id, max_items * 2, strategy)
@@ -608,7 +951,8 @@ class EnhancedRecommendationEngine:
             avg_price = rec['price_range']['avg']
             
             if current_cost + avg_price <= target_budget:
-                rec['estimated_price'] = avg_price
+                # Копия: рекомендации ссылаются на закэшированный пул кандидатов
+                rec = dict(rec, estimated_price=avg_price)
                 selected_products.append(rec)
                 current_cost += avg_price
                 categories_covered.add(rec['product_category'])
@@ -633,8 +977,21 @@ recommendation_engine = EnhancedRecommendationEngine(db_service)
 async def startup_event():
     await db_service.connect()
     await recommendation_engine.initialize_engine()
+    app.state.copurchase_refresh_task = asyncio.create_task(_refresh_copurchase_periodically())
     logger.info("Enhanced recommendation engine initialized")
 
+async def _refresh_copurchase_periodically():
+    while True:
+        await asyncio.sleep(recommendation_engine.config.COPURCHASE['refresh_interval'])
+        try:
+            await recommendation_engine.refresh_copurchase_index()
+        except Exception as e:
+            logger.error(f"Co-purchase index refresh failed: {e}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.copurchase_refresh_task.cancel()
+
 @app.get("/")
 async def root():
     return {
@@ -659,8 +1016,11 @@ async def health_check():
             "database": "connected", 
             "total_products": stats['total_products'],
             "available_products": stats['available_products'],
-            "similarity_matrix": recommendation_engine.similarity_matrix is not None,
+            "tfidf_matrix": recommendation_engine.tfidf_matrix is not None,
             "products_loaded": len(recommendation_engine.product_features),
+            "copurchase_items": len(recommendation_engine.copurchase_index or ()),
+            "als_model": recommendation_engine.als_model is not None,
+            "attribute_keys": len(recommendation_engine.attribute_store.keys),
             "timestamp": datetime.now().isoformat()
         }
     except Exception as e:
@@ -674,7 +1034,8 @@ async def get_recommendations(request: RecommendationRequest):
         recommendations = await recommendation_engine.generate_recommendations(
             user_id=request.user_id,
             limit=request.limit,
-            strategy=request.strategy
+            strategy=request.strategy,
+            attributes=request.attributes
         )
         
         return RecommendationResponse(
@@ -710,6 +1071,22 @@ async def generate_bundle(request: BundleRequest):
         logger.error(f"Bundle generation error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/similar")
+async def get_similar_products(request: SimilarProductsRequest):
+    try:
+        similar = recommendation_engine.similar_products(request.product_id, request.limit, request.attributes)
+        return {"product_id": request.product_id, "similar_count": len(similar), "similar": similar}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Similar products error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/attributes/{key}")
+async def get_attribute_values(key: str, top: int = 20):
+    values = recommendation_engine.attribute_store.value_counts(key, top)
+    return {"key": key, "values": [{"value": value, "products": count} for value, count in values]}
+
 @app.get("/api/ml/health")
 async def ml_health():
     return await health_check()
@@ -0,0 +1,79 @@
+# popularity_index.py - Популярность товаров по экспоненциально затухающим счетчикам покупок
+import math
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+
+class PopularityIndex:
+    """product_id -> нормированная популярность за O(1), по всему каталогу.
+
+    Каждая покупка в момент t дает вклад exp(-ln2 * (now - t) / half_life).
+    Счетчики хранятся относительно фиксированной точки отсчета: s = sum exp(k * (t - t0)).
+    Общий множитель exp(-k * (now - t0)) сокращается при нормировке на максимум,
+    поэтому новые покупки просто прибавляются, а пересчитывать старые не нужно.
+    """
+
+    # Перенос точки отсчета, пока экспоненты далеки от переполнения float64
+    MAX_EXPONENT = 300.0
+
+    def __init__(self, half_life_days: float = 90.0, default_score: float = 0.1):
+        self.half_life_days = half_life_days
+        self.default_score = default_score
+        self.decay_rate = math.log(2) / (half_life_days * 86400.0)
+        self.origin: Optional[float] = None
+        self.product_to_index: Dict[str, int] = {}
+        self.counts = np.zeros(0, dtype=np.float64)
+        self.scores = np.zeros(0, dtype=np.float64)
+        self.events = 0
+
+    def __len__(self) -> int:
+        return len(self.product_to_index)
+
+    def add_events(self, product_ids: List[str], event_times: Iterable[float],
+                   weights: Optional[Iterable[float]] = None):
+        """Учесть покупки (event_times - unix-время в секундах)"""
+        if not product_ids:
+            return
+
+        times = np.asarray(list(event_times), dtype=np.float64)
+        weights = np.ones(len(times)) if weights is None else np.asarray(list(weights), dtype=np.float64)
+        if self.origin is None:
+            self.origin = float(times.max())
+
+        exponents = self.decay_rate * (times - self.origin)
+        if exponents.max() > self.MAX_EXPONENT:
+            # Сдвигаем точку отсчета вперед: все счетчики умножаются на одну константу
+            shift = float(exponents.max())
+            self.counts *= math.exp(-shift)
+            self.origin += shift / self.decay_rate
+            exponents -= shift
+
+        codes = np.fromiter((self.product_to_index.setdefault(pid, len(self.product_to_index)) for pid in product_ids),
+                            dtype=np.int64, count=len(product_ids))
+        if len(self.product_to_index) > len(self.counts):
+            self.counts = np.concatenate([self.counts, np.zeros(len(self.product_to_index) - len(self.counts))])
+
+        np.add.at(self.counts, codes, weights * np.exp(exponents))
+        self.events += len(product_ids)
+
+        peak = self.counts.max()
+        self.scores = np.maximum(self.counts / peak, self.default_score) if peak > 0 else np.full(len(self.counts), self.default_score)
+
+    def score(self, product_id: str) -> float:
+        index = self.product_to_index.get(product_id)
+        return float(self.scores[index]) if index is not None else self.default_score
+
+    def bulk_scores(self, product_ids: Iterable[str]) -> np.ndarray:
+        get = self.product_to_index.get
+        codes = np.fromiter((get(pid, -1) for pid in product_ids), dtype=np.int64)
+        return np.where(codes >= 0, self.scores[np.maximum(codes, 0)] if len(self.scores) else 0, self.default_score)
+
+    def top(self, k: int = 10) -> List[tuple]:
+        ids = list(self.product_to_index)
+        k = min(k, len(ids))
+        if k <= 0:
+            return []
+        top = np.argpartition(-self.counts, k - 1)[:k]
+        top = top[np.argsort(-self.counts[top], kind='stable')]
+        return [(ids[i], float(self.scores[i])) for i in top]
@@ -0,0 +1,137 @@
+# product_names.py - Нормализация названий товаров и группы дубликатов (normalized_name, dedup_group_id)
+import asyncio
+import logging
+import re
+from typing import Dict, Optional, Union
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+DB_CONFIG = {
+    'user': 'store_app1',
+    'host': 'localhost',
+    'database': 'pc_db',
+    'password': '1234',
+    'port': 5432
+}
+
+# Те же замены, что в SQL-функции normalize_product_name (server/DB.sql) - менять только вместе
+_NAME_SUBSTITUTIONS = [
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\s*\(\s*\d+\s*шт/\s*уп\s*\)'), ''),  # размер упаковки в скобках (100 шт/уп)
+    (re.compile(r'\s*\d+\s*шт/\s*уп\.?'), ''),
+    (re.compile(r'\s*\(\s*[^)]*\d+\s*мм\s*[^)]*\)'), ''),  # размеры в мм
+    (re.compile(r'\s*\[[^]]*\]'), '')  # пометки в квадратных скобках
+]
+
+
+def normalize_product_name(name: Optional[str]) -> str:
+    """Название для поиска дубликатов. В БД считается триггером при вставке/изменении товара"""
+    if not name:
+        return ""
+
+    normalized = name.lower().strip()
+    for pattern, replacement in _NAME_SUBSTITUTIONS:
+        normalized = pattern.sub(replacement, normalized)
+
+    return normalized.strip()
+
+
+def dedup_key(row) -> Union[int, str]:
+    """Ключ дедупликации строки каталога - целый dedup_group_id.
+
+    Для строк без бэкфилла запросы каталога берут группу по normalized_name из
+    product_name_groups. Если группы для названия еще нет, то и товаров с этой
+    группой нет - ключом служит нормализованное название.
+    """
+    if row['dedup_group_id'] is not None:
+        return row['dedup_group_id']
+    return row['normalized_name'] if row['normalized_name'] is not None else normalize_product_name(row['name'])
+
+
+async def backfill(pool: asyncpg.Pool, batch_size: int = 5000, recompute_all: bool = False) -> Dict:
+    """Заполнение normalized_name/dedup_group_id у существующих товаров батчами по product_id.
+
+    Значения считает та же SQL-функция, что и триггер, поэтому бэкфилл и новые
+    товары не расходятся. recompute_all - пересчет всех строк после изменения правил.
+    """
+    last_id = ''
+    while True:
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                last = await conn.fetchval("""
+                    WITH batch AS (
+                        SELECT product_id FROM products
+                        WHERE product_id > $1 AND ($3 OR dedup_group_id IS NULL)
+                        ORDER BY product_id
+                        LIMIT $2
+                    ), changed AS (
+                        UPDATE products p
+                        SET normalized_name = normalize_product_name(p.name),
+                            dedup_group_id = product_name_group_id(normalize_product_name(p.name))
+                        FROM batch
+                        WHERE p.product_id = batch.product_id
+                        RETURNING p.product_id
+                    )
+                    SELECT MAX(product_id) FROM changed
+                """, last_id, batch_size, recompute_all)
+
+        if last is None:
+            break
+        last_id = last
+        logger.info(f"Backfilled names up to product_id {last_id}")
+
+    async with pool.acquire() as conn:
+        stats = await conn.fetchrow("""
+            SELECT COUNT(*) AS products, COUNT(DISTINCT dedup_group_id) AS groups,
+                   COUNT(*) FILTER (WHERE dedup_group_id IS NULL) AS missing
+            FROM products
+        """)
+
+    result = dict(stats)
+    logger.info(f"Name backfill finished: {result}")
+    return result
+
+
+async def check(pool: asyncpg.Pool, sample: int = 10000) -> int:
+    """Сверка SQL-нормализации с Python-версией на выборке товаров, возвращает число расхождений"""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT name, normalized_name FROM products
+            WHERE normalized_name IS NOT NULL
+            ORDER BY random()
+            LIMIT $1
+        """, sample)
+
+    mismatches = [row for row in rows if normalize_product_name(row['name']) != row['normalized_name']]
+    for row in mismatches[:20]:
+        logger.warning(f"Normalization mismatch: {row['name']!r}: sql={row['normalized_name']!r} "
+                       f"python={normalize_product_name(row['name'])!r}")
+    logger.info(f"Checked {len(rows)} products, {len(mismatches)} mismatches")
+    return len(mismatches)
+
+
+async def main(batch_size: int, recompute_all: bool, check_only: bool):
+    pool = await asyncpg.create_pool(**DB_CONFIG, min_size=1, max_size=2)
+    try:
+        if check_only:
+            await check(pool)
+        else:
+            await backfill(pool, batch_size=batch_size, recompute_all=recompute_all)
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Бэкфилл normalized_name и dedup_group_id в products")
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--all', action='store_true', help="пересчитать и уже заполненные строки")
+    parser.add_argument('--check', action='store_true', help="только сверить SQL и Python нормализацию")
+    args = parser.parse_args()
+
+    asyncio.run(main(args.batch_size, args.all, args.check))
@@ -0,0 +1,149 @@
+# product_stats.py - Инкрементальное обновление предагрегированной статистики товаров
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+DB_CONFIG = {
+    'user': 'store_app1',
+    'host': 'localhost',
+    'database': 'pc_db',
+    'password': '1234',
+    'port': 5432
+}
+
+# Время события для скользящих окон: дата закупки, а если ее нет - время добавления позиции
+RECOMPUTE_QUERY = """
+INSERT INTO product_stats (product_id, purchase_count, unique_buyers, total_quantity,
+                           last_purchased, purchases_30d, purchases_90d, updated_at)
+SELECT
+    pi.product_id,
+    COUNT(*),
+    COUNT(DISTINCT pr.user_id),
+    COALESCE(SUM(pi.quantity), 0),
+    MAX(t.event_time),
+    COUNT(*) FILTER (WHERE t.event_time >= $2::timestamp - INTERVAL '30 days'),
+    COUNT(*) FILTER (WHERE t.event_time >= $2::timestamp - INTERVAL '90 days'),
+    $2::timestamp
+FROM procurement_items pi
+LEFT JOIN procurements pr ON pr.procurement_id = pi.procurement_id
+CROSS JOIN LATERAL (SELECT COALESCE(pr.procurement_date::timestamp, pi.created_at) AS event_time) t
+WHERE pi.product_id = ANY($1::varchar[])
+GROUP BY pi.product_id
+"""
+
+
+class ProductStatsRefresher:
+    """Поддерживает таблицу product_stats в актуальном состоянии.
+
+    Пересчитываются только затронутые товары: с новыми позициями после
+    водяного знака (с запасом на поздно закоммиченные транзакции) и те,
+    у которых покупки выпали из 30/90-дневных окон с прошлого запуска.
+    Удаление позиций инкрементально не отслеживается - для этого есть full.
+    """
+
+    WATERMARK_OVERLAP = timedelta(minutes=5)
+    BATCH_SIZE = 5000
+
+    def __init__(self, pool: asyncpg.Pool):
+        self.pool = pool
+
+    async def refresh(self, full: bool = False) -> Dict:
+        start_time = datetime.now()
+
+        async with self.pool.acquire() as conn:
+            now = await conn.fetchval("SELECT LOCALTIMESTAMP")
+            state = await conn.fetchrow("SELECT watermark, refreshed_at FROM product_stats_state WHERE id")
+
+            if full or state is None or state['watermark'] is None:
+                full = True
+                product_ids = await self._all_products(conn)
+            else:
+                product_ids = await self._touched_products(conn, state['watermark'], state['refreshed_at'], now)
+
+        for start in range(0, len(product_ids), self.BATCH_SIZE):
+            await self._recompute(product_ids[start:start + self.BATCH_SIZE], now)
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if full:
+                    # Товары, у которых больше нет позиций закупок
+                    await conn.execute("""
+                        DELETE FROM product_stats s
+                        WHERE NOT EXISTS (SELECT 1 FROM procurement_items pi WHERE pi.product_id = s.product_id)
+                    """)
+                await conn.execute("""
+                    INSERT INTO product_stats_state (id, watermark, refreshed_at) VALUES (TRUE, $1, $1)
+                    ON CONFLICT (id) DO UPDATE SET watermark = EXCLUDED.watermark, refreshed_at = EXCLUDED.refreshed_at
+                """, now)
+
+        result = {
+            'mode': 'full' if full else 'incremental',
+            'products_recomputed': len(product_ids),
+            'watermark': now.isoformat(),
+            'duration': (datetime.now() - start_time).total_seconds()
+        }
+        logger.info(f"Product stats refreshed: {result}")
+        return result
+
+    async def _all_products(self, conn) -> List[str]:
+        rows = await conn.fetch("SELECT DISTINCT product_id FROM procurement_items WHERE product_id IS NOT NULL")
+        return [row['product_id'] for row in rows]
+
+    async def _touched_products(self, conn, watermark: datetime, refreshed_at: Optional[datetime],
+                                now: datetime) -> List[str]:
+        refreshed_at = refreshed_at or watermark
+        rows = await conn.fetch("""
+            SELECT DISTINCT pi.product_id
+            FROM procurement_items pi
+            WHERE pi.created_at > $1 AND pi.product_id IS NOT NULL
+            UNION
+            SELECT DISTINCT pi.product_id
+            FROM procurement_items pi
+            JOIN procurements pr ON pr.procurement_id = pi.procurement_id
+            WHERE pi.product_id IS NOT NULL
+            AND (
+                pr.procurement_date::timestamp >= $2::timestamp - INTERVAL '30 days'
+                AND pr.procurement_date::timestamp < $3::timestamp - INTERVAL '30 days'
+                OR pr.procurement_date::timestamp >= $2::timestamp - INTERVAL '90 days'
+                AND pr.procurement_date::timestamp < $3::timestamp - INTERVAL '90 days'
+            )
+        """, watermark - self.WATERMARK_OVERLAP, refreshed_at, now)
+        return [row['product_id'] for row in rows]
+
+    async def _recompute(self, product_ids: List[str], now: datetime):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM product_stats WHERE product_id = ANY($1::varchar[])", product_ids)
+                await conn.execute(RECOMPUTE_QUERY, product_ids, now)
+
+
+async def main(full: bool = False, interval: Optional[float] = None):
+    pool = await asyncpg.create_pool(**DB_CONFIG, min_size=1, max_size=2)
+    refresher = ProductStatsRefresher(pool)
+    try:
+        while True:
+            await refresher.refresh(full=full)
+            if interval is None:
+                break
+            full = False
+            await asyncio.sleep(interval)
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Обновление таблицы product_stats")
+    parser.add_argument('--full', action='store_true', help="полный пересчет (после импорта или удаления закупок)")
+    parser.add_argument('--interval', type=float, help="повторять каждые N секунд")
+    args = parser.parse_args()
+
+    asyncio.run(main(full=args.full, interval=args.interval))
@@ -0,0 +1,38 @@
+# product_texts.py - Текст товара для эмбеддинга и ключ кэша: общие для bert_main и clean_data/embedding_job
+
+
+def embedding_text(row) -> str:
+    """Текст товара для BERT: название, категория, описание, производитель, характеристики, единица"""
+    texts = []
+
+    if row['name']:
+        texts.append(str(row['name']))
+    if row['category_name']:
+        texts.append(str(row['category_name']))
+    if row['description']:
+        desc = str(row['description']).strip()
+        if len(desc) > 10:
+            texts.append(desc[:300])
+    if row['manufacturer']:
+        texts.append(str(row['manufacturer']))
+    if row['specifications']:
+        specs = str(row['specifications']).strip()
+        if len(specs) > 10:
+            texts.append(specs[:200])
+    if row['unit_of_measure']:
+        texts.append(str(row['unit_of_measure']))
+
+    return ". ".join(texts)
+
+
+def canonical_text(text: str) -> str:
+    # Тексты, различающиеся только пробелами, дают одинаковые токены - кодируем один раз
+    return ' '.join(text.split())
+
+
+def embedding_model_key(model_name: str, backend: str) -> str:
+    """Модель в ключе EmbeddingCache"""
+    # int8-квантованная модель дает немного другие векторы - не смешиваем их в кэше с float
+    if backend == 'torch_int8':
+        return f"{model_name}:int8"
+    return model_name
@@ -0,0 +1,171 @@
+# quantized_store.py - Квантованное хранение эмбеддингов с точным переранжированием
+import json
+import logging
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from vector_index import _kmeans, _top_k
+
+logger = logging.getLogger(__name__)
+
+
+class QuantizedEmbeddingStore:
+    """Сжатая копия матрицы эмбеддингов для быстрого приближенного скана.
+
+    Режимы:
+    - float16: половинная точность (x2 по памяти)
+    - int8: симметричное квантование со своим масштабом на каждую размерность (x4)
+    - pq: product quantization, m подпространств по 256 центроидов (x4·dsub)
+
+    Приближенные скоры используются только для отбора кандидатов, итоговый
+    порядок top-k считается по точным float32 векторам (например, memmap).
+    """
+
+    MODES = ('float16', 'int8', 'pq')
+
+    def __init__(self, mode: str = 'int8', pq_m: int = 48, block_size: int = 2048):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown quantization mode: {mode}")
+        self.mode = mode
+        self.pq_m = pq_m
+        self.block_size = block_size
+        self.dim = 0
+        self.size = 0
+        self.data = None
+        self.scale = None
+        self.codebooks = None
+
+    def build(self, vectors: np.ndarray):
+        self.size, self.dim = vectors.shape
+
+        if self.mode == 'float16':
+            self.data = np.empty((self.size, self.dim), dtype=np.float16)
+            for start in range(0, self.size, self.block_size):
+                self.data[start:start + self.block_size] = vectors[start:start + self.block_size]
+
+        elif self.mode == 'int8':
+            max_abs = np.zeros(self.dim, dtype=np.float32)
+            for start in range(0, self.size, self.block_size):
+                block = np.abs(np.asarray(vectors[start:start + self.block_size], dtype=np.float32))
+                max_abs = np.maximum(max_abs, block.max(axis=0))
+            self.scale = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+            self.data = np.empty((self.size, self.dim), dtype=np.int8)
+            for start in range(0, self.size, self.block_size):
+                block = np.asarray(vectors[start:start + self.block_size], dtype=np.float32)
+                self.data[start:start + self.block_size] = np.clip(np.rint(block / self.scale), -127, 127)
+
+        else:
+            if self.dim % self.pq_m:
+                raise ValueError(f"Dimension {self.dim} is not divisible by pq_m={self.pq_m}")
+            dsub = self.dim // self.pq_m
+            rng = np.random.default_rng(42)
+            sample_idx = np.sort(rng.choice(self.size, min(self.size, 256 * 40), replace=False))
+            sample = np.asarray(vectors[sample_idx], dtype=np.float32)
+            ksub = min(256, len(sample))
+            self.codebooks = np.stack([
+                _kmeans(sample[:, j * dsub:(j + 1) * dsub], ksub) for j in range(self.pq_m)
+            ])
+            self.data = np.empty((self.size, self.pq_m), dtype=np.uint8)
+            for start in range(0, self.size, self.block_size):
+                block = np.asarray(vectors[start:start + self.block_size], dtype=np.float32)
+                for j in range(self.pq_m):
+                    sub = block[:, j * dsub:(j + 1) * dsub]
+                    book = self.codebooks[j]
+                    self.data[start:start + self.block_size, j] = np.argmax(
+                        sub @ book.T - 0.5 * (book ** 2).sum(axis=1), axis=1)
+
+        logger.info(f"Quantized {self.size} embeddings ({self.mode}): "
+                    f"{self.memory_bytes() / 2**20:.1f} MB vs {self.size * self.dim * 4 / 2**20:.1f} MB float32")
+        return self
+
+    def memory_bytes(self) -> int:
+        total = self.data.nbytes if self.data is not None else 0
+        for extra in (self.scale, self.codebooks):
+            if extra is not None:
+                total += extra.nbytes
+        return total
+
+    def approximate_scores(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Приближенные скалярные произведения query со всеми (или выбранными) строками"""
+        query = np.asarray(query, dtype=np.float32)
+        data = self.data if rows is None else self.data[rows]
+
+        if self.mode == 'pq':
+            dsub = self.dim // self.pq_m
+            table = np.einsum('jkd,jd->jk', self.codebooks, query.reshape(self.pq_m, dsub))
+            scores = np.empty(len(data), dtype=np.float32)
+            for start in range(0, len(data), self.block_size):
+                codes = data[start:start + self.block_size]
+                scores[start:start + self.block_size] = table[np.arange(self.pq_m), codes].sum(axis=1)
+            return scores
+
+        # Для int8 масштаб переносится в запрос: q·(codes*scale) = (q*scale)·codes
+        if self.mode == 'int8':
+            query = query * self.scale
+        scores = np.empty(len(data), dtype=np.float32)
+        for start in range(0, len(data), self.block_size):
+            scores[start:start + self.block_size] = data[start:start + self.block_size].astype(np.float32) @ query
+        return scores
+
+    def search(self, query: np.ndarray, k: int, exact_vectors: Optional[np.ndarray] = None,
+               rerank: int = 300, exclude: Optional[Iterable[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k строк: приближенный скан + точное переранжирование top-rerank"""
+        scores = self.approximate_scores(query)
+        if exclude is not None:
+            scores[np.asarray(list(exclude), dtype=np.int64)] = -np.inf
+
+        shortlist = _top_k(scores, max(k, rerank) if exact_vectors is not None else k)
+        shortlist = shortlist[np.isfinite(scores[shortlist])]
+        if exact_vectors is None:
+            return shortlist, scores[shortlist]
+
+        # Точные скоры читаются только для короткого списка (memmap не поднимается в RAM целиком)
+        order = np.sort(shortlist)
+        exact = np.asarray(exact_vectors[order], dtype=np.float32) @ np.asarray(query, dtype=np.float32)
+        top = _top_k(exact, k)
+        return order[top], exact[top]
+
+    def measure_quality(self, exact_vectors: np.ndarray, queries: np.ndarray, k: int = 15, rerank: int = 300) -> Dict:
+        """Сравнение с точным поиском: recall@k с переранжированием и без, ошибка скоров"""
+        recalls, raw_recalls, errors = [], [], []
+        for query in queries:
+            exact_scores = np.concatenate([
+                np.asarray(exact_vectors[start:start + self.block_size], dtype=np.float32) @ query
+                for start in range(0, self.size, self.block_size)
+            ])
+            truth = set(_top_k(exact_scores, k).tolist())
+            approx = self.approximate_scores(query)
+            raw_recalls.append(len(truth & set(_top_k(approx, k).tolist())) / k)
+            found, _ = self.search(query, k, exact_vectors=exact_vectors, rerank=rerank)
+            recalls.append(len(truth & set(found.tolist())) / k)
+            errors.append(float(np.abs(approx - exact_scores).max()))
+
+        return {
+            'mode': self.mode,
+            f'recall@{k}': float(np.mean(recalls)),
+            f'recall@{k}_without_rerank': float(np.mean(raw_recalls)),
+            'max_score_error': float(np.max(errors)),
+            'compression': self.size * self.dim * 4 / max(self.memory_bytes(), 1)
+        }
+
+    def save(self, path: str):
+        arrays = {'data': self.data}
+        if self.scale is not None:
+            arrays['scale'] = self.scale
+        if self.codebooks is not None:
+            arrays['codebooks'] = self.codebooks
+        params = {'mode': self.mode, 'pq_m': self.pq_m, 'block_size': self.block_size}
+        with open(path, 'wb') as f:
+            np.savez(f, params=np.array(json.dumps(params)), **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> 'QuantizedEmbeddingStore':
+        with np.load(path, allow_pickle=False) as data:
+            store = cls(**json.loads(str(data['params'])))
+            store.data = data['data']
+            store.scale = data['scale'] if 'scale' in data.files else None
+            store.codebooks = data['codebooks'] if 'codebooks' in data.files else None
+        store.size = len(store.data)
+        store.dim = store.data.shape[1] if store.mode != 'pq' else store.codebooks.shape[0] * store.codebooks.shape[2]
+        return store
@@ -0,0 +1,117 @@
+# query_encoder.py - Кодирование поисковых запросов с динамическим микро-батчингом
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatchEncoder:
+    """Асинхронный кодировщик запросов.
+
+    Конкурентные запросы складываются в очередь, фоновая задача забирает
+    до max_batch_size текстов (ожидая не дольше max_wait_ms после первого)
+    и кодирует их одним вызовом encode_fn в отдельном потоке. Одинаковые
+    запросы в полете объединяются, готовые векторы хранятся в LRU-кэше.
+    """
+
+    def __init__(self, encode_fn: Callable[[List[str]], np.ndarray], max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0, cache_size: int = 10000):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.cache_size = cache_size
+        self.stats = {'requests': 0, 'cache_hits': 0, 'batches': 0, 'encoded': 0}
+        self._cache: OrderedDict = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        # Один поток: модель не кодирует параллельно, батч и так занимает все ядра
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='query-encoder')
+
+    @staticmethod
+    def normalize_query(text: str) -> str:
+        return ' '.join(text.split())
+
+    async def encode(self, text: str) -> np.ndarray:
+        key = self.normalize_query(text)
+        self.stats['requests'] += 1
+
+        vector = self._cache.get(key)
+        if vector is not None:
+            self._cache.move_to_end(key)
+            self.stats['cache_hits'] += 1
+            return vector
+
+        future = self._pending.get(key)
+        if future is None:
+            if self._worker is None or self._worker.done():
+                self._queue = asyncio.Queue()
+                self._worker = asyncio.create_task(self._run())
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            self._queue.put_nowait(key)
+
+        # shield: отмена одного клиента не должна отменять общий результат
+        return await asyncio.shield(future)
+
+    async def _collect_batch(self) -> List[str]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            try:
+                vectors = await loop.run_in_executor(self._executor, self.encode_fn, batch)
+            except Exception as e:
+                logger.error(f"Query encoding failed for batch of {len(batch)}: {e}")
+                for key in batch:
+                    future = self._pending.pop(key, None)
+                    if future is not None and not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.stats['batches'] += 1
+            self.stats['encoded'] += len(batch)
+            for key, vector in zip(batch, np.asarray(vectors, dtype=np.float32)):
+                vector.setflags(write=False)
+                self._remember(key, vector)
+                future = self._pending.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_result(vector)
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._cache[key] = vector
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._executor.shutdown(wait=False)
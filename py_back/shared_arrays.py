@@ -0,0 +1,158 @@
+# shared_arrays.py - Общие read-only массивы модели для нескольких воркеров uvicorn
+import fcntl
+import json
+import logging
+import os
+import time
+import asyncio
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+
+class SharedArrayStore:
+    """Хранилище больших массивов в memory-mapped .npy файлах.
+
+    Один процесс (лидер) строит массивы и публикует их, остальные воркеры
+    подключаются к тем же файлам в режиме только для чтения - страницы
+    делятся через page cache ОС и не дублируются в каждом процессе.
+    """
+
+    MANIFEST_FILE = 'manifest.json'
+    LOCK_FILE = '.leader.lock'
+
+    def __init__(self, root_dir: str, namespace: str, fingerprint: str = '', max_age: Optional[float] = None):
+        self.path = os.path.join(root_dir, namespace)
+        self.fingerprint = fingerprint
+        self.max_age = max_age
+        self._lock_fd = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _read_manifest(self) -> Optional[Dict]:
+        try:
+            with open(self._file(self.MANIFEST_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def is_ready(self) -> bool:
+        """Опубликованы ли актуальные массивы с тем же fingerprint"""
+        manifest = self._read_manifest()
+        if not manifest or manifest.get('fingerprint') != self.fingerprint:
+            return False
+        if self.max_age is not None and time.time() - manifest.get('created_at', 0) > self.max_age:
+            return False
+        return True
+
+    def try_become_leader(self) -> bool:
+        """Неблокирующий захват лидерства (flock снимается ОС, если лидер упал)"""
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(self._file(self.LOCK_FILE), os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def release(self):
+        if self._lock_fd is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _save_array(self, filename: str, array: np.ndarray):
+        tmp_path = self._file(filename + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+        os.replace(tmp_path, self._file(filename))
+
+    def publish(self, arrays: Dict[str, object], metadata: Optional[Dict] = None):
+        """Запись массивов (dense или scipy.sparse CSR) и манифеста.
+
+        Файлы заменяются атомарно, поэтому уже подключенные воркеры
+        продолжают читать старую версию до переподключения. Публикует
+        только лидер: два писателя перемешали бы файлы разных версий.
+        """
+        if self._lock_fd is None:
+            raise RuntimeError(f"Publishing to {self.path} requires leadership (try_become_leader)")
+        entries = {}
+        for name, array in arrays.items():
+            if sparse.issparse(array):
+                csr = array.tocsr()
+                for part in ('data', 'indices', 'indptr'):
+                    self._save_array(f"{name}.{part}.npy", getattr(csr, part))
+                entries[name] = {'kind': 'csr', 'shape': list(csr.shape)}
+            else:
+                self._save_array(f"{name}.npy", np.asarray(array))
+                entries[name] = {'kind': 'dense'}
+
+        if metadata is not None:
+            tmp_path = self._file('metadata.json.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(metadata, f, ensure_ascii=False, default=str)
+            os.replace(tmp_path, self._file('metadata.json'))
+
+        manifest = {
+            'fingerprint': self.fingerprint,
+            'created_at': time.time(),
+            'arrays': entries,
+            'has_metadata': metadata is not None
+        }
+        tmp_path = self._file(self.MANIFEST_FILE + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self._file(self.MANIFEST_FILE))
+
+        logger.info(f"Published {len(entries)} shared arrays to {self.path}")
+
+    def attach(self) -> Tuple[Dict[str, object], Optional[Dict]]:
+        """Подключение к опубликованным массивам только для чтения"""
+        manifest = self._read_manifest()
+        if not manifest:
+            raise RuntimeError(f"No shared arrays published in {self.path}")
+
+        arrays = {}
+        for name, entry in manifest['arrays'].items():
+            if entry['kind'] == 'csr':
+                parts = [np.load(self._file(f"{name}.{part}.npy"), mmap_mode='r')
+                         for part in ('data', 'indices', 'indptr')]
+                arrays[name] = sparse.csr_matrix(tuple(parts), shape=tuple(entry['shape']), copy=False)
+            else:
+                arrays[name] = np.load(self._file(f"{name}.npy"), mmap_mode='r')
+
+        metadata = None
+        if manifest.get('has_metadata'):
+            with open(self._file('metadata.json'), 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+
+        logger.info(f"Attached {len(arrays)} shared arrays from {self.path}")
+        return arrays, metadata
+
+    async def wait_until_ready(self, timeout: float = 3600, poll_interval: float = 1.0):
+        """Ожидание публикации массивов лидером.
+
+        True - массивы опубликованы, можно подключаться. False - лидер упал
+        до публикации и текущий процесс забрал лидерство (блокировка
+        удерживается): строить и публиковать массивы нужно самому, затем
+        release(). По истечении timeout - TimeoutError, блокировка не берется.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.is_ready():
+                return True
+            if self.try_become_leader():
+                if self.is_ready():
+                    self.release()
+                    return True
+                return False
+            await asyncio.sleep(poll_interval)
+        raise TimeoutError(f"Shared arrays in {self.path} were not published within {timeout}s")
@@ -1,8 +1,13 @@
+import asyncio
 import numpy as np
 from collections import defaultdict, Counter
 import logging
 from typing import List, Dict, Any
 import json
+import time
+from datetime import timedelta
+
+from popularity_index import PopularityIndex
 
 logger = logging.getLogger(__name__)
 
@@ -18,19 +23,56 @@ class SmartRecommendationEngine:
                 'availability': 0.05           # Доступность
             },
             'min_availability_score': 0.8,     # Минимальная доступность
-            'price_tolerance': 0.3             # Допуск по цене (±30%)
+            'price_tolerance': 0.3,            # Допуск по цене (±30%)
+            'popularity': {
+                'half_life_days': 90,          # вклад покупки вдвое меньше каждые 90 дней
+                'refresh_interval': 300,       # секунд между дозагрузками новых покупок
+                'watermark_overlap': 300       # запас на поздно закоммиченные позиции
+            }
         }
         
-        # Кэш популярных товаров
-        self.popular_products = []
+        # Популярность всего каталога с затуханием по времени
+        self.popularity = PopularityIndex(half_life_days=self.config['popularity']['half_life_days'])
+        self._popularity_watermark = None
+        self._popularity_refreshed_at = 0.0
+        self._recent_event_ids = {}  # позиции внутри окна перекрытия, чтобы не учесть дважды
+        self._popularity_lock = asyncio.Lock()
     
     async def initialize(self):
-        """Инициализация - загрузка популярных товаров"""
-        self.popular_products = await self.db.get_popular_products(200)
-        logger.info(f"📈 Loaded {len(self.popular_products)} popular products")
+        """Инициализация - построение индекса популярности"""
+        await self.refresh_popularity()
+        logger.info(f"📈 Popularity index: {len(self.popularity)} products, {self.popularity.events} purchases")
+    
+    async def refresh_popularity(self, max_age: float = 0.0):
+        """Дозагрузка покупок после водяного знака в индекс популярности.
+        
+        max_age - пропустить, если индекс обновлялся менее max_age секунд назад.
+        """
+        async with self._popularity_lock:
+            # Параллельные запросы ждут одну дозагрузку, а не считают одни и те же покупки повторно
+            if time.monotonic() - self._popularity_refreshed_at < max_age:
+                return
+            await self._load_purchase_events()
+    
+    async def _load_purchase_events(self):
+        overlap = timedelta(seconds=self.config['popularity']['watermark_overlap'])
+        since = self._popularity_watermark - overlap if self._popularity_watermark else None
+        events = [e for e in await self.db.get_purchase_events(since)
+                  if e['event_time'] is not None and e['procurement_item_id'] not in self._recent_event_ids]
+        
+        self.popularity.add_events([e['product_id'] for e in events], [e['event_time'] for e in events])
+        
+        for event in events:
+            if self._popularity_watermark is None or event['created_at'] > self._popularity_watermark:
+                self._popularity_watermark = event['created_at']
+            self._recent_event_ids[event['procurement_item_id']] = event['created_at']
+        if self._popularity_watermark is not None:
+            horizon = self._popularity_watermark - overlap
+            self._recent_event_ids = {k: v for k, v in self._recent_event_ids.items() if v > horizon}
+        self._popularity_refreshed_at = time.monotonic()
     
-    def _analyze_user_behavior(self, user_procurements: List[Dict]) -> Dict:
-        """Анализ поведения пользователя"""
+    def _analyze_user_behavior(self, user_procurements: Dict[str, np.ndarray]) -> Dict:
+        """Анализ поведения пользователя по колонкам истории закупок"""
         profile = {
             'purchased_products': set(),
             'preferred_categories': Counter(),
@@ -40,19 +82,22 @@ class SmartRecommendationEngine:
             'category_weights': defaultdict(float)
         }
         
-        if not user_procurements:
+        if not len(user_procurements['product_id']):
             return profile
         
+        # Цена позиции, а если она не указана - средняя цена товара
+        unit_prices = user_procurements['unit_price']
+        prices = np.where(unit_prices != 0, unit_prices, user_procurements['average_price'])
+        
         # Анализируем историю покупок
-        for procurement in user_procurements:
-            product_id = procurement['product_id']
-            category = procurement['category_name']
-            price = procurement['unit_price'] or procurement['average_price']
-            
+        for product_id, category, price, quantity in zip(user_procurements['product_id'].tolist(),
+                                                         user_procurements['category_name'].tolist(),
+                                                         prices.tolist(),
+                                                         user_procurements['quantity'].tolist()):
             profile['purchased_products'].add(product_id)
             profile['preferred_categories'][category] += 1
             profile['price_ranges'][category].append(price)
-            profile['total_spent'] += price * procurement.get('quantity', 1)
+            profile['total_spent'] += price * (quantity if quantity is not None else 1)
         
         # Вычисляем среднюю цену
         total_items = sum(profile['preferred_categories'].values())
@@ -68,66 +113,53 @@ class SmartRecommendationEngine:
         logger.info(f"👤 User profile: {total_items} items, {len(profile['preferred_categories'])} categories, avg price: {profile['avg_price_per_item']:.0f}")
         return profile
     
-    def _calculate_purchase_history_score(self, product: Dict, user_profile: Dict) -> float:
+    @staticmethod
+    def _category_lookup(categories: np.ndarray, category_codes: np.ndarray, values: Dict) -> np.ndarray:
+        """Значение из словаря по категории каждого товара (один поиск на уникальную категорию)"""
+        return np.array([values.get(category, 0) for category in categories.tolist()], dtype=np.float64)[category_codes]
+    
+    def _purchase_history_scores(self, categories: np.ndarray, category_codes: np.ndarray, user_profile: Dict) -> np.ndarray:
         """Скор на основе истории покупок"""
         if not user_profile['purchased_products']:
-            return 0.5  # Базовый скор если нет истории
-        
-        # Проверяем, покупал ли пользователь товары из той же категории
-        product_category = product.get('category_name', 'Другое')
-        category_weight = user_profile['category_weights'].get(product_category, 0)
+            return np.full(len(category_codes), 0.5)  # Базовый скор если нет истории
         
         # Увеличиваем скор если пользователь покупал в этой категории
-        return min(category_weight * 2.0, 1.0)
+        category_weights = self._category_lookup(categories, category_codes, user_profile['category_weights'])
+        return np.minimum(category_weights * 2.0, 1.0)
     
-    def _calculate_category_similarity(self, product: Dict, user_profile: Dict) -> float:
+    def _category_similarity_scores(self, categories: np.ndarray, category_codes: np.ndarray, user_profile: Dict) -> np.ndarray:
         """Схожесть по категориям"""
-        product_category = product.get('category_name', 'Другое')
-        
         if not user_profile['preferred_categories']:
-            return 0.3  # Базовый скор если нет предпочтений
+            return np.full(len(category_codes), 0.3)  # Базовый скор если нет предпочтений
         
         # Нормализуем количество покупок в категории
         max_count = max(user_profile['preferred_categories'].values())
-        category_count = user_profile['preferred_categories'].get(product_category, 0)
-        
-        return category_count / max_count if max_count > 0 else 0
+        category_counts = self._category_lookup(categories, category_codes, user_profile['preferred_categories'])
+        return category_counts / max_count if max_count > 0 else np.zeros(len(category_codes))
     
-    def _calculate_price_compatibility(self, product: Dict, user_profile: Dict) -> float:
+    def _price_compatibility_scores(self, prices: np.ndarray, user_profile: Dict) -> np.ndarray:
         """Совместимость по цене"""
-        product_price = product.get('average_price', 0)
         user_avg_price = user_profile['avg_price_per_item']
         
         if user_avg_price == 0:
-            return 0.5  # Базовый скор если нет данных о ценах
+            return np.full(len(prices), 0.5)  # Базовый скор если нет данных о ценах
         
         # Вычисляем насколько цена товара близка к привычной пользователю
-        price_ratio = min(product_price, user_avg_price) / max(product_price, user_avg_price)
+        price_ratio = np.minimum(prices, user_avg_price) / np.maximum(prices, user_avg_price)
         
         # Увеличиваем скор если цена в пределах допуска
         tolerance = self.config['price_tolerance']
-        if abs(product_price - user_avg_price) <= user_avg_price * tolerance:
-            return min(price_ratio + 0.3, 1.0)
-        
-        return price_ratio
+        within_tolerance = np.abs(prices - user_avg_price) <= user_avg_price * tolerance
+        return np.where(within_tolerance, np.minimum(price_ratio + 0.3, 1.0), price_ratio)
     
-    def _calculate_popularity_score(self, product: Dict) -> float:
-        """Скор популярности товара"""
-        product_id = product['product_id']
-        
-        # Ищем товар в списке популярных
-        for popular_product in self.popular_products:
-            if popular_product['product_id'] == product_id:
-                # Нормализуем количество покупок (0-1)
-                max_purchases = max(p['purchase_count'] for p in self.popular_products) if self.popular_products else 1
-                return popular_product['purchase_count'] / max_purchases
-        
-        return 0.1  # Базовый скор для непопулярных товаров
+    def _popularity_scores(self, product_ids: np.ndarray) -> np.ndarray:
+        """Скор популярности товара: затухающие покупки, нормированные на самый популярный (0.1 - без покупок)"""
+        return self.popularity.bulk_scores(product_ids.tolist())
     
-    def _calculate_availability_score(self, product: Dict) -> float:
+    def _availability_scores(self, product_ids: np.ndarray) -> np.ndarray:
         """Скор доступности"""
         # Все товары из БД уже filtered по is_available = true
-        return 1.0
+        return np.ones(len(product_ids))
     
     def _generate_explanation(self, product: Dict, user_profile: Dict, scores: Dict) -> str:
         """Генерация объяснения рекомендации"""
@@ -159,67 +191,78 @@ class SmartRecommendationEngine:
         """Умные персонализированные рекомендации"""
         
         # 1. Получаем историю пользователя
-        user_procurements = await self.db.get_user_procurements(user_id)
+        try:
+            user_procurements = await self.db.get_user_procurements_columns(user_id)
+        except Exception:
+            user_procurements = {'product_id': np.empty(0, dtype=object)}
         
-        # 2. Получаем доступные товары
-        available_products = await self.db.get_available_products(10000)
+        refresh_interval = self.config['popularity']['refresh_interval']
+        if time.monotonic() - self._popularity_refreshed_at > refresh_interval:
+            await self.refresh_popularity(max_age=refresh_interval)
+        
+        # 2. Получаем доступные товары колонками, без словаря на каждую строку
+        try:
+            products = await self.db.get_available_products_columns(10000)
+        except Exception:
+            return []
         
         # 3. Анализируем поведение пользователя
         user_profile = self._analyze_user_behavior(user_procurements)
         
-        # 4. Получаем названия категорий для товаров
-        for product in available_products:
-            product['category_name'] = await self.db.get_category_name(product['category_id'])
+        # 4. Получаем названия категорий для товаров (из кэша справочника, без запросов на товар)
+        product_ids = products['product_id']
+        prices = products['average_price']
+        categories, category_codes = await self.db.resolve_category_column(products['category_id'])
+        category_names = categories[category_codes]
         
-        # 5. Генерируем рекомендации
-        recommendations = []
+        # 5. Вычисляем компоненты скора сразу для всех товаров
+        scores = {
+            'purchase_history': self._purchase_history_scores(categories, category_codes, user_profile),
+            'category_similarity': self._category_similarity_scores(categories, category_codes, user_profile),
+            'price_compatibility': self._price_compatibility_scores(prices, user_profile),
+            'popularity': self._popularity_scores(product_ids),
+            'availability': self._availability_scores(product_ids)
+        }
+        
+        # Вычисляем общий скор (в том же порядке сложения, что и покомпонентно)
+        total_scores = np.zeros(len(product_ids))
+        for factor in scores:
+            total_scores = total_scores + scores[factor] * self.config['weights'][factor]
+        
+        # Пропускаем уже купленные товары и товары ниже минимального порога
         purchased_ids = user_profile['purchased_products']
+        not_purchased = np.fromiter((product_id not in purchased_ids for product_id in product_ids.tolist()),
+                                    dtype=bool, count=len(product_ids))
+        candidates = np.flatnonzero(not_purchased & (total_scores > 0.2))
         
-        for product in available_products:
-            # Пропускаем уже купленные товары
-            if product['product_id'] in purchased_ids:
-                continue
-            
-            # Вычисляем компоненты скора
-            scores = {
-                'purchase_history': self._calculate_purchase_history_score(product, user_profile),
-                'category_similarity': self._calculate_category_similarity(product, user_profile),
-                'price_compatibility': self._calculate_price_compatibility(product, user_profile),
-                'popularity': self._calculate_popularity_score(product),
-                'availability': self._calculate_availability_score(product)
-            }
-            
-            # Вычисляем общий скор
-            total_score = sum(
-                scores[factor] * self.config['weights'][factor] 
-                for factor in scores
-            )
-            
-            # Добавляем в рекомендации если скор выше порога
-            if total_score > 0.2:  # Минимальный порог
-                recommendations.append({
-                    'product_id': product['product_id'],
-                    'product_name': product['name'],
-                    'product_category': product['category_name'],
-                    'total_score': round(total_score, 4),
-                    'component_scores': {k: round(v, 4) for k, v in scores.items()},
-                    'explanation': self._generate_explanation(product, user_profile, scores),
-                    'price_range': {
-                        'avg': product['average_price'],
-                        'min': product['average_price'] * 0.7,
-                        'max': product['average_price'] * 1.3,
-                        'source': 'database_real'
-                    },
-                    'in_catalog': True,
-                    'is_available': True,
-                    'real_data': True
-                })
-        
-        # 6. Сортируем и ограничиваем
-        recommendations.sort(key=lambda x: x['total_score'], reverse=True)
-        final_recommendations = recommendations[:limit]
+        # 6. Сортируем по округленному скору (стабильно, как раньше) и ограничиваем
+        rounded_scores = np.array([round(score, 4) for score in total_scores[candidates].tolist()])
+        top = candidates[np.argsort(-rounded_scores, kind='stable')[:limit]]
+        
+        # Словари строим только для отобранных товаров
+        final_recommendations = []
+        for i in top.tolist():
+            product_scores = {factor: float(values[i]) for factor, values in scores.items()}
+            average_price = float(prices[i])
+            final_recommendations.append({
+                'product_id': product_ids[i],
+                'product_name': products['name'][i],
+                'product_category': category_names[i],
+                'total_score': round(float(total_scores[i]), 4),
+                'component_scores': {k: round(v, 4) for k, v in product_scores.items()},
+                'explanation': self._generate_explanation({'category_name': category_names[i]}, user_profile, product_scores),
+                'price_range': {
+                    'avg': average_price,
+                    'min': average_price * 0.7,
+                    'max': average_price * 1.3,
+                    'source': 'database_real'
+                },
+                'in_catalog': True,
+                'is_available': True,
+                'real_data': True
+            })
         
         logger.info(f"🎯 Generated {len(final_recommendations)} recommendations for user {user_id}")
         logger.info(f"📊 Score range: {final_recommendations[0]['total_score'] if final_recommendations else 0:.3f} - {final_recommendations[-1]['total_score'] if final_recommendations else 0:.3f}")
         
-        return final_recommendations
\ No newline at end of file
+        return final_recommendations
@@ -0,0 +1,351 @@
+# vector_index.py - Индексы ближайших соседей для семантического отбора кандидатов
+import json
+import logging
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Индексы k наибольших значений в порядке убывания"""
+    if k <= 0 or scores.size == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < scores.size:
+        part = np.argpartition(-scores, k - 1)[:k]
+    else:
+        part = np.arange(scores.size)
+    return part[np.argsort(-scores[part], kind='stable')]
+
+
+def _kmeans(x: np.ndarray, k: int, iterations: int = 20, seed: int = 42) -> np.ndarray:
+    """Простой k-means (евклидов) на NumPy, возвращает центроиды (k, dim)"""
+    rng = np.random.default_rng(seed)
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].astype(np.float32)
+
+    for _ in range(iterations):
+        # argmin ||x - c||^2 = argmax (x·c - ||c||^2 / 2)
+        assign = np.argmax(x @ centroids.T - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+        counts = np.bincount(assign, minlength=k)
+        nonempty = counts > 0
+        order = np.argsort(assign, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        sums = np.add.reduceat(x[order], starts, axis=0)
+        centroids[nonempty] = sums / counts[nonempty, None]
+        # Пустые кластеры переинициализируем случайными точками
+        empty = np.flatnonzero(~nonempty)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+
+    return centroids
+
+
+class VectorIndex(ABC):
+    """Базовый интерфейс индекса: ids - целые внешние идентификаторы,
+    скор - скалярное произведение (cosine для нормализованных векторов)."""
+
+    backend = 'base'
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.ids = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.id_to_slot: Dict[int, int] = {}
+        # Буферы с запасом емкости под массивы-атрибуты, см. _append
+        self._buffers: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.id_to_slot)
+
+    @abstractmethod
+    def build(self, ids: Iterable[int], vectors: np.ndarray):
+        """Построение индекса с нуля"""
+
+    @abstractmethod
+    def add(self, ids: Iterable[int], vectors: np.ndarray):
+        """Добавление (или замена) векторов без перестроения"""
+
+    def remove(self, ids: Iterable[int]):
+        for external_id in ids:
+            slot = self.id_to_slot.pop(int(external_id), None)
+            if slot is not None:
+                self.alive[slot] = False
+
+    @abstractmethod
+    def search(self, query: np.ndarray, k: int, exclude: Optional[Iterable[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(ids, скоры) k ближайших по убыванию скора"""
+
+    def _register(self, ids: np.ndarray):
+        # Повторная вставка id заменяет старую запись
+        self.remove(ids)
+        start = len(self.ids)
+        self._append('ids', ids)
+        self._append('alive', np.ones(len(ids), dtype=bool))
+        for offset, external_id in enumerate(ids):
+            self.id_to_slot[int(external_id)] = start + offset
+
+    def _append(self, name: str, rows: np.ndarray):
+        """Дописать строки в массив-атрибут name за амортизированное O(len(rows)).
+
+        Атрибут - срез буфера с запасом; при заполнении буфер удваивается.
+        Если атрибут заменили (build, _restore, memmap), буфер создается заново.
+        """
+        current = getattr(self, name)
+        size = len(current)
+        buffer = self._buffers.get(name)
+        if buffer is None or current.base is not buffer or len(buffer) < size + len(rows):
+            buffer = np.empty((max(size + len(rows), 2 * size, 16),) + current.shape[1:], dtype=current.dtype)
+            buffer[:size] = current
+            self._buffers[name] = buffer
+        buffer[size:size + len(rows)] = rows
+        setattr(self, name, buffer[:size + len(rows)])
+
+    def _search_mask(self, exclude: Optional[Iterable[int]]) -> np.ndarray:
+        mask = self.alive.copy()
+        if exclude is not None:
+            slots = [self.id_to_slot[int(i)] for i in exclude if int(i) in self.id_to_slot]
+            mask[slots] = False
+        return mask
+
+    def _state(self) -> Dict[str, np.ndarray]:
+        return {'ids': self.ids, 'alive': self.alive}
+
+    def _restore(self, arrays: Dict[str, np.ndarray]):
+        self.ids = arrays['ids']
+        self.alive = arrays['alive'].copy()
+        self.id_to_slot = {int(i): slot for slot, i in enumerate(self.ids) if self.alive[slot]}
+
+    def save(self, path: str, meta: Optional[Dict] = None):
+        params = {'backend': self.backend, 'dim': self.dim, 'params': self._params(), 'meta': meta or {}}
+        with open(path, 'wb') as f:
+            np.savez(f, params=np.array(json.dumps(params)), **self._state())
+        logger.info(f"Saved {self.backend} index with {len(self)} vectors to {path}")
+
+    @staticmethod
+    def load(path: str) -> 'VectorIndex':
+        with np.load(path, allow_pickle=False) as data:
+            params = json.loads(str(data['params']))
+            arrays = {name: data[name] for name in data.files if name != 'params'}
+        index = INDEX_BACKENDS[params['backend']](params['dim'], **params['params'])
+        index._restore(arrays)
+        index.meta = params['meta']
+        return index
+
+    def _params(self) -> Dict:
+        return {}
+
+
+class ExactIndex(VectorIndex):
+    """Точный поиск: блочное умножение матрицы на запрос + argpartition"""
+
+    backend = 'exact'
+
+    def __init__(self, dim: int, block_size: int = 65536):
+        super().__init__(dim)
+        self.block_size = block_size
+        self.vectors = np.empty((0, dim), dtype=np.float32)
+
+    def _params(self) -> Dict:
+        return {'block_size': self.block_size}
+
+    def build(self, ids: Iterable[int], vectors: np.ndarray):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.id_to_slot = {}
+        # Не копируем: матрица может быть memmap из общего хранилища
+        self.vectors = vectors
+        self._register(np.asarray(list(ids), dtype=np.int64))
+
+    def add(self, ids: Iterable[int], vectors: np.ndarray):
+        ids = np.asarray(list(ids), dtype=np.int64)
+        self._append('vectors', np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim))
+        self._register(ids)
+
+    def compact(self):
+        """Физически удалить помеченные на удаление векторы"""
+        keep = np.flatnonzero(self.alive)
+        ids = self.ids[keep]
+        self.build(ids, np.asarray(self.vectors[keep]))
+
+    def search(self, query, k, exclude=None):
+        query = np.asarray(query, dtype=np.float32)
+        mask = self._search_mask(exclude)
+
+        best_slots, best_scores = [], []
+        for start in range(0, len(self.ids), self.block_size):
+            scores = np.asarray(self.vectors[start:start + self.block_size]) @ query
+            scores[~mask[start:start + self.block_size]] = -np.inf
+            top = _top_k(scores, k)
+            best_slots.append(top + start)
+            best_scores.append(scores[top])
+
+        if not best_slots:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        slots = np.concatenate(best_slots)
+        scores = np.concatenate(best_scores)
+        order = _top_k(scores, k)
+        order = order[np.isfinite(scores[order])]
+        return self.ids[slots[order]], scores[order]
+
+    def _state(self):
+        state = super()._state()
+        state['vectors'] = np.asarray(self.vectors)
+        return state
+
+    def _restore(self, arrays):
+        super()._restore(arrays)
+        self.vectors = arrays['vectors']
+
+
+class IVFPQIndex(VectorIndex):
+    """IVF-PQ на чистом NumPy: грубый квантователь (k-means на nlist кластеров)
+    и product quantization остатков (m подпространств по 256 центроидов).
+    Поиск просматривает nprobe ближайших списков, опционально с точным
+    переранжированием по исходным векторам."""
+
+    backend = 'ivfpq'
+
+    def __init__(self, dim: int, nlist: int = 1024, m: int = 48, nprobe: int = 16,
+                 train_size: int = 100000, kmeans_iterations: int = 20):
+        super().__init__(dim)
+        if dim % m:
+            raise ValueError(f"Dimension {dim} is not divisible by m={m}")
+        self.nlist = nlist
+        self.m = m
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.kmeans_iterations = kmeans_iterations
+        self.dsub = dim // m
+        self.coarse_centroids = None
+        self.codebooks = None  # (m, 256, dsub)
+        self.list_assign = np.empty(0, dtype=np.int32)
+        self.codes = np.empty((0, m), dtype=np.uint8)
+        self._lists = None
+
+    def _params(self) -> Dict:
+        return {'nlist': self.nlist, 'm': self.m, 'nprobe': self.nprobe,
+                'train_size': self.train_size, 'kmeans_iterations': self.kmeans_iterations}
+
+    def train(self, vectors: np.ndarray):
+        rng = np.random.default_rng(42)
+        sample_idx = rng.choice(len(vectors), min(self.train_size, len(vectors)), replace=False)
+        sample = np.asarray(vectors[np.sort(sample_idx)], dtype=np.float32)
+
+        self.coarse_centroids = _kmeans(sample, self.nlist, self.kmeans_iterations)
+        self.nlist = len(self.coarse_centroids)
+
+        # Для кодбуков PQ достаточно ~40 точек на центроид
+        residuals = sample - self.coarse_centroids[self._assign(sample)]
+        residuals = residuals[:256 * 40]
+        ksub = min(256, len(residuals))
+        self.codebooks = np.stack([
+            _kmeans(residuals[:, j * self.dsub:(j + 1) * self.dsub], ksub, self.kmeans_iterations)
+            for j in range(self.m)
+        ])
+        logger.info(f"Trained IVF-PQ: nlist={self.nlist}, m={self.m}, sample={len(sample)}")
+
+    def _assign(self, x: np.ndarray) -> np.ndarray:
+        c = self.coarse_centroids
+        return np.argmax(x @ c.T - 0.5 * (c ** 2).sum(axis=1), axis=1).astype(np.int32)
+
+    def _encode(self, x: np.ndarray, assign: np.ndarray) -> np.ndarray:
+        residuals = x - self.coarse_centroids[assign]
+        codes = np.empty((len(x), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            sub = residuals[:, j * self.dsub:(j + 1) * self.dsub]
+            book = self.codebooks[j]
+            codes[:, j] = np.argmax(sub @ book.T - 0.5 * (book ** 2).sum(axis=1), axis=1)
+        return codes
+
+    def build(self, ids, vectors, chunk_size: int = 50000):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.id_to_slot = {}
+        self.list_assign = np.empty(0, dtype=np.int32)
+        self.codes = np.empty((0, self.m), dtype=np.uint8)
+        self.train(vectors)
+
+        ids = np.asarray(list(ids), dtype=np.int64)
+        for start in range(0, len(ids), chunk_size):
+            self.add(ids[start:start + chunk_size], vectors[start:start + chunk_size])
+
+    def add(self, ids, vectors):
+        if self.coarse_centroids is None:
+            raise RuntimeError("IVF-PQ index must be trained before adding vectors")
+        ids = np.asarray(list(ids), dtype=np.int64)
+        x = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        assign = self._assign(x)
+        self._append('list_assign', assign)
+        self._append('codes', self._encode(x, assign))
+        self._register(ids)
+        self._lists = None
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            order = np.argsort(self.list_assign, kind='stable')
+            bounds = np.searchsorted(self.list_assign[order], np.arange(self.nlist + 1))
+            self._lists = (order, bounds)
+        return self._lists
+
+    def search(self, query, k, exclude=None, refine_vectors: Optional[np.ndarray] = None, refine_factor: int = 4):
+        """refine_vectors - исходные векторы по внешним id (строкам) для точного переранжирования"""
+        query = np.asarray(query, dtype=np.float32)
+        mask = self._search_mask(exclude)
+        order, bounds = self._inverted_lists()
+
+        coarse_scores = self.coarse_centroids @ query
+        probe = _top_k(coarse_scores, self.nprobe)
+
+        slots = np.concatenate([order[bounds[l]:bounds[l + 1]] for l in probe])
+        slots = slots[mask[slots]]
+        if slots.size == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # Таблица скалярных произведений запроса с центроидами подпространств (m, 256)
+        table = np.einsum('jkd,jd->jk', self.codebooks, query.reshape(self.m, self.dsub))
+        scores = coarse_scores[self.list_assign[slots]] + table[np.arange(self.m), self.codes[slots]].sum(axis=1)
+
+        if refine_vectors is None:
+            top = _top_k(scores, k)
+            return self.ids[slots[top]], scores[top]
+
+        shortlist = slots[_top_k(scores, k * refine_factor)]
+        ids = self.ids[shortlist]
+        exact = np.asarray(refine_vectors[ids]) @ query
+        top = _top_k(exact, k)
+        return ids[top], exact[top]
+
+    def _state(self):
+        state = super()._state()
+        state.update({
+            'coarse_centroids': self.coarse_centroids,
+            'codebooks': self.codebooks,
+            'list_assign': self.list_assign,
+            'codes': self.codes
+        })
+        return state
+
+    def _restore(self, arrays):
+        super()._restore(arrays)
+        self.coarse_centroids = arrays['coarse_centroids']
+        self.codebooks = arrays['codebooks']
+        self.list_assign = arrays['list_assign']
+        self.codes = arrays['codes']
+        self.nlist = len(self.coarse_centroids)
+        self._lists = None
+
+
+INDEX_BACKENDS = {
+    ExactIndex.backend: ExactIndex,
+    IVFPQIndex.backend: IVFPQIndex
+}
+
+
+def create_vector_index(backend: str, dim: int, **params) -> VectorIndex:
+    if backend not in INDEX_BACKENDS:
+        raise ValueError(f"Unknown vector index backend: {backend}")
+    return INDEX_BACKENDS[backend](dim, **params)
@@ -0,0 +1,78 @@
+# weighted_stats.py - Взвешенные статистики по парам (значение, вес) без размножения строк
+from typing import Dict, Sequence
+
+import numpy as np
+
+
+def _as_arrays(values: Sequence[float], weights: Sequence[float]):
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    if values.shape[0] != weights.shape[0]:
+        raise ValueError(f"values and weights length mismatch: {values.shape[0]} != {weights.shape[0]}")
+    positive = weights > 0
+    return values[positive], weights[positive]
+
+
+def weighted_mean(values: Sequence[float], weights: Sequence[float]) -> float:
+    values, weights = _as_arrays(values, weights)
+    if not len(values):
+        return 0.0
+    return float(np.dot(values, weights) / weights.sum())
+
+
+def weighted_std(values: Sequence[float], weights: Sequence[float]) -> float:
+    """Стандартное отклонение по генеральной совокупности (как np.std размноженного списка)"""
+    values, weights = _as_arrays(values, weights)
+    if not len(values):
+        return 0.0
+    mean = np.dot(values, weights) / weights.sum()
+    return float(np.sqrt(np.dot(weights, (values - mean) ** 2) / weights.sum()))
+
+
+def weighted_quantiles(values: Sequence[float], weights: Sequence[float], qs: Sequence[float]) -> np.ndarray:
+    """Квантили с семантикой sorted(expanded)[floor(q * W)], W - сумма весов.
+
+    Для целых весов совпадает с выбором элемента из отсортированного списка,
+    где значение повторено weight раз, но стоит O(n log n) по числу строк.
+    """
+    values, weights = _as_arrays(values, weights)
+    if not len(values):
+        return np.full(len(qs), np.nan)
+
+    order = np.argsort(values, kind='stable')
+    cumulative = np.cumsum(weights[order])
+    positions = np.floor(np.asarray(qs, dtype=np.float64) * cumulative[-1])
+    # Индекс первой строки, чей накопленный вес превышает позицию
+    idx = np.minimum(np.searchsorted(cumulative, positions, side='right'), len(order) - 1)
+    return values[order[idx]]
+
+
+def weighted_quantile(values: Sequence[float], weights: Sequence[float], q: float) -> float:
+    return float(weighted_quantiles(values, weights, [q])[0])
+
+
+def weighted_summary(values: Sequence[float], weights: Sequence[float]) -> Dict[str, float]:
+    """min/max/avg/std/median/q1/q3 за одну сортировку"""
+    values, weights = _as_arrays(values, weights)
+    if not len(values):
+        return {}
+    q1, median, q3 = weighted_quantiles(values, weights, [0.25, 0.5, 0.75])
+    return {
+        'min': float(values.min()),
+        'max': float(values.max()),
+        'avg': weighted_mean(values, weights),
+        'std': weighted_std(values, weights),
+        'median': float(median),
+        'q1': float(q1),
+        'q3': float(q3)
+    }
+
+
+def weighted_centroid(vectors: np.ndarray, weights: Sequence[float]) -> np.ndarray:
+    """Взвешенное среднее строк матрицы (как np.mean по строкам, повторенным weight раз)"""
+    weights = np.asarray(weights, dtype=np.float64)
+    if len(weights) != len(vectors):
+        raise ValueError(f"vectors and weights length mismatch: {len(vectors)} != {len(weights)}")
+    if not len(weights) or weights.sum() <= 0:
+        raise ValueError("weighted centroid requires a positive total weight")
+    return weights @ np.asarray(vectors, dtype=np.float64) / weights.sum()
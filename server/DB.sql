@@ -243,4 +243,119 @@ CREATE TABLE procurement_drafts (
 
 -- Индексы для черновиков
 CREATE INDEX idx_procurement_drafts_user ON procurement_drafts(user_id);
-CREATE INDEX idx_procurement_drafts_updated ON procurement_drafts(updated_at DESC);
\ No newline at end of file
+CREATE INDEX idx_procurement_drafts_updated ON procurement_drafts(updated_at DESC);
+-- 📈 ПРЕДАГРЕГИРОВАННАЯ СТАТИСТИКА ТОВАРОВ
+-- Заполняется и инкрементально обновляется джобой py_back/product_stats.py,
+-- загрузчики каталога делают JOIN вместо коррелированных подзапросов по procurement_items
+CREATE TABLE product_stats (
+    product_id VARCHAR(100) PRIMARY KEY REFERENCES products(product_id) ON DELETE CASCADE,
+    purchase_count INTEGER NOT NULL DEFAULT 0,  -- число позиций закупок с товаром
+    unique_buyers INTEGER NOT NULL DEFAULT 0,  -- число различных пользователей
+    total_quantity BIGINT NOT NULL DEFAULT 0,
+    last_purchased TIMESTAMP,
+    purchases_30d INTEGER NOT NULL DEFAULT 0,  -- скользящие окна по дате закупки
+    purchases_90d INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Водяной знак инкрементального обновления (одна строка)
+CREATE TABLE product_stats_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    watermark TIMESTAMP,  -- procurement_items.created_at, до которого позиции учтены
+    refreshed_at TIMESTAMP  -- момент последнего пересчета скользящих окон
+);
+
+CREATE INDEX idx_product_stats_purchase_count ON product_stats(purchase_count DESC);
+CREATE INDEX idx_procurement_items_created ON procurement_items(created_at);
+
+-- 📣 ЛЕНТА ИЗМЕНЕНИЙ КАТАЛОГА
+-- Резидентный каталог py_back/catalog_feed.py слушает канал catalog_changes
+-- и перечитывает только товары из уведомлений ('*' - полная перезагрузка)
+CREATE OR REPLACE FUNCTION notify_catalog_product_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM pg_notify('catalog_changes', OLD.product_id);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM pg_notify('catalog_changes', NEW.product_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_catalog_reload() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('catalog_changes', '*');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_products_catalog_changes
+AFTER INSERT OR UPDATE OR DELETE ON products
+FOR EACH ROW EXECUTE FUNCTION notify_catalog_product_change();
+
+-- purchase_count в каталоге берется из product_stats, а не напрямую из procurement_items
+CREATE TRIGGER trg_product_stats_catalog_changes
+AFTER INSERT OR UPDATE OR DELETE ON product_stats
+FOR EACH ROW EXECUTE FUNCTION notify_catalog_product_change();
+
+-- Переименование категории затрагивает много товаров - проще перечитать каталог
+CREATE TRIGGER trg_categories_catalog_changes
+AFTER INSERT OR UPDATE OR DELETE ON categories
+FOR EACH STATEMENT EXECUTE FUNCTION notify_catalog_reload();
+
+-- 🔤 НОРМАЛИЗОВАННЫЕ НАЗВАНИЯ И ГРУППЫ ДУБЛИКАТОВ
+-- Считаются один раз при вставке/переименовании товара, движки дедуплицируют по dedup_group_id.
+-- Строкам без бэкфилла движки подставляют группу по normalized_name (LEFT JOIN product_name_groups).
+-- Существующие товары заполняет py_back/product_names.py (там же Python-копия правил)
+CREATE TABLE product_name_groups (
+    group_id SERIAL PRIMARY KEY,
+    normalized_name TEXT NOT NULL UNIQUE
+);
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS normalized_name TEXT;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS dedup_group_id INTEGER REFERENCES product_name_groups(group_id);
+CREATE INDEX idx_products_dedup_group ON products(dedup_group_id);
+
+CREATE OR REPLACE FUNCTION normalize_product_name(p_name TEXT) RETURNS TEXT AS $$
+    SELECT btrim(
+        regexp_replace(
+        regexp_replace(
+        regexp_replace(
+        regexp_replace(
+        regexp_replace(
+            lower(regexp_replace(COALESCE(p_name, ''), '^\s+|\s+$', '', 'g')),
+            '\s+', ' ', 'g'),
+            '\s*\(\s*\d+\s*шт/\s*уп\s*\)', '', 'g'),  -- размер упаковки в скобках (100 шт/уп)
+            '\s*\d+\s*шт/\s*уп\.?', '', 'g'),
+            '\s*\(\s*[^)]*\d+\s*мм\s*[^)]*\)', '', 'g'),  -- размеры в мм
+            '\s*\[[^]]*\]', '', 'g'),  -- пометки в квадратных скобках
+        ' ')
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION product_name_group_id(p_normalized TEXT) RETURNS INTEGER AS $$
+DECLARE
+    v_group_id INTEGER;
+BEGIN
+    INSERT INTO product_name_groups (normalized_name) VALUES (p_normalized)
+    ON CONFLICT (normalized_name) DO NOTHING
+    RETURNING group_id INTO v_group_id;
+
+    IF v_group_id IS NULL THEN
+        SELECT group_id INTO v_group_id FROM product_name_groups WHERE normalized_name = p_normalized;
+    END IF;
+    RETURN v_group_id;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION set_product_normalized_name() RETURNS trigger AS $$
+BEGIN
+    NEW.normalized_name := normalize_product_name(NEW.name);
+    NEW.dedup_group_id := product_name_group_id(NEW.normalized_name);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trg_products_normalized_name
+BEFORE INSERT OR UPDATE OF name ON products
+FOR EACH ROW EXECUTE FUNCTION set_product_normalized_name();
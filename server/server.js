@@ -1619,6 +1619,22 @@ app.post("/api/ml/recommendations", async (req, res) => {
   }
 });
 
+app.post("/api/ml/search", async (req, res) => {
+  try {
+    const r = await fetch("http://127.0.0.1:8000/api/search", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(req.body),
+    });
+
+    const data = await r.json();
+    res.status(r.status).json(data);
+  } catch (err) {
+    console.error("ML search error:", err);
+    res.status(500).json({ error: "ML service unreachable" });
+  }
+});
+
 // =============================================
 // СЛУЖЕБНЫЕ ENDPOINTS
 // =============================================